@@ -6,7 +6,14 @@ from sio.executors.checker import output_to_fraction
 from sio.executors.common import _extract_input_if_zipfile, _populate_environ
 from sio.workers import ft
 from sio.workers.executors import DetailedUnprotectedExecutor
-from sio.workers.util import TemporaryCwd, decode_fields, replace_invalid_UTF, tempcwd
+from sio.workers.util import (
+    RunningJob,
+    TemporaryCwd,
+    current_job,
+    decode_fields,
+    replace_invalid_UTF,
+    tempcwd,
+)
 from sio.workers.file_runners import get_file_runner
 
 import signal
@@ -162,9 +169,11 @@ def _run(environ, executor, use_sandboxes):
                 self.kwargs = kwargs
                 self.value = None
                 self.exception = None
+                # Cancelling the job kills the commands run by the thread.
+                self.job = current_job()
             
             def run(self):
-                with TemporaryCwd():
+                with RunningJob(self.job), TemporaryCwd():
                     try:
                         self.value = self.executor(*self.args, **self.kwargs)
                     except Exception as e:
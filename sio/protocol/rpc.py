@@ -1,16 +1,76 @@
 from __future__ import absolute_import
 from twisted.protocols.basic import NetstringReceiver
 from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 import six
 
 log = Logger()
 
 import json
+import zlib
 from enum import Enum
 
 from sio.workers.util import json_dumps
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _json_dumps(obj):
+    return json_dumps(obj).encode('utf-8')
+
+
+def _json_key(key):
+    if isinstance(key, bytes):
+        return key.decode('utf-8')
+    return json.dumps(key)
+
+
+def _to_json_types(obj):
+    """Returns ``obj`` as it's decoded from JSON: with string keys of
+    dicts, lists instead of tuples and bytes sent as UTF-8 strings."""
+    cls = type(obj)
+    if cls is dict:
+        return {
+            key if type(key) is str else _json_key(key): _to_json_types(value)
+            for key, value in six.iteritems(obj)
+        }
+    elif cls is list or cls is tuple:
+        return [_to_json_types(value) for value in obj]
+    elif cls is bytes:
+        return obj.decode('utf-8')
+    return obj
+
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(_to_json_types(obj))
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# Encodings of messages which can be negotiated in the handshake, see
+# WorkerRPC. Maps: name -> (dumps, loads), in the order of preference.
+# All of them must decode messages like JSON does, as the handlers don't
+# know which one is used. msgpack is used if it's installed, it is a few
+# times faster than JSON.
+ENCODINGS = {'json': (_json_dumps, json.loads)}
+if msgpack is not None:
+    ENCODINGS = dict(msgpack=(_msgpack_dumps, _msgpack_loads), **ENCODINGS)
+COMPRESSIONS = ('zlib',)
+
+# Flags in the first byte of negotiated frames.
+FRAME_COMPRESSED = 1
+# The message is continued in the next frame.
+FRAME_MORE = 2
+
+# How often (in seconds) workers and sioworkersd send heartbeats.
+DEFAULT_HEARTBEAT_INTERVAL = 10
+
 
 State = Enum('State', 'connected sent_hello established')
 
@@ -50,25 +110,83 @@ def makeRemoteException(msg, uid=None):
 
 
 class WorkerRPC(NetstringReceiver):
+    """JSON-RPC-like protocol over netstrings.
+
+    Messages are JSON-encoded, one per netstring. Clients offer other
+    framing in their hello: an encoding (see ``ENCODINGS``), compression
+    of large messages and splitting of messages longer than
+    ``MAX_LENGTH`` into several frames. The server chooses what it
+    supports in its hello_ack, and both sides switch to it after the
+    handshake. Peers which don't know about it stay with plain JSON.
+    Both sides tell their ``MAX_LENGTH`` as well, which is the longest
+    frame the other one may send.
+
+    A negotiated frame starts with a byte of ``FRAME_*`` flags, which is
+    followed by a part of the encoded, possibly compressed, message.
+
+    If both sides say in the handshake that they answer heartbeats, the
+    ones with ``heartbeatInterval`` set send pings that often. The peer
+    is considered dead and the connection is aborted if nothing is
+    received from it after ``HEARTBEAT_MISSES`` pings in a row. The pings
+    are counted rather than the time, so that the peers aren't dropped
+    when our own reactor stalls. Round-trip times
+    of the pings are averaged in ``rtt``.
+    """
+
     MAX_LENGTH = 2 ** 20  # 1MB should be enough
+    # Longest message which is reassembled from negotiated frames.
+    MAX_MESSAGE_LENGTH = 2 ** 28
+    # Negotiated messages longer than this are compressed.
+    COMPRESSION_THRESHOLD = 2 ** 12
     DEFAULT_TIMEOUT = 30
+    # Encodings and compression methods which are offered or accepted,
+    # in the order of preference.
+    FRAMING_ENCODINGS = tuple(ENCODINGS)
+    FRAMING_COMPRESSIONS = COMPRESSIONS
+    HEARTBEAT_MISSES = 3
+    # Weight of a new round-trip time in the average, like in TCP.
+    RTT_GAIN = 0.125
 
-    def __init__(self, server=False, timeout=DEFAULT_TIMEOUT):
+    def __init__(self, server=False, timeout=DEFAULT_TIMEOUT, heartbeat_interval=None):
         self.requestID = 0
         # dictionary of pending call() requests,
         # pendingCalls[requestID] = (returned deferred, timeout deferred)
         self.pendingCalls = {}
+        # Ids of calls which have timed out, their replies are dropped.
+        self.timedOutCalls = set()
         self.isServer = server
         self.state = None
         # Fired when state changes to established.
         self.ready = defer.Deferred()
         self.defaultTimeout = timeout
         self.clientInfo = {}
+        # Negotiated framing, None for plain JSON messages.
+        self.encoding = None
+        self.compression = None
+        self.peerMaxLength = self.MAX_LENGTH
+        self._chunks = []
+        self._chunksLength = 0
+        # Heartbeats are sent by the clock, which tests may replace.
+        self.clock = reactor
+        self.heartbeatInterval = heartbeat_interval
+        self.peerHeartbeats = False
+        self.rtt = None
+        self._heartbeatCall = None
+        self._lastReceived = None
+        # Pings sent since the peer last sent anything.
+        self._unansweredPings = 0
 
     def connectionMade(self):
         self.state = State.connected
         if not self.isServer:
-            self.sendMsg('hello', data=self.getHelloData())
+            kwargs = {}
+            if self.FRAMING_ENCODINGS:
+                kwargs['framing'] = {
+                    'encodings': list(self.FRAMING_ENCODINGS),
+                    'compression': list(self.FRAMING_COMPRESSIONS),
+                    'max_length': self.MAX_LENGTH,
+                }
+            self.sendMsg('hello', data=self.getHelloData(), heartbeats=True, **kwargs)
             self.state = State.sent_hello
             log.debug('sent hello')
 
@@ -77,12 +195,17 @@ class WorkerRPC(NetstringReceiver):
         for (_, timer) in six.itervalues(self.pendingCalls):
             if not timer.called:
                 timer.cancel()
+        if self._heartbeatCall is not None and self._heartbeatCall.running:
+            self._heartbeatCall.stop()
 
     def _processMessage(self, msg):
         if self.state == State.established:
             if msg['type'] == 'result':
                 d = self.pendingCalls.get(msg['id'])
                 if d is None:
+                    if msg['id'] in self.timedOutCalls:
+                        self.timedOutCalls.remove(msg['id'])
+                        return
                     raise ProtocolError("got result for unknown call")
                 del self.pendingCalls[msg['id']]
                 d[0].callback(msg['result'])
@@ -104,11 +227,18 @@ class WorkerRPC(NetstringReceiver):
             elif msg['type'] == 'error':
                 d = self.pendingCalls.get(msg['id'])
                 if d is None:
+                    if msg['id'] in self.timedOutCalls:
+                        self.timedOutCalls.remove(msg['id'])
+                        return
                     raise ProtocolError("got error for unknown call")
                 del self.pendingCalls[msg['id']]
                 exc = makeRemoteException(msg, uid=getattr(self, 'uniqueID', None))
                 d[0].errback(exc)
                 d[1].cancel()
+            elif msg['type'] == 'ping':
+                self.sendMsg('pong', time=msg['time'])
+            elif msg['type'] == 'pong':
+                self._updateRtt(self.clock.seconds() - msg['time'])
         elif self.state == State.connected:
             if not self.isServer:
                 raise ProtocolError(
@@ -118,15 +248,31 @@ class WorkerRPC(NetstringReceiver):
                 if msg['type'] == 'hello':
                     log.debug('got hello')
                     self.clientInfo = msg['data']
-                    self.sendMsg('hello_ack')
+                    offer = msg.get('framing')
+                    framing = self._chooseFraming(offer)
+                    kwargs = {}
+                    if framing is not None:
+                        kwargs['framing'] = framing
+                    self.peerHeartbeats = bool(msg.get('heartbeats'))
+                    if self.peerHeartbeats:
+                        kwargs['heartbeats'] = True
+                    self.sendMsg('hello_ack', **kwargs)
+                    if framing is not None:
+                        framing['max_length'] = offer.get('max_length')
+                        self._useFraming(framing)
                     self.state = State.established
+                    self._startHeartbeats()
                     self.ready.callback(None)
                 else:
                     raise ProtocolError("expected client hello, got %s" % str(msg))
         elif self.state == State.sent_hello:
             if msg['type'] == 'hello_ack':
                 log.debug('got hello_ack')
+                if msg.get('framing') is not None:
+                    self._useFraming(msg['framing'])
+                self.peerHeartbeats = bool(msg.get('heartbeats'))
                 self.state = State.established
+                self._startHeartbeats()
                 self.ready.callback(None)
             else:
                 raise ProtocolError("expected hello_ack, got %s" % str(msg))
@@ -136,13 +282,106 @@ class WorkerRPC(NetstringReceiver):
         Should return a dict."""
         return {}
 
+    def _startHeartbeats(self):
+        self._lastReceived = self.clock.seconds()
+        if not (self.heartbeatInterval and self.peerHeartbeats):
+            return
+        self._heartbeatCall = LoopingCall(self._heartbeat)
+        self._heartbeatCall.clock = self.clock
+        self._heartbeatCall.start(self.heartbeatInterval, now=False)
+
+    def _heartbeat(self):
+        now = self.clock.seconds()
+        if self._unansweredPings >= self.HEARTBEAT_MISSES:
+            log.warn(
+                '{uid} answered none of {n} pings in {s:.1f} seconds, dropping it',
+                uid=getattr(self, 'uniqueID', None) or 'peer',
+                n=self._unansweredPings,
+                s=now - self._lastReceived,
+            )
+            self._heartbeatCall.stop()
+            self.transport.abortConnection()
+            return
+        self._unansweredPings += 1
+        self.sendMsg('ping', time=now)
+
+    def _updateRtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.RTT_GAIN * (rtt - self.rtt)
+        self.rttUpdated()
+
+    def rttUpdated(self):
+        """Placeholder method, called when ``rtt`` changes."""
+
+    def _chooseFraming(self, offer):
+        """Returns the framing chosen from the client's offer, or None."""
+        if not offer:
+            return None
+        encodings = [e for e in self.FRAMING_ENCODINGS if e in offer['encodings']]
+        if not encodings:
+            return None
+        compressions = [
+            c for c in self.FRAMING_COMPRESSIONS if c in offer.get('compression', ())
+        ]
+        return {
+            'encoding': encodings[0],
+            'compression': compressions[0] if compressions else None,
+            'max_length': self.MAX_LENGTH,
+        }
+
+    def _useFraming(self, framing):
+        encoding = framing.get('encoding')
+        compression = framing.get('compression')
+        if encoding not in ENCODINGS or compression not in (None,) + COMPRESSIONS:
+            raise ProtocolError("unsupported framing %s" % str(framing))
+        self.encoding = encoding
+        self.compression = compression
+        # Frames of older peers are limited by the same constant. The frame
+        # flags take a byte.
+        max_length = framing.get('max_length')
+        if max_length is not None and max_length > 1:
+            self.peerMaxLength = max_length
+
+    def _decodeFrame(self, string):
+        """Returns the message ending in the frame, or None if it's
+        continued in the next one."""
+        if not string:
+            raise ProtocolError("received an empty frame")
+        flags = six.indexbytes(string, 0)
+        self._chunksLength += len(string) - 1
+        if self._chunksLength > self.MAX_MESSAGE_LENGTH:
+            raise ProtocolError("received a message which is too long")
+        self._chunks.append(string[1:])
+        if flags & FRAME_MORE:
+            return None
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._chunksLength = 0
+        if flags & FRAME_COMPRESSED:
+            if self.compression is None:
+                raise ProtocolError("received a compressed frame")
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data, self.MAX_MESSAGE_LENGTH)
+            if decompressor.unconsumed_tail:
+                raise ProtocolError("received a message which is too long")
+        return ENCODINGS[self.encoding][1](data)
+
     def stringReceived(self, string):
+        self._lastReceived = self.clock.seconds()
+        self._unansweredPings = 0
         try:
-            try:
-                msg = json.loads(string.decode())
-            except ValueError:
-                log.failure("Received message with invalid JSON. Terminating.")
-                raise
+            if self.encoding is not None:
+                msg = self._decodeFrame(string)
+                if msg is None:
+                    return
+            else:
+                try:
+                    msg = json.loads(string.decode())
+                except ValueError:
+                    log.failure("Received message with invalid JSON. Terminating.")
+                    raise
             self._processMessage(msg)
         except ProtocolError:
             log.failure("Fatal protocol error. Terminating.")
@@ -168,17 +407,36 @@ class WorkerRPC(NetstringReceiver):
     def _timeout(self, rid):
         d = self.pendingCalls[rid][0]
         del self.pendingCalls[rid]
+        self.timedOutCalls.add(rid)
         d.errback(TimeoutError())
 
+    def _sendMessage(self, msg):
+        if self.encoding is None:
+            self.sendString(_json_dumps(msg))
+            return
+        data = ENCODINGS[self.encoding][0](msg)
+        flags = 0
+        if self.compression is not None and len(data) > self.COMPRESSION_THRESHOLD:
+            data = zlib.compress(data, 1)
+            flags |= FRAME_COMPRESSED
+        chunk_size = self.peerMaxLength - 1
+        for start in range(0, max(len(data), 1), chunk_size):
+            more = FRAME_MORE if start + chunk_size < len(data) else 0
+            self.sendString(
+                six.int2byte(flags | more) + data[start : start + chunk_size]
+            )
+
     def sendMsg(self, msg_type, **kwargs):
         kwargs['type'] = msg_type
-        self.sendString(json_dumps(kwargs).encode('utf-8'))
+        self._sendMessage(kwargs)
 
     def call(self, cmd, *args, **kwargs):
         """Call a remote function. Raises RemoteError if something goes wrong
         on the remote end and TimeoutError on timeout.
-        Warning: remote tasks can *not* be cancelled and will keep executing
-        even if connection is dropped. You should handle this manually.
+        Warning: remote tasks are *not* cancelled on timeout and will keep
+        executing even if connection is dropped. You should handle this
+        manually, e.g. with another call. A reply which comes after the
+        timeout is dropped.
         """
         if 'timeout' in kwargs:
             timeout = kwargs['timeout']
@@ -191,10 +449,9 @@ class WorkerRPC(NetstringReceiver):
 
         def cb(ignore):
             self.pendingCalls[current_id] = (d, timer)
-            s = json_dumps(
+            self._sendMessage(
                 {'type': 'call', 'id': current_id, 'method': cmd, 'args': args}
             )
-            self.sendString(s.encode('utf-8'))
 
         if self.state != State.established:
             # wait for connection
@@ -1,11 +1,16 @@
 from __future__ import absolute_import
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import protocol, reactor
+from twisted.internet import defer, protocol, reactor, task
 import json
+import os
+import zlib
 
-from sio.protocol import rpc
-from sio.workers.util import json_dumps
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+
+from sio.protocol import rpc, worker
+from sio.workers.util import CancellableJob, JobCancelled, json_dumps
 
 
 class TestClient(rpc.WorkerRPC):
@@ -27,6 +32,9 @@ class TestServer(rpc.WorkerRPC):
     def cmd_mul3(self, x):
         return x * 3
 
+    def cmd_echo(self, x):
+        return x
+
 
 class TestServerFactory(protocol.Factory):
     protocol = TestServer
@@ -46,6 +54,12 @@ def decode(x):
 
 hello_msg = {'type': 'hello', 'data': {}}
 
+framing_offer = {
+    'encodings': list(rpc.WorkerRPC.FRAMING_ENCODINGS),
+    'compression': list(rpc.WorkerRPC.FRAMING_COMPRESSIONS),
+    'max_length': rpc.WorkerRPC.MAX_LENGTH,
+}
+
 hello_ack_msg = {'type': 'hello_ack'}
 
 
@@ -73,6 +87,46 @@ class ServerTestCase(unittest.TestCase):
         ret = decode(self.tr.value())
         self.assertEqual(ret['result'], 15)
 
+    def test_server_negotiates_framing(self):
+        offer = {'encodings': ['cbor', 'json'], 'compression': ['zlib']}
+        self.proto.dataReceived(encode(dict(hello_msg, framing=offer)))
+        framing = {
+            'encoding': 'json',
+            'compression': 'zlib',
+            'max_length': rpc.WorkerRPC.MAX_LENGTH,
+        }
+        self.assertEqual(
+            decode(self.tr.value()), {'type': 'hello_ack', 'framing': framing}
+        )
+        self.tr.clear()
+        call = {'type': 'call', 'method': 'mul3', 'args': ['ab' * 4096], 'id': 0}
+        frame = b'\x00' + json_dumps(call).encode('utf-8')
+        self.proto.dataReceived(b'%d:%s,' % (len(frame), frame))
+        data = self.tr.value().partition(b':')[2][:-1]
+        self.assertEqual(data[:1], b'\x01')
+        ret = json.loads(zlib.decompress(data[1:]).decode('utf-8'))
+        self.assertEqual(ret['result'], 'ab' * 3 * 4096)
+
+    def test_server_negotiates_msgpack(self):
+        if rpc.msgpack is None:
+            raise unittest.SkipTest('msgpack is not installed')
+        offer = {'encodings': ['msgpack', 'json'], 'compression': []}
+        self.proto.dataReceived(encode(dict(hello_msg, framing=offer)))
+        self.assertEqual(decode(self.tr.value())['framing']['encoding'], 'msgpack')
+        self.tr.clear()
+        call = {'type': 'call', 'method': 'mul3', 'args': [5], 'id': 0}
+        frame = b'\x00' + rpc.msgpack.packb(call)
+        self.proto.dataReceived(b'%d:%s,' % (len(frame), frame))
+        data = self.tr.value().partition(b':')[2][:-1]
+        self.assertEqual(data[:1], b'\x00')
+        self.assertEqual(rpc.msgpack.unpackb(data[1:])['result'], 15)
+
+    def test_server_falls_back_to_json(self):
+        self.proto.FRAMING_ENCODINGS = ('json',)
+        offer = {'encodings': ['msgpack', 'json'], 'compression': ['zlib']}
+        self.proto.dataReceived(encode(dict(hello_msg, framing=offer)))
+        self.assertEqual(decode(self.tr.value())['framing']['encoding'], 'json')
+
 
 class ClientTestCase(unittest.TestCase):
     def setUp(self):
@@ -82,7 +136,10 @@ class ClientTestCase(unittest.TestCase):
         self.proto.makeConnection(self.tr)
 
     def _hello(self):
-        self.assertEqual(decode(self.tr.value()), hello_msg)
+        self.assertEqual(
+            decode(self.tr.value()),
+            dict(hello_msg, framing=framing_offer, heartbeats=True),
+        )
         self.assertEqual(self.proto.state, rpc.State.sent_hello)
         self.proto.dataReceived(encode(hello_ack_msg))
         self.assertEqual(self.proto.state, rpc.State.established)
@@ -109,6 +166,51 @@ class ClientTestCase(unittest.TestCase):
         return d
 
 
+class HeartbeatTestCase(unittest.TestCase):
+    def setUp(self):
+        self.proto = TestServer()
+        self.proto.heartbeatInterval = 1
+        self.proto.clock = self.clock = task.Clock()
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def test_pings_measure_rtt_and_drop_silent_peers(self):
+        self.proto.dataReceived(encode(dict(hello_msg, heartbeats=True)))
+        self.assertEqual(decode(self.tr.value()), dict(hello_ack_msg, heartbeats=True))
+        self.tr.clear()
+        self.clock.advance(1)
+        self.assertEqual(decode(self.tr.value()), {'type': 'ping', 'time': 1})
+        self.clock.advance(0.5)
+        self.proto.dataReceived(encode({'type': 'pong', 'time': 1}))
+        self.assertEqual(self.proto.rtt, 0.5)
+
+        # Pings at 2, 3 and 4 are not answered.
+        for _ in range(3):
+            self.clock.advance(1)
+        self.assertFalse(self.tr.disconnecting)
+        self.clock.advance(1)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_peers_are_not_dropped_when_the_reactor_stalls(self):
+        self.proto.dataReceived(encode(dict(hello_msg, heartbeats=True)))
+        self.tr.clear()
+        # The reactor is blocked for a long time, and the heartbeat runs
+        # before the data sent meanwhile is read.
+        self.clock.advance(10)
+        self.assertEqual(decode(self.tr.value()), {'type': 'ping', 'time': 10})
+        self.assertFalse(self.tr.disconnecting)
+        self.proto.dataReceived(encode({'type': 'pong', 'time': 10}))
+        self.clock.advance(10)
+        self.assertFalse(self.tr.disconnecting)
+
+    def test_old_peers_are_not_pinged(self):
+        self.proto.dataReceived(encode(hello_msg))
+        self.tr.clear()
+        self.clock.advance(10)
+        self.assertEqual(self.tr.value(), b'')
+        self.assertFalse(self.tr.disconnecting)
+
+
 class IntegrationTestCase(unittest.TestCase):
     def setUp(self):
         factory = TestServerFactory()
@@ -126,6 +228,58 @@ class IntegrationTestCase(unittest.TestCase):
 
         return creator.connectTCP('127.0.0.1', self.port.getHost().port).addCallback(cb)
 
+    def _call_with_framing(self, client_class, arg):
+        creator = protocol.ClientCreator(reactor, client_class)
+
+        def cb(client):
+            self.addCleanup(client.transport.loseConnection)
+            d = client.call('mul3', arg)
+            d.addCallback(self.assertEqual, arg * 3)
+            d.addCallback(lambda _: client)
+            return d
+
+        return creator.connectTCP('127.0.0.1', self.port.getHost().port).addCallback(cb)
+
+    def test_long_messages_are_split(self):
+        class Client(TestClient):
+            FRAMING_COMPRESSIONS = ()
+            MAX_LENGTH = 2 ** 12
+
+        # Both sides split their messages to fit the client's limit.
+        d = self._call_with_framing(Client, 'x' * 2 ** 19)
+        d.addCallback(lambda client: self.assertIsNone(client.compression))
+        return d
+
+    def test_long_messages_are_compressed(self):
+        d = self._call_with_framing(TestClient, 'ab' * 2 ** 20)
+        d.addCallback(lambda client: self.assertEqual(client.compression, 'zlib'))
+        return d
+
+    @defer.inlineCallbacks
+    def test_encodings_decode_messages_alike(self):
+        arg = {1: b'bytes', 'list': (1, 2.5, None, True), 'dict': {None: 'x'}}
+        results = []
+        for encoding in rpc.ENCODINGS:
+
+            class Client(TestClient):
+                FRAMING_ENCODINGS = (encoding,)
+
+            creator = protocol.ClientCreator(reactor, Client)
+            client = yield creator.connectTCP('127.0.0.1', self.port.getHost().port)
+            self.addCleanup(client.transport.loseConnection)
+            results.append((yield client.call('echo', arg)))
+            self.assertEqual(client.encoding, encoding)
+        expected = {'1': 'bytes', 'list': [1, 2.5, None, True], 'dict': {'null': 'x'}}
+        self.assertEqual(results, [expected] * len(rpc.ENCODINGS))
+
+    def test_json_only_peers(self):
+        class Client(TestClient):
+            FRAMING_ENCODINGS = ()
+
+        d = self._call_with_framing(Client, 'x')
+        d.addCallback(lambda client: self.assertIsNone(client.encoding))
+        return d
+
     def test_nomethod(self):
         creator = protocol.ClientCreator(reactor, TestClient)
 
@@ -135,3 +289,142 @@ class IntegrationTestCase(unittest.TestCase):
             return self.assertFailure(d, rpc.RemoteError)
 
         return creator.connectTCP('127.0.0.1', self.port.getHost().port).addCallback(cb)
+
+
+class CacheSummaryTestCase(unittest.TestCase):
+    def test_recently_used_files_are_kept(self):
+        self.patch(worker, 'CACHE_SUMMARY_SIZE', 3)
+        factory = worker.WorkerFactory(name='w')
+        factory.addCachedFiles(['/a', '/b'])
+        factory.addCachedFiles(['/c', '/a'])
+        version = factory.cacheSummaryVersion
+        self.assertEqual(factory.getCacheSummary(), ['/b', '/c', '/a'])
+
+        factory.addCachedFiles(['/c'])
+        self.assertEqual(factory.cacheSummaryVersion, version)
+        factory.addCachedFiles(['/d'])
+        self.assertEqual(factory.getCacheSummary(), ['/a', '/c', '/d'])
+        self.assertNotEqual(factory.cacheSummaryVersion, version)
+
+        proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.assertEqual(proto.getHelloData()['cached_files'], ['/a', '/c', '/d'])
+
+
+class ReattachTestCase(unittest.TestCase):
+    def test_tasks_outlive_connections(self):
+        factory = worker.WorkerFactory(name='w')
+        proto = factory.buildProtocol(('127.0.0.1', 0))
+        for task_id in ('a', 'b', 'c', 'd'):
+            factory.running[task_id] = {'task_id': task_id}
+            factory.jobs[task_id] = CancellableJob()
+            proto._waitForResult(task_id)
+        proto.connectionLost(Failure(ConnectionDone()))
+        factory.taskDone({'task_id': 'a'}, 'a')
+        factory.taskDone({'task_id': 'b'}, 'b')
+        self.assertEqual(sorted(factory.results), ['a', 'b'])
+
+        proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.assertTrue(proto.getHelloData()['reattach'])
+        d = proto.cmd_reattach(['a', 'c', 'x'])
+        # The task which isn't reattached is cancelled.
+        self.assertTrue(factory.jobs['d'].cancelled)
+        self.assertNoResult(d)
+        factory.taskDone(Failure(JobCancelled()), 'd')
+        self.assertEqual(sorted(self.successResultOf(d)), ['a', 'c'])
+        self.assertEqual(list(factory.results), ['a'])
+
+        self.assertEqual(proto.cmd_get_result('a'), {'task_id': 'a'})
+        d = proto.cmd_get_result('c')
+        factory.taskDone({'task_id': 'c'}, 'c')
+        self.assertEqual(self.successResultOf(d), {'task_id': 'c'})
+        self.assertEqual(factory.results, {})
+        self.assertEqual(factory.running, {})
+        self.assertRaises(RuntimeError, proto.cmd_get_result, 'b')
+
+    def test_results_expire(self):
+        factory = worker.WorkerFactory(name='w')
+        factory.clock = clock = task.Clock()
+        for task_id in ('a', 'b'):
+            factory.running[task_id] = {'task_id': task_id}
+            factory.jobs[task_id] = CancellableJob()
+        factory.taskDone({'task_id': 'a'}, 'a')
+        clock.advance(worker.RESULT_KEEP_TIME / 2)
+        factory.taskDone({'task_id': 'b'}, 'b')
+        clock.advance(worker.RESULT_KEEP_TIME / 2)
+        self.assertEqual(list(factory.results), ['b'])
+
+        proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.assertEqual(self.successResultOf(proto.cmd_reattach(['a', 'b'])), ['b'])
+        self.assertEqual(proto.cmd_get_result('b'), {'task_id': 'b'})
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+class QueueTestCase(unittest.TestCase):
+    def test_tasks_wait_for_free_slots(self):
+        started = []
+
+        def deferToThread(f, env, *args):
+            started.append((f, env['task_id']))
+            return defer.Deferred()
+
+        self.patch(worker.threads, 'deferToThread', deferToThread)
+        self.patch(
+            worker.threads,
+            'deferToThreadPool',
+            lambda reactor, pool, f, env: deferToThread(f, env),
+        )
+        factory = worker.WorkerFactory(name='w', concurrency=1)
+        proto = factory.buildProtocol(('127.0.0.1', 0))
+        results = {
+            task_id: proto.cmd_run({'task_id': task_id, 'job_type': 'vcpu-exec'})
+            for task_id in ('a', 'b', 'c')
+        }
+        # The files of the queued tasks are downloaded meanwhile.
+        self.assertEqual(
+            started,
+            [
+                (worker._runner_wrap, 'a'),
+                (worker._prefetch_wrap, 'b'),
+                (worker._prefetch_wrap, 'c'),
+            ],
+        )
+        self.assertEqual(sorted(proto.cmd_get_running()), ['a', 'b', 'c'])
+
+        # A queued task is dropped right away when cancelled.
+        self.assertTrue(self.successResultOf(proto.cmd_cancel('c')))
+        self.failureResultOf(results['c'], JobCancelled)
+        self.assertEqual(list(factory.queued), ['b'])
+        factory.taskDone({'task_id': 'a'}, 'a')
+        self.assertEqual(started[-1], (worker._runner_wrap, 'b'))
+        self.assertEqual(self.successResultOf(results['a']), {'task_id': 'a'})
+        self.assertEqual(list(factory.queued), [])
+
+
+class CpusTestCase(unittest.TestCase):
+    def test_factories_have_cpus_of_their_own(self):
+        cpus = os.cpu_count()
+        first = worker.WorkerFactory(name='a', concurrency=cpus)
+        second = worker.WorkerFactory(name='b', concurrency=cpus)
+        for factory in (first, second):
+            self.assertEqual(
+                sorted(factory.cpus.get_nowait() for _ in range(cpus)),
+                list(range(cpus)),
+            )
+        self.assertRaises(
+            ValueError, worker.WorkerFactory, name='c', concurrency=cpus + 1
+        )
+
+
+class PartitionCpusTestCase(unittest.TestCase):
+    def test_dedicated_cores_have_no_siblings_in_use(self):
+        # Four cores with two threads each: CPUs i and i + 4 are siblings.
+        def get_siblings(cpu):
+            return frozenset([cpu % 4, cpu % 4 + 4])
+
+        self.assertEqual(
+            worker.partition_cpus(range(8), 0, get_siblings), ([], list(range(8)))
+        )
+        self.assertEqual(
+            worker.partition_cpus(range(8), 2, get_siblings), ([2, 3], [0, 1, 4, 5])
+        )
+        self.assertRaises(ValueError, worker.partition_cpus, range(8), 4, get_siblings)
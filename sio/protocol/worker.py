@@ -1,8 +1,18 @@
 from __future__ import absolute_import
 from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.internet import threads
-from sio.workers import runner
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from sio.workers import ft, runner
 from sio.protocol import rpc
+from sio.workers.util import (
+    CancellableJob,
+    JobCancelled,
+    RunningJob,
+    get_cached_files,
+)
+from collections import OrderedDict
 import os
 import platform
 from queue import SimpleQueue
@@ -12,66 +22,227 @@ import six
 
 log = Logger()
 
-# This is supposedly thread-safe...
-queue = SimpleQueue()
+# Number of most recently used files reported to sioworkersd as
+# the summary of the filetracker cache.
+CACHE_SUMMARY_SIZE = 1024
+# How often (in seconds) the summary is sent, if it has changed.
+CACHE_SUMMARY_INTERVAL = 10
+# Threads downloading the files of queued tasks. They have a pool of their
+# own, so that the jobs don't wait for free threads behind the downloads.
+PREFETCH_THREADS = 2
+# How long (in seconds) the results of tasks which ended while disconnected
+# are kept. sioworkersd stops waiting for the tasks of a lost worker sooner
+# (see sio.sioworkersd.workermanager.REATTACH_TIMEOUT), or doesn't reattach
+# them at all, and then they would be kept forever.
+RESULT_KEEP_TIME = 600
+
 
 # ingen replaces the environment, so merge it
-def _runner_wrap(env):
+def _runner_wrap(env, cpus, job=None):
     # If the queue is somehow empty, then we want to find via an error.
-    cpu = queue.get_nowait()
-    os.sched_setaffinity(0, [cpu])
-    renv = runner.run(env)
-    env.update(renv)
-    queue.put(cpu)
+    cpu = cpus.get_nowait()
+    try:
+        os.sched_setaffinity(0, [cpu])
+        with RunningJob(job):
+            renv = runner.run(env)
+        env.update(renv)
+    finally:
+        cpus.put(cpu)
     return env
 
 
+def _prefetch_wrap(env):
+    if env.get('filetracker_url'):
+        ft.init_instance(env['filetracker_url'])
+    ft.fetch_to_cache(env, get_cached_files(env))
+
+
+def _read_thread_siblings(cpu):
+    """Returns the set of CPUs sharing a physical core with ``cpu``
+    (including itself), or just ``cpu`` if the topology is unknown."""
+    path = '/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list' % cpu
+    try:
+        with open(path) as f:
+            siblings_list = f.read().strip()
+    except (IOError, OSError):
+        return frozenset([cpu])
+    siblings = set()
+    for part in siblings_list.split(','):
+        first, _, last = part.partition('-')
+        siblings.update(range(int(first), int(last or first) + 1))
+    return frozenset(siblings)
+
+
+def partition_cpus(cpus, cpu_exec_slots, get_siblings=_read_thread_siblings):
+    """Splits ``cpus`` into the ones running cpu-exec jobs and the ones
+    running other jobs, returned as a pair of lists.
+
+    Each of the ``cpu_exec_slots`` cpu-exec jobs gets a whole physical core
+    (the last ones, as the first CPU is usually the busiest with system
+    tasks). The job is pinned to one CPU of the core and its SMT siblings
+    are left idle, so that other jobs don't disturb the time measurements.
+    """
+    cpus = set(cpus)
+    cores = sorted(set(get_siblings(cpu) & cpus for cpu in cpus), key=min)
+    if cpu_exec_slots >= len(cores):
+        raise ValueError(
+            "Can't dedicate %d cores to cpu-exec jobs, the worker has only %d"
+            % (cpu_exec_slots, len(cores))
+        )
+    dedicated = cores[len(cores) - cpu_exec_slots :]
+    shared = cores[: len(cores) - cpu_exec_slots]
+    return (
+        [min(core) for core in dedicated],
+        sorted(cpu for core in shared for cpu in core),
+    )
+
+
 class WorkerProtocol(rpc.WorkerRPC):
     def __init__(self):
         rpc.WorkerRPC.__init__(self, server=False)
-        self.running = {}
+        self._cacheSummaryCall = LoopingCall(self._sendCacheSummary)
+        self._sentCacheSummaryVersion = None
+        self.ready.addCallback(self._startSendingCacheSummary)
 
     def getHelloData(self):
+        self._sentCacheSummaryVersion = self.factory.cacheSummaryVersion
         return {
             'name': self.factory.name,
             'concurrency': self.factory.concurrency,
             'available_ram_mb': self.factory.available_ram_mb,
             'can_run_cpu_exec': self.factory.can_run_cpu_exec,
+            'cpu_exec_slots': self.factory.cpu_exec_slots,
+            'cpu_shares': self.factory.cpu_shares,
+            'scratch_disk_mb': self.factory.scratch_disk_mb,
+            'cached_files': self.factory.getCacheSummary(),
+            'reattach': True,
+            'queue': True,
         }
 
+    def connectionLost(self, reason):
+        rpc.WorkerRPC.connectionLost(self, reason)
+        if self._cacheSummaryCall.running:
+            self._cacheSummaryCall.stop()
+        # Results of the tasks are kept until sioworkersd reconnects.
+        waiters = self.factory.resultWaiters
+        for task_id, (proto, _) in list(waiters.items()):
+            if proto is self:
+                del waiters[task_id]
+
+    def _startSendingCacheSummary(self, ignore=None):
+        if self.connected:
+            self._cacheSummaryCall.start(CACHE_SUMMARY_INTERVAL, now=False)
+
+    def _sendCacheSummary(self):
+        version = self.factory.cacheSummaryVersion
+        if version == self._sentCacheSummaryVersion:
+            return
+        self._sentCacheSummaryVersion = version
+        d = self.call('update_cache_summary', self.factory.getCacheSummary())
+
+        def _error(failure):
+            if failure.check(rpc.NoSuchMethodError):
+                # sioworkersd is too old to use the summary.
+                if self._cacheSummaryCall.running:
+                    self._cacheSummaryCall.stop()
+            else:
+                log.failure('Failed to send cache summary:', failure, LogLevel.warn)
+
+        d.addErrback(_error)
+
+    def _countRunningCpuExec(self):
+        return sum(
+            1
+            for task in six.itervalues(self.factory.running)
+            if task['job_type'] == 'cpu-exec'
+        )
+
+    def _waitForResult(self, task_id):
+        d = defer.Deferred()
+        self.factory.resultWaiters[task_id] = (self, d)
+        return d
+
     def cmd_run(self, env):
         job_type = env['job_type']
+        # With dedicated cores, cpu-exec jobs run alongside other jobs.
+        dedicated = self.factory.cpu_exec_slots > 0
         if job_type == 'cpu-exec':
-            if self.running:
+            if dedicated:
+                if self._countRunningCpuExec() >= self.factory.cpu_exec_slots:
+                    raise RuntimeError('Send cpu-exec job to worker with no free cores')
+            elif self.factory.running:
                 raise RuntimeError('Send cpu-exec job to busy worker')
             if not self.factory.can_run_cpu_exec:
                 raise RuntimeError('Send cpu-exec job to worker which can\'t run it')
-        if any(
-            [(task['job_type'] == 'cpu-exec') for task in six.itervalues(self.running)]
-        ):
+        if not dedicated and self._countRunningCpuExec():
             raise RuntimeError('Send job to worker already running cpu-exec job')
-        task_id = env['task_id']
-        log.info('running {job_type} {tid}', job_type=job_type, tid=task_id)
-        self.running[task_id] = env
-        d = threads.deferToThread(_runner_wrap, env)
+        self.factory.runTask(env)
+        return self._waitForResult(env['task_id'])
 
-        # Log errors, but pass them to sioworkersd anyway
-        def _error(x):
-            log.failure('Error during task execution:', x, LogLevel.warn)
-            return x
+    def cmd_cancel(self, task_id):
+        """Kills the processes of a running task, leaving the other tasks
+        alone, or drops a queued one. The task ends with ``JobCancelled``.
 
-        def _done(x):
-            del self.running[task_id]
-            log.info('{tid} done.', tid=task_id)
-            return x
+        Returns True when the task has ended, or False if it isn't running.
+        """
+        job = self.factory.jobs.get(task_id)
+        if job is None:
+            return False
+        log.info('cancelling {tid}', tid=task_id)
+        job.cancel()
+        d = defer.Deferred()
+        self.factory.cancelWaiters.setdefault(task_id, []).append(d)
+        if task_id in self.factory.queued:
+            # It hasn't started, so nothing has to be killed.
+            self.factory.taskDone(Failure(JobCancelled()), task_id)
+        return d
 
-        d.addBoth(_done)
-        d.addErrback(_error)
+    def cmd_reattach(self, task_ids):
+        """Binds tasks started over the previous connections to this one.
+        The other tasks are cancelled, and the results of the other tasks
+        which ended while disconnected are dropped.
+
+        Returns the ids of the given tasks which are running or have ended
+        (their results are delivered by ``get_result``), when the cancelled
+        tasks have ended.
+        """
+        factory = self.factory
+        task_ids = set(task_ids)
+        attached = [
+            task_id
+            for task_id in task_ids
+            if task_id in factory.running or task_id in factory.results
+        ]
+        cancelled = [
+            self.cmd_cancel(task_id)
+            for task_id in list(factory.running)
+            if task_id not in task_ids
+        ]
+
+        def _dropResults(_):
+            # Including the ones of the cancelled tasks.
+            for task_id in list(factory.results):
+                if task_id not in task_ids:
+                    log.info('dropping result of {tid}', tid=task_id)
+                    factory.popResult(task_id)
+            return attached
+
+        d = defer.gatherResults(cancelled)
+        d.addCallback(_dropResults)
         return d
 
+    def cmd_get_result(self, task_id):
+        """Returns the result of a task reattached to this connection
+        (see ``reattach``), when it ends."""
+        if task_id in self.factory.results:
+            return self.factory.popResult(task_id)
+        if task_id not in self.factory.running:
+            raise RuntimeError('Task %s is not running' % task_id)
+        return self._waitForResult(task_id)
+
     def cmd_get_running(self):
         # sets are not json-serializable
-        return list(self.running.keys())
+        return list(self.factory.running.keys())
 
 
 class WorkerFactory(ReconnectingClientFactory):
@@ -79,16 +250,193 @@ class WorkerFactory(ReconnectingClientFactory):
     protocol = WorkerProtocol
 
     def __init__(
-        self, concurrency=1, available_ram_mb=1024, can_run_cpu_exec=False, name=None
+        self,
+        concurrency=1,
+        available_ram_mb=1024,
+        can_run_cpu_exec=False,
+        name=None,
+        cpu_exec_slots=0,
+        cpu_shares=None,
+        scratch_disk_mb=None,
+        heartbeat_interval=rpc.DEFAULT_HEARTBEAT_INTERVAL,
     ):
+        """``cpu_exec_slots`` is the number of physical cores dedicated to
+        cpu-exec jobs, which then don't make the whole worker exclusive.
+        ``concurrency`` doesn't include them.
+
+        ``cpu_shares`` and ``scratch_disk_mb``, if given, are the resources
+        which sioworkersd divides between jobs according to their types
+        (see sio.sioworkersd.utils.DEFAULT_CPU_SHARES), in addition to
+        RAM. ``concurrency`` still limits the number of jobs.
+
+        Tasks sent when all the slots are taken (sioworkersd does it when
+        prefetching, see sio.sioworkersd.workermanager.WorkerManager) wait
+        in a queue, and their files are downloaded to the filetracker
+        cache meanwhile. Each of them starts when a running job ends.
+
+        ``heartbeat_interval`` is how often (in seconds) sioworkersd is
+        pinged, so that the connection is dropped and made again when it
+        hangs, or None to only notice broken connections.
+        """
         self.concurrency = concurrency
         self.available_ram_mb = available_ram_mb
-        self.can_run_cpu_exec = can_run_cpu_exec
+        self.can_run_cpu_exec = can_run_cpu_exec or cpu_exec_slots > 0
+        self.cpu_exec_slots = cpu_exec_slots
+        self.cpu_shares = cpu_shares
+        self.scratch_disk_mb = scratch_disk_mb
+        self.heartbeatInterval = heartbeat_interval
         if name is None:
             self.name = platform.node()
         else:
             self.name = name
-        cpus = list(range(0, os.cpu_count()))
+        # Filetracker paths of recently used files, least recent first.
+        # Kept here, because the cache outlives connections.
+        self.cachedFiles = OrderedDict()
+        self.cacheSummaryVersion = 0
+        # Tasks outlive connections as well, so that sioworkersd may
+        # reattach them when the worker reconnects.
+        self.running = {}
+        self.jobs = {}  # Map: task_id -> CancellableJob
+        # Tasks waiting for a slot, in the order of arrival.
+        self.queued = OrderedDict()  # Map: task_id -> env
+        self._prefetchPool = None  # Started when a task is queued
+        # Map: task_id -> list of Deferreds fired when the task ends
+        self.cancelWaiters = {}
+        # Map: task_id -> (protocol, Deferred) waiting for the task's result
+        self.resultWaiters = {}
+        # Results of tasks which ended while disconnected, kept until
+        # they are delivered or for RESULT_KEEP_TIME.
+        self.results = {}  # Map: task_id -> result env or Failure
+        self._resultExpiries = {}  # Map: task_id -> DelayedCall
+        # The results expire by the clock, which tests may replace.
+        self.clock = reactor
+        cpu_exec_cpus, cpus = partition_cpus(range(os.cpu_count()), cpu_exec_slots)
+        if concurrency > len(cpus):
+            raise ValueError(
+                "Can't run %d jobs at once, the worker has only %d CPUs for them"
+                % (concurrency, len(cpus))
+            )
         shuffle(cpus)
+        # Free CPUs for running jobs. This is supposedly thread-safe...
+        self.cpus = SimpleQueue()
         for cpu in cpus:
-            queue.put(cpu)
+            self.cpus.put(cpu)
+        # Free CPUs of the cores dedicated to cpu-exec jobs, see partition_cpus.
+        self.cpuExecCpus = SimpleQueue()
+        for cpu in cpu_exec_cpus:
+            self.cpuExecCpus.put(cpu)
+
+    def buildProtocol(self, addr):
+        proto = ReconnectingClientFactory.buildProtocol(self, addr)
+        proto.heartbeatInterval = self.heartbeatInterval
+        return proto
+
+    def _takesSlot(self, env):
+        # With dedicated cores, cpu-exec jobs run alongside other jobs.
+        return not (env['job_type'] == 'cpu-exec' and self.cpu_exec_slots > 0)
+
+    def _countTakenSlots(self):
+        return sum(
+            1
+            for task_id, env in six.iteritems(self.running)
+            if task_id not in self.queued and self._takesSlot(env)
+        )
+
+    def runTask(self, env):
+        """Starts a task, or queues it if all the slots are taken."""
+        task_id = env['task_id']
+        wait = self._takesSlot(env) and self._countTakenSlots() >= self.concurrency
+        self.running[task_id] = env
+        self.jobs[task_id] = CancellableJob()
+        # The files are downloaded to the cache at the beginning of the task,
+        # or while it's queued.
+        self.addCachedFiles(get_cached_files(env))
+        if wait:
+            log.info('queueing {job_type} {tid}', job_type=env['job_type'], tid=task_id)
+            self.queued[task_id] = env
+            d = threads.deferToThreadPool(
+                reactor, self._getPrefetchPool(), _prefetch_wrap, env
+            )
+            # The job downloads the files anyway.
+            d.addErrback(
+                lambda x: log.failure(
+                    'Failed to prefetch files of {tid}:', x, LogLevel.warn, tid=task_id
+                )
+            )
+        else:
+            self._startTask(env)
+
+    def _getPrefetchPool(self):
+        if self._prefetchPool is None:
+            pool = self._prefetchPool = ThreadPool(0, PREFETCH_THREADS, 'prefetch')
+            pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+        return self._prefetchPool
+
+    def _startTask(self, env):
+        task_id = env['task_id']
+        job = self.jobs[task_id]
+        log.info('running {job_type} {tid}', job_type=env['job_type'], tid=task_id)
+        if self._takesSlot(env):
+            d = threads.deferToThread(_runner_wrap, env, self.cpus, job)
+        else:
+            d = threads.deferToThread(_runner_wrap, env, self.cpuExecCpus, job)
+
+        # Log errors, but pass them to sioworkersd anyway
+        def _error(x):
+            log.failure('Error during task execution:', x, LogLevel.warn)
+            return x
+
+        d.addErrback(_error)
+        d.addBoth(self.taskDone, task_id)
+
+    def taskDone(self, result, task_id):
+        """Delivers the result of a task over the connection which waits for
+        it, or keeps it until sioworkersd reconnects. The slot of the task
+        goes to the first queued one."""
+        env = self.running.pop(task_id)
+        del self.jobs[task_id]
+        started = self.queued.pop(task_id, None) is None
+        log.info('{tid} done.', tid=task_id)
+        if task_id not in self.resultWaiters:
+            log.info('keeping result of {tid} until reconnected', tid=task_id)
+            self.results[task_id] = result
+            self._resultExpiries[task_id] = self.clock.callLater(
+                RESULT_KEEP_TIME, self._expireResult, task_id
+            )
+        else:
+            _, d = self.resultWaiters.pop(task_id)
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        for waiter in self.cancelWaiters.pop(task_id, ()):
+            waiter.callback(True)
+        if started and self.queued and self._takesSlot(env):
+            self._startTask(self.queued.popitem(last=False)[1])
+
+    def _expireResult(self, task_id):
+        log.info('dropping result of {tid}, it was not reattached', tid=task_id)
+        del self._resultExpiries[task_id]
+        del self.results[task_id]
+
+    def popResult(self, task_id):
+        """Removes and returns the kept result of a task."""
+        self._resultExpiries.pop(task_id).cancel()
+        return self.results.pop(task_id)
+
+    def addCachedFiles(self, files):
+        """Records that ``files`` were used, and so are in the cache."""
+        for path in files:
+            if path in self.cachedFiles:
+                self.cachedFiles.move_to_end(path)
+            else:
+                self.cachedFiles[path] = None
+                self.cacheSummaryVersion += 1
+                if len(self.cachedFiles) > CACHE_SUMMARY_SIZE:
+                    self.cachedFiles.popitem(last=False)
+
+    def getCacheSummary(self):
+        """Returns the summary of the filetracker cache sent to sioworkersd:
+        a list of recently used files."""
+        return list(self.cachedFiles)
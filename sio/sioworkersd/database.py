@@ -0,0 +1,519 @@
+"""Persistent storage of task groups for :mod:`sio.sioworkersd.taskmanager`.
+
+Every group which has to be returned asynchronously (i.e. has a
+``return_url``) is stored in a database, so that it can be resumed after
+a server failure.
+
+Writes are group-committed: instead of syncing the database after each
+change, changes made during one reactor iteration are committed together
+with a single sync at the beginning of the next one. Changes which are
+not critical (``sync=False``) are committed lazily, either with the next
+group commit or by the periodic compaction.
+
+Each group is stored as a record of separate fields (see ``FIELDS``),
+which are written independently. Bumping the retry counter doesn't
+rewrite the whole group environment. Results of single tasks of a group
+which is still being judged are stored separately as well (see
+``add_task_result``), so that only the unfinished tasks are run again
+after a restart.
+
+Backends are pluggable, see :func:`getDefaultDatabaseClassName` and the
+``--database-backend`` option of ``sioworkersd``.
+"""
+
+from __future__ import absolute_import
+import json
+import os
+import sqlite3
+
+import six
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater, LoopingCall
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+
+from sio.workers.util import json_dumps
+
+log = Logger()
+
+DB_COMPACTION_INTERVAL_IN_SEC = 10
+# Should not be too small. We want to avoid lots of errors in case of server
+# failure.
+DB_COMPACTION_RESTART_INTERVAL_IN_SEC = 60 * 60
+
+# Fields of a stored group:
+# ``status``: 'to_judge', 'to_return' or 'dead_letter' (returning failed
+#             too many times, see TaskManager.replayDeadLetters)
+# ``timestamp``: time when the group was added
+# ``retry_cnt``: number of failed attempts of returning the results
+# ``next_retry``: time of the next attempt of returning the results, if the
+#                 last one failed
+# ``env``: the group environment, as received from oioioi
+# ``results``: dict of keys which should be added to ``env`` when returning
+FIELDS = ('status', 'timestamp', 'retry_cnt', 'next_retry', 'env', 'results')
+# Fields which are stored JSON-encoded.
+JSON_FIELDS = ('env', 'results')
+
+
+class Database(object):
+    """Abstract database interface.
+
+    Subclasses implement the storage (``_store``, ``_storeTaskResult``,
+    ``_remove``, ``_iterate``) and the durability primitives (``_commit``,
+    ``_compact``, ``_close``). This class takes care of batching commits.
+    """
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        # Whether there are changes that are not committed yet.
+        self._dirty = False
+        # DelayedCall of the group commit scheduled for the next iteration.
+        self._pending_commit = None
+        # Deferreds waiting for the group commit.
+        self._commit_waiters = []
+        # Number of syncs requested and number of commits actually made,
+        # useful for seeing how well the requests are batched.
+        self.sync_requests = 0
+        self.commits = 0
+        self.compaction_task = LoopingCall(self.compact)
+
+    def start_periodic_compaction(self):
+        def restart_compaction_task(failure, task):
+            log.error("Failed to compact database. Error:", failure)
+            d = deferLater(
+                reactor,
+                DB_COMPACTION_RESTART_INTERVAL_IN_SEC,
+                lambda: task.start(DB_COMPACTION_INTERVAL_IN_SEC),
+            )
+            d.addErrback(restart_compaction_task, task=task)
+            return d
+
+        self.compaction_task.start(DB_COMPACTION_INTERVAL_IN_SEC).addErrback(
+            restart_compaction_task, task=self.compaction_task
+        )
+
+    def get_items(self):
+        """Returns a list of all stored records.
+
+        Each record is a dict with ``id``, the fields from ``FIELDS``
+        which were set and ``task_results``, a dict mapping names of
+        finished tasks to their results, if there are any.
+        """
+        loaded = []
+        for job_id, fields in self._iterate():
+            job = self._decode(job_id, fields)
+            if job is not None:
+                loaded.append(job)
+        return loaded
+
+    def iter_items(self, status):
+        """Yields records with the given ``status`` in timestamp order
+        (records without a timestamp first).
+
+        The records are read lazily, so it is fine to modify the database
+        between iterations. This implementation loads all the records
+        at once, backends with an index should do better.
+        """
+        jobs = [job for job in self.get_items() if job.get('status') == status]
+        jobs.sort(key=lambda job: (job.get('timestamp') or 0, job['id']))
+        return iter(jobs)
+
+    def _decode(self, job_id, fields):
+        """Turns a pair yielded by ``_iterate`` into a record.
+
+        Returns None (and removes the record) if it can't be decoded.
+        """
+        job = {'id': job_id}
+        try:
+            if fields is None:
+                raise ValueError()
+            for name, value in six.iteritems(fields):
+                if name in JSON_FIELDS and value is not None:
+                    value = json.loads(value)
+                elif name == 'task_results':
+                    value = {k: json.loads(v) for k, v in six.iteritems(value)}
+                job[name] = value
+        except ValueError:
+            log.error('Failed to load json from DB: {}'.format(fields))
+            self._remove(job_id, (fields or {}).get('task_results', ()))
+            self._dirty = True
+            return None
+        return job
+
+    def update(self, job_id, fields, sync=True):
+        """Sets the given ``fields`` of the record of ``job_id``.
+
+        Only the given fields are encoded and written, the other ones are
+        left untouched.
+
+        If ``sync`` is true, the change is committed with the next group
+        commit and the returned Deferred fires once it is durable.
+        Otherwise the change is committed lazily and the returned
+        Deferred fires immediately.
+        """
+        encoded = {}
+        for name, value in six.iteritems(fields):
+            if name not in FIELDS:
+                raise ValueError('Unknown field %s' % name)
+            if name in JSON_FIELDS:
+                value = json_dumps(value)
+            encoded[name] = value
+        self._store(six.ensure_text(job_id), encoded)
+        self._dirty = True
+        if sync:
+            return self.sync()
+        return defer.succeed(None)
+
+    def add_task_result(self, job_id, task, result, sync=False):
+        """Stores the ``result`` of a finished ``task`` of the group
+        ``job_id``.
+
+        The results are removed together with the record.
+        """
+        self._storeTaskResult(
+            six.ensure_text(job_id), six.ensure_text(task), json_dumps(result)
+        )
+        self._dirty = True
+        if sync:
+            return self.sync()
+        return defer.succeed(None)
+
+    def delete(self, job_id, sync=False):
+        # Check self.compaction_task to know why sync is False by default
+        self._remove(six.ensure_text(job_id))
+        self._dirty = True
+        if sync:
+            return self.sync()
+        return defer.succeed(None)
+
+    def sync(self):
+        """Returns a Deferred which fires when all the changes made so far
+        are durable.
+
+        All the calls made during one reactor iteration share a single
+        commit.
+        """
+        self.sync_requests += 1
+        if not self._dirty and self._pending_commit is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._commit_waiters.append(d)
+        if self._pending_commit is None:
+            self._pending_commit = reactor.callLater(0, self._groupCommit)
+        return d
+
+    def _groupCommit(self):
+        self._pending_commit = None
+        waiters, self._commit_waiters = self._commit_waiters, []
+        try:
+            self._flush()
+        except Exception:
+            f = Failure()
+            log.failure("Failed to commit changes to the database.", f)
+            for d in waiters:
+                d.errback(f)
+            return
+        for d in waiters:
+            d.callback(None)
+
+    def _flush(self):
+        if self._dirty:
+            self._commit()
+            self.commits += 1
+            self._dirty = False
+
+    def compact(self):
+        """Commits all the pending changes and compacts the storage.
+
+        This is called periodically, see ``start_periodic_compaction``.
+        """
+        self._flush()
+        self._compact()
+
+    def close(self):
+        """Commits all the pending changes and closes the database."""
+        if self.compaction_task.running:
+            self.compaction_task.stop()
+        if self._pending_commit is not None:
+            self._pending_commit.cancel()
+            self._groupCommit()
+        else:
+            self._flush()
+        self._close()
+
+    def _store(self, job_id, fields):
+        """Sets the given fields of the record, creating it if necessary.
+
+        Values of ``JSON_FIELDS`` are already encoded.
+        """
+        raise NotImplementedError()
+
+    def _storeTaskResult(self, job_id, task, result):
+        raise NotImplementedError()
+
+    def _remove(self, job_id, tasks=()):
+        """Removes the record together with its task results.
+
+        ``tasks`` are names of task results known to be stored, in case
+        the record is broken.
+        """
+        raise NotImplementedError()
+
+    def _iterate(self):
+        """Yields pairs (job_id, fields) for all stored records.
+
+        ``fields`` maps names of the set fields to their values, with
+        ``JSON_FIELDS`` still encoded, and ``task_results`` (if there are
+        any) to a dict of encoded task results. It is None if the record
+        can't be decoded, such records are removed.
+        """
+        raise NotImplementedError()
+
+    def _commit(self):
+        """Makes all changes durable."""
+        raise NotImplementedError()
+
+    def _compact(self):
+        pass
+
+    def _close(self):
+        raise NotImplementedError()
+
+
+class SQLiteDatabase(Database):
+    """SQLite database in WAL mode.
+
+    Every commit appends to the write-ahead log and syncs it once,
+    compaction checkpoints the log into the main database file.
+    """
+
+    # Number of records read at once by iter_items().
+    BATCH_SIZE = 100
+
+    def __init__(self, db_filename):
+        super(SQLiteDatabase, self).__init__(db_filename)
+        self.db = sqlite3.connect(db_filename)
+        try:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError as e:
+            self.db.close()
+            raise RuntimeError(
+                'Failed to open %s as an SQLite database (%s). If it was '
+                'created by an older version of sioworkersd, run it with '
+                '--database-backend=sio.sioworkersd.database.BerkeleyDatabase.'
+                % (db_filename, e)
+            )
+        # Sync the log on every commit, so that a committed group commit
+        # survives a power failure.
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS groups ('
+            'id TEXT PRIMARY KEY, status TEXT, timestamp REAL, '
+            'retry_cnt INTEGER, next_retry REAL, env TEXT, results TEXT)'
+        )
+        # Groups without a timestamp come first, as if it were 0, see
+        # iter_items. The index is on the same expression.
+        self.db.execute('DROP INDEX IF EXISTS groups_by_status')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS groups_by_status_and_time '
+            'ON groups (status, COALESCE(timestamp, 0), id)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS task_results ('
+            'group_id TEXT, task TEXT, result TEXT NOT NULL, '
+            'PRIMARY KEY (group_id, task))'
+        )
+        self.db.commit()
+
+    def _store(self, job_id, fields):
+        names = sorted(fields)
+        self.db.execute(
+            'INSERT INTO groups (id, %s) VALUES (?%s) '
+            'ON CONFLICT (id) DO UPDATE SET %s'
+            % (
+                ', '.join(names),
+                ', ?' * len(names),
+                ', '.join('%s = excluded.%s' % (n, n) for n in names),
+            ),
+            [job_id] + [fields[n] for n in names],
+        )
+
+    def _storeTaskResult(self, job_id, task, result):
+        self.db.execute(
+            'INSERT OR REPLACE INTO task_results (group_id, task, result) '
+            'VALUES (?, ?, ?)',
+            (job_id, task, result),
+        )
+
+    def _remove(self, job_id, tasks=()):
+        self.db.execute('DELETE FROM groups WHERE id = ?', (job_id,))
+        self.db.execute('DELETE FROM task_results WHERE group_id = ?', (job_id,))
+
+    def _fields(self, job_id, row):
+        fields = {name: value for name, value in zip(FIELDS, row) if value is not None}
+        task_results = dict(
+            self.db.execute(
+                'SELECT task, result FROM task_results WHERE group_id = ?', (job_id,)
+            ).fetchall()
+        )
+        if task_results:
+            fields['task_results'] = task_results
+        return fields
+
+    def _iterate(self):
+        cursor = self.db.execute('SELECT id, %s FROM groups' % ', '.join(FIELDS))
+        for row in cursor.fetchall():
+            yield row[0], self._fields(row[0], row[1:])
+
+    def iter_items(self, status):
+        # Reads keys from the index in batches, each starting after the
+        # last key of the previous one, and loads every record just before
+        # yielding it, so that records changed in the meantime are seen
+        # in their current state.
+        query = 'SELECT COALESCE(timestamp, 0), id FROM groups WHERE status = ?'
+        order = ' ORDER BY COALESCE(timestamp, 0), id LIMIT %d' % self.BATCH_SIZE
+        keys = self.db.execute(query + order, (status,)).fetchall()
+        while keys:
+            for _, job_id in keys:
+                row = self.db.execute(
+                    'SELECT %s FROM groups WHERE id = ? AND status = ?'
+                    % ', '.join(FIELDS),
+                    (job_id, status),
+                ).fetchone()
+                if row is None:
+                    continue
+                job = self._decode(job_id, self._fields(job_id, row))
+                if job is not None:
+                    yield job
+            keys = self.db.execute(
+                query + ' AND (COALESCE(timestamp, 0), id) > (?, ?)' + order,
+                (status,) + tuple(keys[-1]),
+            ).fetchall()
+
+    def _commit(self):
+        self.db.commit()
+
+    def _compact(self):
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def _close(self):
+        self.db.close()
+
+
+class BerkeleyDatabase(Database):
+    """Berkeley DB hash database, the format used by older versions of
+    sioworkersd.
+
+    Every field is stored under its own key, ``<job_id>\\0<field>``, and
+    every task result under ``<job_id>\\0task_results\\0<task>``.
+    Records written by older versions (a whole JSON record under
+    ``<job_id>``) are still read. There is no journal, so a commit is
+    a full sync of the database.
+    """
+
+    def __init__(self, db_filename):
+        super(BerkeleyDatabase, self).__init__(db_filename)
+        import berkeleydb as bsddb
+
+        # hashopen, cause we operate on single keys and do full scan at start.
+        self.db = bsddb.hashopen(db_filename)
+
+    @staticmethod
+    def _key(job_id, field):
+        return six.ensure_binary(job_id) + b'\0' + six.ensure_binary(field)
+
+    def _store(self, job_id, fields):
+        for name, value in six.iteritems(fields):
+            if name not in JSON_FIELDS:
+                value = json_dumps(value)
+            self.db[self._key(job_id, name)] = six.ensure_binary(value)
+
+    def _storeTaskResult(self, job_id, task, result):
+        self.db[self._key(job_id, 'task_results\0' + task)] = six.ensure_binary(result)
+
+    def _remove(self, job_id, tasks=()):
+        keys = [six.ensure_binary(job_id)] + [
+            self._key(job_id, name) for name in FIELDS
+        ]
+        # Task results can't be listed without a full scan, but their
+        # names are known from the env, which records written by older
+        # versions keep in the whole record.
+        tasks = set(tasks)
+        try:
+            tasks.update(json.loads(self.db[self._key(job_id, 'env')])['workers_jobs'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        try:
+            tasks.update(json.loads(self.db[keys[0]])['env']['workers_jobs'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        keys += [self._key(job_id, 'task_results\0' + t) for t in tasks]
+        for key in keys:
+            if key in self.db:
+                del self.db[key]
+
+    def _iterate(self):
+        records = {}
+        task_result_keys = {}  # Map: job_id -> keys of its task results
+        for key in self.db.keys():
+            job_id, _, name = key.partition(b'\0')
+            job_id = job_id.decode()
+            if name.startswith(b'task_results\0'):
+                task_result_keys.setdefault(job_id, []).append(key)
+            if records.get(job_id, {}) is None:
+                continue
+            value = self.db[key].decode()
+            try:
+                if not name:
+                    # A whole record, written by older versions of sioworkersd.
+                    legacy = json.loads(value)
+                    legacy['env'] = json_dumps(legacy.get('env'))
+                    # Fields written since then take precedence.
+                    fields = records.setdefault(job_id, {})
+                    for n in FIELDS:
+                        if n in legacy:
+                            fields.setdefault(n, legacy[n])
+                elif name.startswith(b'task_results\0'):
+                    task = name.partition(b'\0')[2].decode()
+                    fields = records.setdefault(job_id, {})
+                    fields.setdefault('task_results', {})[task] = value
+                else:
+                    name = name.decode()
+                    if name not in JSON_FIELDS:
+                        value = json.loads(value)
+                    records.setdefault(job_id, {})[name] = value
+            except ValueError:
+                log.error('Failed to load json from DB: {}'.format(value))
+                records[job_id] = None
+        # The broken records are not decoded, so their task results are
+        # removed here.
+        for job_id, fields in six.iteritems(records):
+            if fields is None:
+                for key in task_result_keys.get(job_id, ()):
+                    del self.db[key]
+        return six.iteritems(records)
+
+    def _commit(self):
+        self.db.sync()
+
+    def _close(self):
+        self.db.close()
+
+
+# The header which every SQLite database file starts with.
+SQLITE_HEADER = b'SQLite format 3\0'
+
+
+def getDefaultDatabaseClassName(db_filename=None):
+    """Returns the backend for the database file ``db_filename``.
+
+    Files created by older versions of sioworkersd are Berkeley DB
+    databases, so existing files which aren't SQLite databases are
+    opened with ``BerkeleyDatabase``. New files are SQLite databases.
+    """
+    if db_filename is not None and os.path.exists(db_filename):
+        with open(db_filename, 'rb') as f:
+            header = f.read(len(SQLITE_HEADER))
+        if header and header != SQLITE_HEADER:
+            return 'sio.sioworkersd.database.BerkeleyDatabase'
+    return 'sio.sioworkersd.database.SQLiteDatabase'
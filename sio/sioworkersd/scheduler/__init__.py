@@ -21,6 +21,16 @@ class Scheduler(object):
         """Will be called when a worker disappears."""
         pass
 
+    def updateWorkerCache(self, worker_id):
+        """Will be called when a worker reports new contents of its
+        filetracker cache (``cached_files``)."""
+        pass
+
+    def updateWorkerRtt(self, worker_id):
+        """Will be called when the round-trip time of the worker's
+        heartbeats (``rtt``) changes."""
+        pass
+
     def addTask(self, env):
         """Add a new task to queue."""
         raise NotImplementedError()
@@ -29,11 +39,39 @@ class Scheduler(object):
         """Will be called when a task is completed or cancelled."""
         raise NotImplementedError()
 
+    def reattachTask(self, env, worker_id):
+        """Will be called instead of ``addTask`` with a task which is already
+        running on the worker, because it was started before the worker
+        reconnected. The worker is added first."""
+        raise NotImplementedError()
+
+    def getTaskClass(self, env):
+        """Returns the name of the class of a task (e.g. of a fast lane),
+        by which queue waits are reported in statistics."""
+        return 'default'
+
+    def taskFinished(self, result_env):
+        """Will be called with the result env of a successfully completed
+        task, right before ``delTask``."""
+        pass
+
     def schedule(self):
         """Return a list of tasks to be executed now, as a list of pairs
         (task_id, worker_id)."""
         raise NotImplementedError()
 
+    def prefetch(self):
+        """Return a list of tasks to be sent to workers whose slots are all
+        taken, as a list of pairs (task_id, worker_id). Will be called right
+        after ``schedule``.
+
+        A worker starts such tasks when the tasks it runs end (except
+        cpu-exec jobs on dedicated cores), in the order in which they were
+        sent, and meanwhile downloads their files. The scheduler must
+        account for it when the running tasks are deleted.
+        """
+        return []
+
 
 def getDefaultSchedulerClassName():
     return 'sio.sioworkersd.scheduler.prioritizing.PrioritizingScheduler'
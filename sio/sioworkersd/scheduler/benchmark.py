@@ -0,0 +1,358 @@
+"""Trace-driven scheduler benchmark.
+
+Replays a trace of scheduler events against a scheduler class, using the
+Twisted-free ``Manager`` stand-in from :mod:`sio.sioworkersd.scheduler.stubs`,
+and reports scheduling throughput, the latency distribution of
+``schedule()`` calls and the peak memory usage.
+
+A trace is a sequence of events, each being a list whose first element
+is the name of the operation:
+
+``["updateContest", contest_uid, priority, weight]``
+``["addWorker", worker_id, concurrency, available_ram_mb, can_run_cpu_exec]``
+``["delWorker", worker_id]``
+``["addTask", env]``, where ``env`` is a task env with at least ``task_id``,
+    ``job_type`` and ``contest_uid``
+``["delTask", task_id]``, which finishes (or cancels) the task
+``["complete", count]``, which finishes ``count`` random running tasks
+``["schedule"]``
+
+Recorded traces are read from files with one JSON-encoded event per line,
+synthetic ones are generated by :func:`synthetic_trace`. Any class
+implementing :class:`sio.sioworkersd.scheduler.Scheduler` can be
+benchmarked, e.g.::
+
+    python -m sio.sioworkersd.scheduler.benchmark --tasks 1000 100000
+    python -m sio.sioworkersd.scheduler.benchmark --trace trace.jsonl \\
+        --scheduler sio.sioworkersd.scheduler.prioritizing.PrioritizingScheduler
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+from random import Random
+
+from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
+from sio.sioworkersd.scheduler.stubs import Manager, Worker
+from sio.sioworkersd.utils import load_class
+import six
+from six.moves import range
+
+DEFAULT_QUEUE_SIZES = (1000, 10000, 100000, 1000000)
+# Chances that a worker is replaced by a new one, and that a contest
+# changes its priority and weight, before each pass of synthetic traces.
+WORKER_CHURN = 0.05
+CONTEST_CHURN = 0.05
+# Percentiles of schedule() latency shown in the report.
+LATENCY_PERCENTILES = (50, 90, 99, 100)
+
+
+class BenchmarkManager(Manager):
+    """``Manager`` which supports workers with different RAM and tasks
+    with arbitrary envs, and doesn't check its state after each pass
+    unless asked to."""
+
+    def __init__(self, check=False):
+        super(BenchmarkManager, self).__init__()
+        self.check = check
+        self.running = []  # Ids of tasks assigned to workers
+        self._running_index = {}  # Map: task_id -> index in self.running
+
+    def addWorker(self, wid, conc, ram=8192, can_run_cpu_exec=True):
+        worker = Worker({'concurrency': conc}, [], can_run_cpu_exec=can_run_cpu_exec)
+        worker.available_ram_mb = ram
+        self.workers[wid] = worker
+        self.scheduler.addWorker(wid)
+
+    def delWorker(self, wid):
+        for tid in list(self.workers[wid].tasks):
+            self.finishTask(tid)
+        super(BenchmarkManager, self).delWorker(wid)
+
+    def addTaskEnv(self, env):
+        task = dict(env, assigned_worker_id=None)
+        self.tasks[task['task_id']] = task
+        self.scheduler.addTask(task)
+
+    def finishTask(self, tid):
+        task = self.tasks.pop(tid)
+        wid = task['assigned_worker_id']
+        if wid is not None:
+            worker = self.workers[wid]
+            worker.tasks.remove(tid)
+            if task['job_type'] == 'cpu-exec':
+                worker.count_cpu_exec -= 1
+                worker.is_running_cpu_exec = False
+            # Swap with the last element.
+            index = self._running_index.pop(tid)
+            last = self.running.pop()
+            if last != tid:
+                self.running[index] = last
+                self._running_index[last] = index
+        self.scheduler.delTask(tid)
+
+    def completeRandomTasks(self, count):
+        for _ in range(min(count, len(self.running))):
+            self.finishTask(self.running[self.random.randrange(len(self.running))])
+
+    def schedule(self):
+        res = self.scheduler.schedule()
+        for tid, wid in res:
+            self._assignTaskToWorker(wid, self.tasks[tid])
+            self._running_index[tid] = len(self.running)
+            self.running.append(tid)
+        if self.check:
+            state = self._checkInnerState()
+            if state != 'OK':
+                raise AssertionError(state)
+        return res
+
+
+class TraceReplay(object):
+    """Replays a trace against a scheduler, measuring it."""
+
+    def __init__(self, scheduler_class, check=False):
+        self.manager = BenchmarkManager(check=check)
+        self.manager.setScheduler(scheduler_class(self.manager))
+        self.events = 0
+        self.assignments = 0
+        self.elapsed = 0.0
+        self.schedule_latencies = []
+
+    def replay(self, trace):
+        handlers = {
+            'updateContest': self.manager.updateContest,
+            'addWorker': self.manager.addWorker,
+            'delWorker': self.manager.delWorker,
+            'addTask': self.manager.addTaskEnv,
+            'delTask': self.manager.finishTask,
+            'complete': self.manager.completeRandomTasks,
+            'schedule': self._schedule,
+        }
+        timer = timeit.default_timer
+        for event in trace:
+            handler = handlers[event[0]]
+            start = timer()
+            handler(*event[1:])
+            self.elapsed += timer() - start
+            self.events += 1
+
+    def _schedule(self):
+        start = timeit.default_timer()
+        res = self.manager.schedule()
+        self.schedule_latencies.append(timeit.default_timer() - start)
+        self.assignments += len(res)
+
+    def report(self):
+        """Returns a dict of the measured values, times are in seconds."""
+        latencies = sorted(self.schedule_latencies)
+        percentiles = {}
+        for p in LATENCY_PERCENTILES:
+            if latencies:
+                index = min(len(latencies) - 1, len(latencies) * p // 100)
+                percentiles[p] = latencies[index]
+            else:
+                percentiles[p] = None
+        elapsed = self.elapsed or float('inf')
+        return {
+            'events': self.events,
+            'assignments': self.assignments,
+            'elapsed': self.elapsed,
+            'events_per_sec': self.events / elapsed,
+            'assignments_per_sec': self.assignments / elapsed,
+            'schedule_calls': len(latencies),
+            'schedule_latency': percentiles,
+        }
+
+
+def synthetic_trace(
+    tasks_count, workers_count=None, contests_count=100, passes=1000, seed=0
+):
+    """Generates a trace which fills the queue with ``tasks_count`` tasks
+    and then performs ``passes`` scheduling passes, finishing some of
+    the running tasks before each of them. Between the passes, workers
+    are replaced by new ones and contests change their priorities and
+    weights (see ``WORKER_CHURN`` and ``CONTEST_CHURN``).
+
+    Workers have concurrency and RAM like typical sioworkers machines,
+    30% of them can run cpu-exec jobs. About a quarter of the tasks are
+    real-cpu ones.
+    """
+    rand = Random(seed)
+    if workers_count is None:
+        workers_count = max(10, min(tasks_count // 100, 500))
+
+    def add_contest(uid):
+        return ['updateContest', uid, rand.randint(0, 2), rand.randint(1, 100)]
+
+    def add_worker(wid):
+        return [
+            'addWorker',
+            wid,
+            rand.choice([1, 2, 4, 8]),
+            rand.choice([2048, 4096, 8192, 16384]),
+            rand.random() < 0.3,
+        ]
+
+    for uid in range(contests_count):
+        yield add_contest(uid)
+    worker_ids = list(range(workers_count))
+    for wid in worker_ids:
+        yield add_worker(wid)
+    for tid in range(tasks_count):
+        yield [
+            'addTask',
+            {
+                'task_id': tid,
+                'job_type': 'cpu-exec' if rand.random() < 0.25 else 'vcpu-exec',
+                'contest_uid': rand.randrange(contests_count),
+                'task_priority': rand.randint(0, 10),
+                'exec_mem_limit': rand.choice([64, 256, 512, 1024]) * 1024,
+            },
+        ]
+    next_tid = tasks_count
+    next_wid = workers_count
+    for _ in range(passes):
+        if rand.random() < WORKER_CHURN:
+            index = rand.randrange(len(worker_ids))
+            yield ['delWorker', worker_ids[index]]
+            worker_ids[index] = next_wid
+            yield add_worker(next_wid)
+            next_wid += 1
+        if rand.random() < CONTEST_CHURN:
+            yield add_contest(rand.randrange(contests_count))
+        yield ['schedule']
+        completed = rand.randint(1, max(1, workers_count // 10))
+        yield ['complete', completed]
+        # Keep the queue size roughly constant.
+        for _ in range(completed):
+            yield [
+                'addTask',
+                {
+                    'task_id': next_tid,
+                    'job_type': 'cpu-exec' if rand.random() < 0.25 else 'vcpu-exec',
+                    'contest_uid': rand.randrange(contests_count),
+                    'task_priority': rand.randint(0, 10),
+                },
+            ]
+            next_tid += 1
+
+
+def read_trace(f):
+    """Reads a recorded trace from a file object, one JSON event per line."""
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def run_benchmark(scheduler_class, trace, check=False, measure_memory=True):
+    """Replays ``trace`` and returns the report of
+    :meth:`TraceReplay.report`, with ``peak_memory`` (in bytes) added if
+    ``measure_memory`` is set.
+
+    The trace is materialized first, so that generating it isn't counted.
+    Tracing memory allocations slows the scheduler down, so the time
+    measurements are more accurate without it.
+    """
+    trace = list(trace)
+    replay = TraceReplay(scheduler_class, check=check)
+    if measure_memory:
+        tracemalloc.start()
+    try:
+        replay.replay(trace)
+        report = replay.report()
+        if measure_memory:
+            report['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+    return report
+
+
+def _format_report(name, report):
+    lines = [
+        '%s: %d events, %d assignments in %.3f s'
+        % (name, report['events'], report['assignments'], report['elapsed']),
+        '  %.0f events/s, %.0f assignments/s'
+        % (report['events_per_sec'], report['assignments_per_sec']),
+        '  schedule() latency over %d calls: %s'
+        % (
+            report['schedule_calls'],
+            ', '.join(
+                'p%d %.1f us' % (p, latency * 1e6)
+                for p, latency in sorted(six.iteritems(report['schedule_latency']))
+                if latency is not None
+            ),
+        ),
+    ]
+    if 'peak_memory' in report:
+        lines.append('  peak memory: %.1f MiB' % (report['peak_memory'] / 2.0 ** 20))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--scheduler',
+        default=getDefaultSchedulerClassName(),
+        help='dotted path of the scheduler class',
+    )
+    parser.add_argument(
+        '--trace', help='file with a recorded trace, instead of synthetic ones'
+    )
+    parser.add_argument(
+        '--tasks',
+        type=int,
+        nargs='+',
+        default=list(DEFAULT_QUEUE_SIZES),
+        help='queue sizes of synthetic traces',
+    )
+    parser.add_argument('--workers', type=int, help='workers in synthetic traces')
+    parser.add_argument(
+        '--passes', type=int, default=1000, help='passes in synthetic traces'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--check', action='store_true', help='check the state after each pass'
+    )
+    parser.add_argument(
+        '--no-memory',
+        action='store_true',
+        help="don't trace memory allocations (they slow the scheduler down)",
+    )
+    args = parser.parse_args(argv)
+
+    scheduler_class = load_class(args.scheduler)
+    if args.trace:
+        with open(args.trace) as f:
+            traces = [(args.trace, read_trace(f))]
+            _run(scheduler_class, traces, args)
+    else:
+        traces = [
+            (
+                '%d tasks' % tasks,
+                synthetic_trace(
+                    tasks, args.workers, passes=args.passes, seed=args.seed
+                ),
+            )
+            for tasks in args.tasks
+        ]
+        _run(scheduler_class, traces, args)
+
+
+def _run(scheduler_class, traces, args):
+    for name, trace in traces:
+        report = run_benchmark(
+            scheduler_class, trace, check=args.check, measure_memory=not args.no_memory
+        )
+        print(_format_report(name, report))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,25 @@ chosen in the first phase. The tasks within a contest are scheduled
 for judging according to decreasing priorities. Tasks with the same
 task priority within one contest are judged in arrival order.
 
+Optionally (see DURATION_ORDER), tasks with the same priority from one
+group (submission) are ordered by their expected durations, learned from
+the durations of finished tasks. Running the longest tasks first shortens
+the time until the whole group is judged, running the shortest ones first
+shortens the average wait of a task. Groups are still judged in arrival
+order.
+
+Any-cpu workers which are blocked for waiting real-cpu tasks (see
+_assignTaskToAnyCpuWorker) stay partially idle until their tasks end.
+Optionally (see the ``backfill`` argument), they are given virtual-cpu
+tasks whose time limits guarantee that they end before the running
+tasks, so that the real-cpu tasks aren't delayed.
+
+Virtual-cpu tasks of the job types in the fast lane (see the ``fast_lane``
+argument), e.g. compilations, which all the other tasks of a submission
+wait for, are chosen before all the other tasks, regardless of contest
+priorities. Optionally, a share of vcpu slots is reserved for them, so
+that they don't wait for running tasks to end even during rejudges.
+
 We define two types of workers:
 1. any-cpu worker (virtual cpu + real cpu)
 2. vcpu-only worker (only virtual cpu)
@@ -33,25 +52,65 @@ We define two types of workers:
 If a worker has WORKER_ALLOW_RUN_CPU_EXEC setting set to true, the
 worker is any-cpu worker. Otherwise it is vcpu-only worker.
 
+A worker may also have physical cores dedicated to real-cpu tasks
+(``cpu_exec_slots``, see sio.protocol.worker.partition_cpus). Then it is
+a vcpu-only worker as far as its ``concurrency`` slots are concerned, and
+additionally runs up to ``cpu_exec_slots`` real-cpu tasks alongside the
+virtual-cpu ones, so it is never blocked.
+
 We define two types of tasks:
 1. real-cpu task
 2. virtual-cpu task (virtual cpu)
 
 Real-cpu task is cpu-exec job. It is judged on real cpu.
-It can be judged only on any-cpu worker. Moreover it have to be
-judged exclusively on a worker (at most one at a time).
+It can be judged only on any-cpu worker (or a dedicated core of a worker).
+Moreover it have to be judged exclusively on a worker (at most one at
+a time). Free dedicated cores are used first.
 Virtual-cpu task is non cpu-exec job. Most often it is judged on virtual
 cpu. It can be judged on any worker (any-cpu or vcpu-only).
 Virtual-cpu tasks can be judged simultaneously on one worker.
+
+Workers may advertise CPU shares and scratch disk space (see
+sio.sioworkersd.utils.DEFAULT_CPU_SHARES). Then the vcpu slots of such
+a worker are its free CPU shares, a virtual-cpu task takes as many of them
+as its job type uses, and it must also fit in the free disk space. Tasks
+are packed onto workers so that the remaining RAM per slot matches the
+task's RAM per slot, see _WorkersQueue.
+
+Workers report which files are in their filetracker caches (see
+sio.workers.util.CACHED_FILE_KEYS). Once a worker is chosen for
+a task, another one which is equally suitable for it, but has more of
+the task's files cached, is preferred, to avoid downloading them again.
+
+Optionally (see the ``prefetch_depth`` argument), virtual-cpu tasks are
+reserved for workers whose slots are all taken, so that the workers
+download their files while the running tasks end, see prefetch.
+
+Optionally (see the ``slow_rtt`` argument), workers whose heartbeats
+are slow only get virtual-cpu tasks which no other worker can run, see
+updateWorkerRtt.
+
+When many vcpu slots are free, e.g. after many workers have (re)connected,
+vcpu-only workers get their tasks in batches, several per contest draw,
+see _scheduleBatch.
 """
 
 from __future__ import absolute_import
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import math
 from random import Random
+import time
 from sortedcontainers import SortedList, SortedSet
 
 from sio.sioworkersd.scheduler import Scheduler
-from sio.sioworkersd.utils import get_required_ram_for_job
+from sio.sioworkersd.scheduler.runtimestats import RuntimeStatistics
+from sio.sioworkersd.utils import (
+    get_cpu_shares_for_job,
+    get_required_disk_for_job,
+    get_required_ram_for_job,
+    get_time_limit_for_job,
+)
+from sio.workers.util import get_cached_files
 import six
 
 
@@ -70,6 +129,9 @@ class _WaitingTasksQueue(object):
     def __init__(self):
         self._dict = OrderedDict()
         self._tasks_required_ram = SortedList()
+        # Incremented on every change, so that values computed from
+        # the queue can be cached.
+        self.version = 0
 
     def __contains__(self, task):
         return task in self._dict
@@ -85,10 +147,12 @@ class _WaitingTasksQueue(object):
     def add(self, task):
         self._dict[task] = True
         self._tasks_required_ram.add(task.required_ram_mb)
+        self.version += 1
 
     def remove(self, task):
         del self._dict[task]
         self._tasks_required_ram.discard(task.required_ram_mb)
+        self.version += 1
 
     def left(self):
         if self._dict:
@@ -99,6 +163,7 @@ class _WaitingTasksQueue(object):
     def popleft(self):
         task = self._dict.popitem(False)[0]
         self._tasks_required_ram.discard(task.required_ram_mb)
+        self.version += 1
         return task
 
     def getTasksRequiredRam(self):
@@ -120,22 +185,52 @@ class WorkerInfo(object):
         self.id = wid
         self.concurrency = wdata.concurrency
         self.total_ram_mb = wdata.available_ram_mb
-        self.cpu_enabled = wdata.can_run_cpu_exec
+        # None if the worker doesn't advertise them.
+        self.cpu_shares = wdata.cpu_shares
+        self.total_disk_mb = wdata.scratch_disk_mb
+        # Number of real-cpu tasks which the worker can run on dedicated
+        # cores. Workers without them run real-cpu tasks exclusively.
+        self.cpu_exec_slots = wdata.cpu_exec_slots if wdata.can_run_cpu_exec else 0
+        self.cpu_enabled = wdata.can_run_cpu_exec and not self.cpu_exec_slots
+        # Whether tasks may be reserved for the worker, see
+        # PrioritizingScheduler.prefetch.
+        self.can_queue = wdata.can_queue
 
         # Mutable data
         # Whether this worker is currently running real-cpu task.
         self.is_running_real_cpu = False
-        # Count of tasks that the worker currently has assigned.
+        # Count of tasks that the worker currently has assigned,
+        # except the ones on dedicated cores.
         self.running_tasks = 0
+        # Count of real-cpu tasks running on dedicated cores.
+        self.running_cpu_exec_tasks = 0
         # Amount of RAM that can be potentially used by current tasks.
         self.used_ram_mb = 0
+        # CPU shares and scratch disk space used by current tasks.
+        self.used_cpu_shares = 0
+        self.used_disk_mb = 0
+        # Times by which the running tasks end according to their time
+        # limits (only tracked for backfilling), and the number of running
+        # tasks for which it's unknown.
+        self.task_deadlines = SortedList()
+        self.unbounded_tasks = 0
+        # Filetracker paths of files which the worker has (probably) cached,
+        # least recently used first (the values are unused).
+        self.cached_files = OrderedDict()
+        # Virtual-cpu tasks reserved for the worker, which it starts in
+        # this order when its tasks end. They don't take slots, but their
+        # RAM, CPU shares and scratch disk space are used already.
+        self.reserved_tasks = deque()
+        # Whether the worker's heartbeats are slow, see
+        # PrioritizingScheduler.updateWorkerRtt.
+        self.degraded = False
 
     # for Python 3 compatibility
     def __lt__(self, other):
         return self.id < other.id
 
     def getQueueName(self):
-        if self.is_running_real_cpu or self.running_tasks == self.concurrency:
+        if self.getAvailableVcpuSlots() == 0:
             return None
         elif self.cpu_enabled:
             return 'any-cpu'
@@ -151,38 +246,258 @@ class WorkerInfo(object):
         """
         return self.total_ram_mb - self.used_ram_mb
 
+    def hasDiskFor(self, task):
+        """Returns whether the task fits in the free scratch disk space."""
+        return (
+            self.total_disk_mb is None
+            or self.used_disk_mb + task.required_disk_mb <= self.total_disk_mb
+        )
+
     def getAvailableVcpuSlots(self):
-        """Returns the number of vcpu tasks that can be assigned to worker.
+        """Returns the number of vcpu slots that are free.
 
         This value only depends on concurrency and the number of currently
-        running tasks.
+        running tasks. If the worker advertises CPU shares, it's the number
+        of free shares instead (as long as the concurrency allows another
+        task).
         """
-        if self.is_running_real_cpu:
+        if self.is_running_real_cpu or self.running_tasks == self.concurrency:
             return 0
-        else:
+        elif self.cpu_shares is None:
             return self.concurrency - self.running_tasks
+        else:
+            return self.cpu_shares - self.used_cpu_shares
+
+    def getTotalVcpuSlots(self):
+        return self.concurrency if self.cpu_shares is None else self.cpu_shares
+
+    def getTaskSlots(self, task):
+        """Returns the number of vcpu slots a virtual-cpu task takes."""
+        return 1 if self.cpu_shares is None else task.cpu_shares
+
+    def canRunVirtualCpuTask(self, task):
+        """Returns whether a virtual-cpu task can be assigned right now."""
+        return (
+            self.getAvailableVcpuSlots() >= self.getTaskSlots(task)
+            and self.getAvailableRam() >= task.required_ram_mb
+            and self.hasDiskFor(task)
+        )
+
+    def getReservableVcpuSlots(self, depth):
+        """Returns the number of vcpu slots that virtual-cpu tasks may be
+        reserved in, with up to ``depth`` tasks per slot.
+
+        Tasks are only reserved for workers whose slots are all taken.
+        Like in getAvailableVcpuSlots, it's the number of free CPU shares
+        if the worker advertises them (as long as the depth allows another
+        task).
+        """
+        limit = depth * self.concurrency
+        if (
+            not self.can_queue
+            or self.is_running_real_cpu
+            or self.running_tasks < self.concurrency
+            or len(self.reserved_tasks) >= limit
+        ):
+            return 0
+        elif self.cpu_shares is None:
+            return limit - len(self.reserved_tasks)
+        else:
+            return self.cpu_shares - self.used_cpu_shares
+
+    def canReserveVirtualCpuTask(self, task, depth):
+        """Returns whether a virtual-cpu task can be reserved right now."""
+        return (
+            self.getReservableVcpuSlots(depth) >= self.getTaskSlots(task)
+            and self.getAvailableRam() >= task.required_ram_mb
+            and self.hasDiskFor(task)
+        )
+
+    def getAvailableCpuExecSlots(self):
+        """Returns the number of real-cpu tasks that can be assigned to
+        the worker's dedicated cores."""
+        return self.cpu_exec_slots - self.running_cpu_exec_tasks
 
     def attachTask(self, task):
-        assert self.running_tasks < self.concurrency
         assert self.used_ram_mb + task.required_ram_mb <= self.total_ram_mb
-        assert self.is_running_real_cpu is False
+        assert self.hasDiskFor(task)
 
-        if task.real_cpu:
-            assert self.cpu_enabled is True
-            assert self.running_tasks == 0
-            self.is_running_real_cpu = True
+        if task.real_cpu and self.cpu_exec_slots:
+            assert self.running_cpu_exec_tasks < self.cpu_exec_slots
+            self.running_cpu_exec_tasks += 1
+        else:
+            assert self.running_tasks < self.concurrency
+            assert self.is_running_real_cpu is False
+            if task.real_cpu:
+                assert self.cpu_enabled is True
+                assert self.running_tasks == 0
+                self.is_running_real_cpu = True
+            else:
+                assert self.getAvailableVcpuSlots() >= self.getTaskSlots(task)
+            self.running_tasks += 1
+            if self.cpu_shares is not None:
+                self.used_cpu_shares += task.cpu_shares
 
         self.used_ram_mb += task.required_ram_mb
-        self.running_tasks += 1
+        self.used_disk_mb += task.required_disk_mb
+        if task.deadline is None:
+            self.unbounded_tasks += 1
+        else:
+            self.task_deadlines.add(task.deadline)
+
+    def reserveTask(self, task):
+        assert not task.real_cpu
+        self.reserved_tasks.append(task)
+        self.used_ram_mb += task.required_ram_mb
+        self.used_disk_mb += task.required_disk_mb
+        if self.cpu_shares is not None:
+            self.used_cpu_shares += task.cpu_shares
+
+    def unreserveTask(self, task):
+        self.reserved_tasks.remove(task)
+        self.used_ram_mb -= task.required_ram_mb
+        self.used_disk_mb -= task.required_disk_mb
+        if self.cpu_shares is not None:
+            self.used_cpu_shares -= task.cpu_shares
 
     def detachTask(self, task):
-        assert self.running_tasks >= 1
-        assert self.running_tasks == 1 or self.is_running_real_cpu is False
         assert self.used_ram_mb >= task.required_ram_mb
 
+        if task.real_cpu and self.cpu_exec_slots:
+            assert self.running_cpu_exec_tasks >= 1
+            self.running_cpu_exec_tasks -= 1
+        else:
+            assert self.running_tasks >= 1
+            assert self.running_tasks == 1 or self.is_running_real_cpu is False
+            self.running_tasks -= 1
+            self.is_running_real_cpu = False
+            if self.cpu_shares is not None:
+                self.used_cpu_shares -= task.cpu_shares
+
         self.used_ram_mb -= task.required_ram_mb
-        self.running_tasks -= 1
-        self.is_running_real_cpu = False
+        self.used_disk_mb -= task.required_disk_mb
+        if task.deadline is None:
+            self.unbounded_tasks -= 1
+        else:
+            self.task_deadlines.remove(task.deadline)
+
+    def getDrainDeadline(self):
+        """Returns the time by which all the running tasks end, according
+        to their time limits, or None if it's unknown."""
+        if self.unbounded_tasks or not self.task_deadlines:
+            return None
+        return self.task_deadlines[-1]
+
+
+class _WorkersQueue(object):
+    """A queue of workers which are not full (free or partially free).
+
+    Iterating yields workers sorted by ``key``. Additionally, workers are
+    indexed for choosing the best one for a virtual-cpu task, see
+    ``getBestWorkerForVirtualCpuTask``: they are partitioned into busy
+    and empty ones, by the number of available vcpu slots, by whether
+    their slots are CPU shares and by whether they are degraded, and each
+    partition is sorted by available RAM. Workers must be removed from
+    the queue before their state changes, and inserted back after.
+
+    ``slots`` returns the number of available vcpu slots of a worker,
+    by default ``WorkerInfo.getAvailableVcpuSlots``.
+    """
+
+    def __init__(self, key, slots=None):
+        self._key = key
+        self._slots = slots or (lambda w: w.getAvailableVcpuSlots())
+        self._workers = SortedSet(key=key)
+        # Map: is busy
+        #      -> (number of vcpu slots, has CPU shares, is degraded)
+        #      -> workers sorted by RAM
+        self._partitions = {False: {}, True: {}}
+
+    def __len__(self):
+        return len(self._workers)
+
+    def __iter__(self):
+        return iter(self._workers)
+
+    def _getPartitionKey(self, worker):
+        return self._slots(worker), worker.cpu_shares is not None, worker.degraded
+
+    def _getPartition(self, worker, create=False):
+        partitions = self._partitions[worker.running_tasks > 0]
+        partition_key = self._getPartitionKey(worker)
+        partition = partitions.get(partition_key)
+        if partition is None and create:
+            key = self._key
+            partition = partitions[partition_key] = SortedList(
+                key=lambda w: (w.getAvailableRam(), key(w))
+            )
+        return partition
+
+    def add(self, worker):
+        self._workers.add(worker)
+        self._getPartition(worker, create=True).add(worker)
+
+    def remove(self, worker):
+        self._workers.remove(worker)
+        partition = self._getPartition(worker)
+        partition.remove(worker)
+        if not partition:
+            del self._partitions[worker.running_tasks > 0][
+                self._getPartitionKey(worker)
+            ]
+
+    def _getBestCandidate(self, busy, degraded, task):
+        best = None
+        task_ram = task.required_ram_mb
+        for partition_key, partition in six.iteritems(self._partitions[busy]):
+            slots, has_shares, partition_degraded = partition_key
+            task_slots = task.cpu_shares if has_shares else 1
+            if slots < task_slots or partition_degraded != degraded:
+                continue
+            # The task should leave the worker with as much RAM per free
+            # slot as it takes per its slot. Workers with at least that
+            # much RAM start at i. The first of them and the last worker
+            # before them (if it has enough RAM) are the closest ones from
+            # both sides. Among workers with equal RAM, the first in queue
+            # order wins. Workers without enough disk space are skipped
+            # one by one, as free disk space isn't indexed.
+            i = partition.bisect_key_left((slots * task_ram / task_slots,))
+            candidates = []
+            j = i
+            while j < len(partition) and not partition[j].hasDiskFor(task):
+                j += 1
+            if j < len(partition):
+                candidates.append(partition[j])
+            j = i - 1
+            while j >= 0 and not partition[j].hasDiskFor(task):
+                j -= 1
+            if j >= 0 and partition[j].getAvailableRam() >= task_ram:
+                ram = partition[j].getAvailableRam()
+                j = partition.bisect_key_left((ram,))
+                while not partition[j].hasDiskFor(task):
+                    j += 1
+                candidates.append(partition[j])
+            for worker in candidates:
+                difference = abs(
+                    worker.getAvailableRam() / self._slots(worker)
+                    - task_ram / task_slots
+                )
+                candidate = (difference, self._key(worker), worker)
+                if best is None or candidate[:2] < best[:2]:
+                    best = candidate
+        return best
+
+    def getBestWorkerForVirtualCpuTask(self, task, prefer_busy=False):
+        """See ``PrioritizingScheduler._getBestWorkerForVirtualCpuTask``."""
+        for degraded in (False, True):
+            busy = self._getBestCandidate(True, degraded, task)
+            if prefer_busy and busy is not None:
+                return busy[2]
+            empty = self._getBestCandidate(False, degraded, task)
+            candidates = [c for c in (busy, empty) if c is not None]
+            if candidates:
+                return min(candidates, key=lambda c: c[:2])[2]
+        return None
 
 
 class TaskInfo(object):
@@ -202,12 +517,31 @@ class TaskInfo(object):
         self.id = env['task_id']
         self.real_cpu = env['job_type'] == 'cpu-exec'
         self.required_ram_mb = get_required_ram_for_job(env)
+        self.cpu_shares = get_cpu_shares_for_job(env)
+        self.required_disk_mb = get_required_disk_for_job(env)
         self.priority = env.get('task_priority', 0)
+        self.files = get_cached_files(env)
+        time_limit = get_time_limit_for_job(env)
+        # In seconds, None if unknown.
+        self.time_limit = time_limit / 1000.0 if time_limit is not None else None
         self.contest = contest
         TaskInfo.sequence_counter += 1
         self.sequence_number = TaskInfo.sequence_counter
+        # Used for ordering tasks by duration within a group, see
+        # PrioritizingScheduler.addTask. By default the order is FIFO.
+        self.group_id = None
+        self.group_sequence_number = self.sequence_number
+        self.duration_rank = 0
+        # Set by PrioritizingScheduler.addTask.
+        self.fast_lane = False
         # Mutable data
         self.assigned_worker = None
+        # The worker for which the task is reserved, see
+        # PrioritizingScheduler.prefetch.
+        self.reserved_worker = None
+        # The time by which the task ends according to its time limit,
+        # set when it's assigned (only for backfilling).
+        self.deadline = None
 
 
 class ContestInfo(object):
@@ -230,6 +564,97 @@ class ContestInfo(object):
         self.weight = weight
 
 
+class _ContestWeights(object):
+    """Contests with the same priority, for weighted random selection.
+
+    Contests are kept in insertion order, with a Fenwick tree over their
+    weights, so that adding, removing and reweighting a contest as well as
+    finding the contest at a given prefix sum of weights are O(log n).
+    Removed contests leave empty slots behind, which are dropped once
+    they outnumber the live ones.
+    """
+
+    def __init__(self):
+        self._contests = []  # Contest (or None) in each slot
+        self._weights = []
+        self._tree = [0]  # 1-based
+        self._slots = {}  # Map: contest -> slot
+        self.total = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, contest):
+        return contest in self._slots
+
+    def _prefixSum(self, i):
+        result = 0
+        while i > 0:
+            result += self._tree[i]
+            i -= i & -i
+        return result
+
+    def _addToSlot(self, slot, delta):
+        self._weights[slot] += delta
+        self.total += delta
+        i = slot + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def add(self, contest, weight):
+        assert contest not in self._slots
+        slot = len(self._contests)
+        self._contests.append(contest)
+        self._weights.append(weight)
+        self._slots[contest] = slot
+        i = slot + 1
+        self._tree.append(
+            weight + self._prefixSum(i - 1) - self._prefixSum(i - (i & -i))
+        )
+        self.total += weight
+
+    def remove(self, contest):
+        slot = self._slots.pop(contest)
+        self._addToSlot(slot, -self._weights[slot])
+        self._contests[slot] = None
+        if len(self._contests) > 2 * len(self._slots) + 16:
+            self._compact()
+
+    def setWeight(self, contest, weight):
+        slot = self._slots[contest]
+        self._addToSlot(slot, weight - self._weights[slot])
+
+    def choose(self, value):
+        """Returns the first contest at which the prefix sum of weights
+        reaches ``value`` (1 <= ``value`` <= ``total``)."""
+        assert 1 <= value <= self.total
+        i = 0
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+        while step:
+            if i + step < len(self._tree) and self._tree[i + step] < value:
+                i += step
+                value -= self._tree[i]
+            step //= 2
+        return self._contests[i]
+
+    def _compact(self):
+        live = [
+            (contest, weight)
+            for contest, weight in zip(self._contests, self._weights)
+            if contest is not None
+        ]
+        self._contests = []
+        self._weights = []
+        self._tree = [0]
+        self._slots = {}
+        self.total = 0
+        for contest, weight in live:
+            self.add(contest, weight)
+
+
 class TasksQueues(object):
     """Per-contest priority queues of tasks.
 
@@ -241,24 +666,52 @@ class TasksQueues(object):
         self.random = random
         # Map from contest to SortedSet of queued tasks in that contest.
         self.queues = {}
+        # Contests with queued tasks, grouped by priority (at the time of
+        # adding them or of the last updateContest call).
+        self._contest_priorities = {}  # Map: contest -> priority
+        self._weights_by_priority = {}  # Map: priority -> _ContestWeights
+        self._priorities = SortedList()
 
     def __nonzero__(self):
         return bool(self.queues)
 
     __bool__ = __nonzero__  # for Python 2/3 compatibility
 
+    def _addContest(self, contest):
+        priority = contest.priority
+        weights = self._weights_by_priority.get(priority)
+        if weights is None:
+            weights = self._weights_by_priority[priority] = _ContestWeights()
+            self._priorities.add(priority)
+        weights.add(contest, contest.weight)
+        self._contest_priorities[contest] = priority
+
+    def _removeContest(self, contest):
+        priority = self._contest_priorities.pop(contest)
+        weights = self._weights_by_priority[priority]
+        weights.remove(contest)
+        if not weights:
+            del self._weights_by_priority[priority]
+            self._priorities.remove(priority)
+
     def addTask(self, task):
-        contest_queue = self.queues.setdefault(
-            task.contest,
-            SortedSet(
+        contest_queue = self.queues.get(task.contest)
+        if contest_queue is None:
+            contest_queue = self.queues[task.contest] = SortedSet(
                 key=
                 # It's important that if we have many tasks with the same
                 # priority, then we give priority to the oldest.
                 # Otherwise, it would be unfair to the contestants if we
                 # judged recently submitted solutions before the old ones.
-                lambda t: (t.priority, -t.sequence_number)
-            ),
-        )
+                # Tasks of one group may be reordered by their durations.
+                lambda t: (
+                    t.priority,
+                    -t.group_sequence_number,
+                    t.duration_rank,
+                    -t.sequence_number,
+                )
+            )
+            self._addContest(task.contest)
         assert task not in contest_queue
         contest_queue.add(task)
 
@@ -268,6 +721,19 @@ class TasksQueues(object):
         contest_queue.remove(task)
         if not contest_queue:
             del self.queues[contest]
+            self._removeContest(contest)
+
+    def updateContest(self, contest):
+        """Must be called after the priority or weight of a contest
+        has been changed."""
+        if contest not in self.queues:
+            return
+        if self._contest_priorities[contest] == contest.priority:
+            weights = self._weights_by_priority[contest.priority]
+            weights.setWeight(contest, contest.weight)
+        else:
+            self._removeContest(contest)
+            self._addContest(contest)
 
     def chooseTask(self):
         """Returns the highest-priority task from a contest chosen according
@@ -281,37 +747,28 @@ class TasksQueues(object):
 
         # Assumes that contests' weights are positive integers.
         # Contests' priorities may also be negative or zero.
-        # It is possible to implement this function in logarithmic
-        # complexity instead of linear. If you have many queued contests,
-        # you should consider reimplementing it.
+        # Both picking the highest priority and the weighted choice
+        # of a contest are logarithmic in the number of queued contests.
+
+        return self._chooseContestQueue()[-1]
+
+    def chooseTasks(self, count):
+        """Like chooseTask, but returns up to ``count`` highest-priority
+        tasks of the chosen contest, the best one first.
+
+        All contests get the same number of tasks per draw, so they are
+        still chosen in proportion to their weights.
+        """
+        return self._chooseContestQueue()[-count:][::-1]
 
+    def _chooseContestQueue(self):
         assert self.queues
 
-        max_contest_priority = None
-        contests_weights_sum = None
-        for contest in six.iterkeys(self.queues):
-            current_contest_priority = contest.priority
-            if (
-                max_contest_priority is None
-                or current_contest_priority > max_contest_priority
-            ):
-                max_contest_priority = current_contest_priority
-                contests_weights_sum = 0
-            if max_contest_priority == current_contest_priority:
-                contests_weights_sum += contest.weight
-
-        random_value = self.random.randint(1, contests_weights_sum)
-        contests_weights_prefix_sum = 0
-        best_contest = None
-        for contest in six.iterkeys(self.queues):
-            if contest.priority != max_contest_priority:
-                continue
-            contests_weights_prefix_sum += contest.weight
-            if contests_weights_prefix_sum >= random_value:
-                best_contest = contest
-                break
+        weights = self._weights_by_priority[self._priorities[-1]]
+        random_value = self.random.randint(1, weights.total)
+        best_contest = weights.choose(random_value)
 
-        return self.queues[best_contest][-1]
+        return self.queues[best_contest]
 
 
 class PrioritizingScheduler(Scheduler):
@@ -330,16 +787,72 @@ class PrioritizingScheduler(Scheduler):
     starvation.
     """
 
-    def __init__(self, manager):
+    # Scheduling passes starting with at least this many free vcpu slots
+    # assign tasks to vcpu-only workers in batches, see _scheduleBatch.
+    BATCH_SCHEDULING_MIN_FREE_SLOTS = 64
+    # Number of tasks taken from a contest at once by _scheduleBatch.
+    BATCH_TASKS_PER_DRAW = 8
+    # Files cached by more workers than this are ignored when looking for
+    # a worker with the task's files, to keep the search fast. They are
+    # cached widely enough anyway.
+    CACHE_LOCALITY_MAX_HOLDERS = 64
+    # Files of assigned tasks are assumed to be cached until the worker
+    # reports otherwise, but at most this many per worker (so that it
+    # is bounded for workers which don't report their caches).
+    MAX_CACHED_FILES_PER_WORKER = 1024
+    # Order of tasks with the same priority within a group: None (arrival
+    # order), 'longest-first' or 'shortest-first'. See the subclasses
+    # below, which can be chosen with the --scheduler option.
+    DURATION_ORDER = None
+
+    def __init__(
+        self,
+        manager,
+        backfill=False,
+        clock=None,
+        fast_lane=(),
+        fast_lane_share=0,
+        prefetch_depth=0,
+        slow_rtt=None,
+    ):
+        """``backfill`` enables backfilling of blocked any-cpu workers, see
+        _backfillBlockedWorker. ``clock`` (with a ``seconds()`` method, like
+        the reactor) is used for it, instead of the system time.
+
+        ``fast_lane`` are job types of virtual-cpu tasks which are chosen
+        before the other tasks, and ``fast_lane_share`` (from 0 to 1) is
+        the share of vcpu slots reserved for them, see
+        _respectsFastLaneReservation.
+
+        ``prefetch_depth`` is the number of tasks per slot which may be
+        reserved for a worker whose slots are all taken, see prefetch.
+
+        Workers whose heartbeats take longer than ``slow_rtt`` seconds
+        to return are degraded, see updateWorkerRtt.
+        """
         super(PrioritizingScheduler, self).__init__(manager)
+        assert 0 <= fast_lane_share <= 1
+        assert prefetch_depth >= 0
         self.random = Random(0)
+        self.backfill = backfill
+        self._seconds = time.time if clock is None else clock.seconds
+        self.fast_lane = frozenset(fast_lane)
+        self.fast_lane_share = fast_lane_share
+        self.prefetch_depth = prefetch_depth
+        self.slow_rtt = slow_rtt
+        # Total vcpu slots of all workers, and the ones taken by
+        # the fast lane tasks.
+        self.total_vcpu_slots = 0
+        self.fast_lane_used_slots = 0
 
         # Worker scheduling data
         self.workers = {}  # Map: worker_id -> worker
+        # Number of free vcpu slots of workers in the queues below.
+        self.free_vcpu_slots = 0
         # Queues of workers which are not full (free or partially free).
         self.workers_queues = {
-            'vcpu-only': SortedSet(),
-            'any-cpu': SortedSet(
+            'vcpu-only': _WorkersQueue(key=lambda w: w.id),
+            'any-cpu': _WorkersQueue(
                 key=
                 # For scheduling real-cpu tasks (which must run on
                 # any-cpu workers) we need empty workers and we prefer
@@ -349,19 +862,56 @@ class PrioritizingScheduler(Scheduler):
             ),
         }
 
+        # Full workers for which tasks may be reserved, see prefetch.
+        self.prefetch_queues = {
+            'vcpu-only': _WorkersQueue(
+                key=lambda w: w.id,
+                slots=lambda w: w.getReservableVcpuSlots(self.prefetch_depth),
+            ),
+            'any-cpu': _WorkersQueue(
+                key=lambda w: w.id,
+                slots=lambda w: w.getReservableVcpuSlots(self.prefetch_depth),
+            ),
+        }
+
+        # Workers with free dedicated cores, sorted by available RAM.
+        self.cpu_exec_workers = SortedList(key=lambda w: (w.getAvailableRam(), w.id))
+
+        # Map: filetracker path -> workers which have the file cached
+        self.file_locations = {}
+
+        # RAM of all any-cpu workers (including full ones), sorted.
+        self.any_cpu_workers_ram = SortedList()
+        # Cached result of _getNumberOfBlockedAnyCpuWorkers(), with
+        # the version of waiting_real_cpu_tasks it was computed for.
+        # Reset when any-cpu workers come and go.
+        self._blocked_any_cpu_workers = None
+        self._blocked_any_cpu_workers_version = None
+
         # Task scheduling data
         self.contests = {}  # Map: contest_uid -> contest
         self.tasks = {}  # Map: task_id -> task
+        if self.DURATION_ORDER is not None:
+            assert self.DURATION_ORDER in ('longest-first', 'shortest-first')
+            self.runtime_stats = RuntimeStatistics()
+        else:
+            self.runtime_stats = None
+        # Map: group_id -> [sequence number of its first task,
+        #                   number of its tasks in self.tasks]
+        self.groups = {}
         # Queues of tasks waiting for scheduling.
         # They do not contain tasks from self.waiting_real_cpu_tasks.
+        # Tasks in the fast lane are only in their own queue.
         self.tasks_queues = {
+            'fast-lane': TasksQueues(self.random),
             'virtual-cpu': TasksQueues(self.random),
+            'real-cpu': TasksQueues(self.random),
             'both': TasksQueues(self.random),
         }
         # Real-cpu tasks which have been scheduled,
         # but couldn't have been assigned to workers, because each
         # worker had already assigned at least one task.
-        # See also: a huge comment in _scheduleOnce.
+        # See also: a huge comment in _assignTaskToAnyCpuWorker.
         self.waiting_real_cpu_tasks = _WaitingTasksQueue()
 
     def __unicode__(self):
@@ -377,83 +927,141 @@ class PrioritizingScheduler(Scheduler):
         queue_name = worker.getQueueName()
         if queue_name is not None:
             self.workers_queues[queue_name].add(worker)
+            self.free_vcpu_slots += worker.getAvailableVcpuSlots()
+        if worker.getAvailableCpuExecSlots():
+            self.cpu_exec_workers.add(worker)
+        if worker.getReservableVcpuSlots(self.prefetch_depth):
+            self.prefetch_queues[self._getPrefetchQueueName(worker)].add(worker)
 
     def _removeWorkerFromQueue(self, worker):
         queue_name = worker.getQueueName()
         if queue_name is not None:
             self.workers_queues[queue_name].remove(worker)
+            self.free_vcpu_slots -= worker.getAvailableVcpuSlots()
+        if worker.getAvailableCpuExecSlots():
+            self.cpu_exec_workers.remove(worker)
+        if worker.getReservableVcpuSlots(self.prefetch_depth):
+            self.prefetch_queues[self._getPrefetchQueueName(worker)].remove(worker)
+
+    @staticmethod
+    def _getPrefetchQueueName(worker):
+        return 'any-cpu' if worker.cpu_enabled else 'vcpu-only'
 
     def addWorker(self, worker_id):
         """Will be called when a new worker appears."""
-        worker = WorkerInfo(worker_id, self.manager.getWorkers()[worker_id])
+        wdata = self.manager.getWorkers()[worker_id]
+        worker = WorkerInfo(worker_id, wdata)
         self.workers[worker_id] = worker
+        self.total_vcpu_slots += worker.getTotalVcpuSlots()
+        self._addCachedFiles(worker, wdata.cached_files)
+        worker.degraded = self._isDegraded(wdata)
+        if worker.cpu_enabled:
+            self.any_cpu_workers_ram.add(worker.total_ram_mb)
+            self._blocked_any_cpu_workers_version = None
         self._insertWorkerToQueue(worker)
 
     def delWorker(self, worker_id):
         """Will be called when a worker disappears."""
         worker = self.workers[worker_id]
         assert worker.running_tasks == 0
+        assert worker.running_cpu_exec_tasks == 0
+        assert not worker.reserved_tasks
         del self.workers[worker_id]
+        self.total_vcpu_slots -= worker.getTotalVcpuSlots()
+        self._removeCachedFiles(worker, list(worker.cached_files))
+        if worker.cpu_enabled:
+            self.any_cpu_workers_ram.remove(worker.total_ram_mb)
+            self._blocked_any_cpu_workers_version = None
         self._removeWorkerFromQueue(worker)
 
+    def updateWorkerCache(self, worker_id):
+        """Will be called when a worker reports new contents of its
+        filetracker cache."""
+        worker = self.workers[worker_id]
+        cached_files = self.manager.getWorkers()[worker_id].cached_files
+        self._removeCachedFiles(
+            worker, [path for path in worker.cached_files if path not in cached_files]
+        )
+        self._addCachedFiles(worker, cached_files)
+
+    def updateWorkerRtt(self, worker_id):
+        """Will be called when the round-trip time of the worker's
+        heartbeats changes.
+
+        Workers whose round-trip time exceeds ``slow_rtt`` are degraded
+        (e.g. overloaded or behind a congested link), so they only get
+        virtual-cpu tasks which no other worker can run right now.
+        """
+        worker = self.workers[worker_id]
+        degraded = self._isDegraded(self.manager.getWorkers()[worker_id])
+        if degraded != worker.degraded:
+            self._removeWorkerFromQueue(worker)
+            worker.degraded = degraded
+            self._insertWorkerToQueue(worker)
+
+    def _isDegraded(self, wdata):
+        return (
+            self.slow_rtt is not None
+            and wdata.rtt is not None
+            and wdata.rtt > self.slow_rtt
+        )
+
+    def _addCachedFiles(self, worker, files):
+        for path in files:
+            if path in worker.cached_files:
+                worker.cached_files.move_to_end(path)
+                continue
+            worker.cached_files[path] = None
+            self.file_locations.setdefault(path, set()).add(worker)
+            if len(worker.cached_files) > self.MAX_CACHED_FILES_PER_WORKER:
+                self._removeCachedFiles(worker, [next(iter(worker.cached_files))])
+
+    def _removeCachedFiles(self, worker, files):
+        for path in files:
+            del worker.cached_files[path]
+            holders = self.file_locations[path]
+            holders.discard(worker)
+            if not holders:
+                del self.file_locations[path]
+
     def _getAnyCpuQueueSize(self):
         return len(self.workers_queues['any-cpu'])
 
-    def _getBestWorkerForVirtualCpuTask(self, queue, task_ram, prefer_busy=False):
+    def _getBestWorkerForVirtualCpuTask(self, queue, task, prefer_busy=False):
         """Selects a worker from the queue best suited for a given task.
 
         The algorithm used picks a worker such that
         getAvailableRam() / getAvailableVcpuSlots() is the closest
-        possible to task RAM limit between all viable workers.
+        possible to task RAM limit (per vcpu slot taken by the task)
+        between all viable workers.
 
         If prefer_busy flag is set to True, partially busy workers are given
-        higher priority than completely empty ones.
+        higher priority than completely empty ones. Degraded workers (see
+        updateWorkerRtt) are only chosen if no other worker can run the
+        task.
 
         Returns None if there are no viable workers.
-        """
-
-        def suitability(worker):
-            worker_optimal_ram = (
-                worker.getAvailableRam() / worker.getAvailableVcpuSlots()
-            )
-            difference = abs(worker_optimal_ram - task_ram)
-
-            if prefer_busy:
-                return worker.running_tasks > 0, -difference
-            else:
-                return -difference
 
-        assigned_worker = None
-        for worker in queue:
-            # getAvailableVcpuSlots() should never be 0 in normal conditions
-            # because fully busy workers shouldn't be added to queues.
-            if (
-                worker.getAvailableRam() >= task_ram
-                and worker.getAvailableVcpuSlots() > 0
-            ):
-                if assigned_worker is None or suitability(worker) > suitability(
-                    assigned_worker
-                ):
-                    assigned_worker = worker
-
-        # Performance note: the execution time is linear in relation to
-        # the worker queue size. This should not be a problem, but it's
-        # possible in some cases to implement a logarithmic version
-        # by using a suitable comparator as a key for worker queue SortedSet.
-
-        return assigned_worker
+        Ties are resolved in favour of the worker which is first in
+        the queue. The queue's index makes this logarithmic in the queue
+        size (times the number of distinct counts of free slots), plus
+        linear in the number of workers around the best RAM fit which
+        are skipped for not having enough scratch disk space. Workers
+        which don't advertise it are never skipped.
+        """
+        return queue.getBestWorkerForVirtualCpuTask(task, prefer_busy)
 
-    def _getBestVcpuOnlyWorkerForVirtualCpuTask(self, task_ram):
-        """Returns a vcpu-only worker suitable for a task with given RAM limit.
+    def _getBestVcpuOnlyWorkerForVirtualCpuTask(self, task):
+        """Returns a vcpu-only worker suitable for a given virtual-cpu task.
 
         If there are no suitable workers (each worker is fully used, or
         doesn't have enough RAM available), returns None.
         """
         return self._getBestWorkerForVirtualCpuTask(
-            self.workers_queues['vcpu-only'], task_ram
+            self.workers_queues['vcpu-only'], task
         )
 
-    def _getBestAnyCpuWorkerForVirtualCpuTask(self, task_ram):
+    def _getBestAnyCpuWorkerForVirtualCpuTask(self, task):
         """Returns any-cpu worker suitable for running given virtual-cpu task.
 
         If there are no suitable workers (each worker is fully used, or
@@ -463,14 +1071,14 @@ class PrioritizingScheduler(Scheduler):
         _scheduleOnce for details.
         """
         return self._getBestWorkerForVirtualCpuTask(
-            self.workers_queues['any-cpu'], task_ram, prefer_busy=True
+            self.workers_queues['any-cpu'], task, prefer_busy=True
         )
 
-    def _getBestAnyCpuWorkerForRealCpuTask(self, task_ram):
+    def _getBestAnyCpuWorkerForRealCpuTask(self, task):
         """Returns any-cpu worker suitable for running a given real-cpu task.
 
         The worker must be completely empty and have enough RAM (more than
-        task RAM limit).
+        task RAM limit) and disk space.
 
         If there are no such workers, returns None.
         """
@@ -482,11 +1090,120 @@ class PrioritizingScheduler(Scheduler):
             if worker.running_tasks > 0:
                 # All workers are partially busy.
                 return None
-            if worker.getAvailableRam() >= task_ram:
+            if (
+                worker.getAvailableRam() >= task.required_ram_mb
+                and worker.hasDiskFor(task)
+            ):
                 return worker
 
         return None
 
+    def _getBestCpuExecSlotForRealCpuTask(self, task):
+        """Returns a worker with a free dedicated core and enough RAM (and
+        disk space) for a given real-cpu task, the one with the lowest
+        available RAM.
+
+        If there are no such workers, returns None. Like in
+        _getBestWorkerForVirtualCpuTask, the workers without enough disk
+        space are skipped one by one.
+        """
+        workers = self.cpu_exec_workers
+        i = workers.bisect_key_left((task.required_ram_mb,))
+        while i < len(workers) and not workers[i].hasDiskFor(task):
+            i += 1
+        if i < len(workers):
+            return workers[i]
+        return None
+
+    def _getBestWorkerForRealCpuTask(self, task):
+        """Returns a worker which can run a given real-cpu task right now,
+        preferably on a dedicated core, so that no any-cpu worker is taken
+        exclusively.
+
+        If there are no such workers, returns None.
+        """
+        return self._getBestCpuExecSlotForRealCpuTask(
+            task
+        ) or self._getBestAnyCpuWorkerForRealCpuTask(task)
+
+    def _getRamMisfit(self, task, worker, reserve=False):
+        """Returns how far the worker's RAM is from the best fit for the
+        task, which is what choosing a worker for it minimizes: the
+        difference of RAM per slot (see _getBestWorkerForVirtualCpuTask)
+        for virtual-cpu tasks, and the RAM left over for real-cpu ones.
+        With ``reserve``, the slots are the ones for reserved tasks.
+        """
+        if task.real_cpu:
+            return worker.getAvailableRam() - task.required_ram_mb
+        if reserve:
+            slots = worker.getReservableVcpuSlots(self.prefetch_depth)
+        else:
+            slots = worker.getAvailableVcpuSlots()
+        return abs(
+            worker.getAvailableRam() / slots
+            - task.required_ram_mb / worker.getTaskSlots(task)
+        )
+
+    def _preferCachingWorker(self, task, worker, reserve=False):
+        """Returns the worker which has the most of the task's files cached,
+        among the ones as suitable for the task as ``worker`` (the one
+        chosen without looking at the caches).
+
+        Suitable workers are in the same queue (or have free dedicated
+        cores, if ``worker`` has), can run the task now, fit it at least
+        as well as ``worker`` (see _getRamMisfit) and aren't degraded,
+        unless ``worker`` is. If ``worker`` is
+        a partially busy any-cpu worker, so must be the others, see
+        _getBestAnyCpuWorkerForVirtualCpuTask. With ``reserve``, they are
+        in the same prefetch queue and the task can be reserved for them
+        instead. Ties are resolved in favour of ``worker``, and then of
+        lower worker ids.
+        """
+        if not task.files:
+            return worker
+        counts = {}  # Map: worker -> number of the task's files it has
+        for path in task.files:
+            holders = self.file_locations.get(path, ())
+            if len(holders) > self.CACHE_LOCALITY_MAX_HOLDERS:
+                continue
+            for holder in holders:
+                counts[holder] = counts.get(holder, 0) + 1
+
+        dedicated = task.real_cpu and worker.cpu_exec_slots > 0
+        queue_name = worker.getQueueName()
+        need_busy = queue_name == 'any-cpu' and worker.running_tasks > 0
+        misfit = self._getRamMisfit(task, worker, reserve)
+        best, best_count = worker, counts.get(worker, 0)
+        for candidate, count in six.iteritems(counts):
+            if count < best_count or (
+                count == best_count and (best is worker or best < candidate)
+            ):
+                continue
+            if reserve:
+                if candidate.cpu_enabled != worker.cpu_enabled or (
+                    not candidate.canReserveVirtualCpuTask(task, self.prefetch_depth)
+                ):
+                    continue
+            elif dedicated:
+                if not candidate.getAvailableCpuExecSlots():
+                    continue
+            elif (
+                candidate.getQueueName() != queue_name
+                or (task.real_cpu and candidate.running_tasks > 0)
+                or (need_busy and candidate.running_tasks == 0)
+                or (not task.real_cpu and not candidate.canRunVirtualCpuTask(task))
+            ):
+                continue
+            if (
+                (candidate.degraded and not worker.degraded)
+                or candidate.getAvailableRam() < task.required_ram_mb
+                or not candidate.hasDiskFor(task)
+                or self._getRamMisfit(task, candidate, reserve) > misfit
+            ):
+                continue
+            best, best_count = candidate, count
+        return best
+
     # Task scheduling
 
     def updateContest(self, contest_uid, priority, weight):
@@ -501,46 +1218,141 @@ class PrioritizingScheduler(Scheduler):
         else:
             contest.priority = priority
             contest.weight = weight
+            for queues in six.itervalues(self.tasks_queues):
+                queues.updateContest(contest)
 
     def _addTaskToQueues(self, task):
-        if not task.real_cpu:
+        if task.fast_lane:
+            self.tasks_queues['fast-lane'].addTask(task)
+            return
+        if task.real_cpu:
+            self.tasks_queues['real-cpu'].addTask(task)
+        else:
             self.tasks_queues['virtual-cpu'].addTask(task)
         self.tasks_queues['both'].addTask(task)
 
     def _removeTaskFromQueues(self, task):
-        if not task.real_cpu:
+        if task.fast_lane:
+            self.tasks_queues['fast-lane'].delTask(task)
+            return
+        if task.real_cpu:
+            self.tasks_queues['real-cpu'].delTask(task)
+        else:
             self.tasks_queues['virtual-cpu'].delTask(task)
         self.tasks_queues['both'].delTask(task)
 
     def _attachTaskToWorker(self, task, worker):
+        self._removeWorkerFromQueue(worker)
+        self._bindTaskToWorker(task, worker)
+        self._insertWorkerToQueue(worker)
+
+    def _bindTaskToWorker(self, task, worker):
+        """Attaches a task to a worker which isn't in the queues."""
         assert task.assigned_worker is None
         task.assigned_worker = worker
-
-        self._removeWorkerFromQueue(worker)
+        if self.backfill and task.time_limit is not None:
+            task.deadline = self._seconds() + task.time_limit
+        if task.fast_lane:
+            self.fast_lane_used_slots += worker.getTaskSlots(task)
         worker.attachTask(task)
-        self._insertWorkerToQueue(worker)
+        # The worker downloads the files to its cache.
+        self._addCachedFiles(worker, task.files)
 
     def addTask(self, env):
         """Add a new task to queue."""
         assert env['contest_uid'] in self.contests
         task = TaskInfo(env, self.contests[env['contest_uid']])
         assert task.id not in self.tasks
+        task.fast_lane = not task.real_cpu and env['job_type'] in self.fast_lane
+        if self.runtime_stats is not None and env.get('group_id') is not None:
+            task.group_id = env['group_id']
+            group = self.groups.setdefault(task.group_id, [task.sequence_number, 0])
+            group[1] += 1
+            task.group_sequence_number = group[0]
+            duration = self.runtime_stats.estimate(env)
+            if self.DURATION_ORDER == 'longest-first':
+                task.duration_rank = duration
+            else:
+                task.duration_rank = -duration
         self.tasks[task.id] = task
         self._addTaskToQueues(task)
 
+    def reattachTask(self, env, worker_id):
+        """Will be called instead of ``addTask`` with a task which is already
+        running on the worker, because it was started before the worker
+        reconnected."""
+        self.addTask(env)
+        task = self.tasks[env['task_id']]
+        self._removeTaskFromQueues(task)
+        self._attachTaskToWorker(task, self.workers[worker_id])
+
     def delTask(self, task_id):
         """Will be called when a task is completed or cancelled."""
         assert task_id in self.tasks
         task = self.tasks.pop(task_id)
+        if task.group_id is not None:
+            group = self.groups[task.group_id]
+            group[1] -= 1
+            if not group[1]:
+                del self.groups[task.group_id]
         if task.assigned_worker:
-            self._removeWorkerFromQueue(task.assigned_worker)
-            task.assigned_worker.detachTask(task)
-            self._insertWorkerToQueue(task.assigned_worker)
+            worker = task.assigned_worker
+            if task.fast_lane:
+                self.fast_lane_used_slots -= worker.getTaskSlots(task)
+            self._removeWorkerFromQueue(worker)
+            worker.detachTask(task)
+            # The worker starts the first reserved task in its slot.
+            reserved = None
+            if worker.reserved_tasks and not (task.real_cpu and worker.cpu_exec_slots):
+                reserved = worker.reserved_tasks[0]
+                worker.unreserveTask(reserved)
+                reserved.reserved_worker = None
+            self._insertWorkerToQueue(worker)
+            if reserved is not None:
+                self._attachTaskToWorker(reserved, worker)
+        elif task.reserved_worker:
+            self._removeWorkerFromQueue(task.reserved_worker)
+            task.reserved_worker.unreserveTask(task)
+            self._insertWorkerToQueue(task.reserved_worker)
         elif task in self.waiting_real_cpu_tasks:
             self.waiting_real_cpu_tasks.remove(task)
         else:
             self._removeTaskFromQueues(task)
 
+    def taskFinished(self, result_env):
+        """Will be called with the result env of a successfully completed
+        task, right before ``delTask``."""
+        if self.runtime_stats is not None:
+            self.runtime_stats.addResult(result_env)
+
+    def getTaskClass(self, env):
+        if env['job_type'] in self.fast_lane and env['job_type'] != 'cpu-exec':
+            return 'fast-lane'
+        return 'default'
+
+    def _chooseVirtualCpuTask(self):
+        """Returns the virtual-cpu task which should be assigned next, from
+        the fast lane if possible, or None if there are none."""
+        for queue_name in ('fast-lane', 'virtual-cpu'):
+            if self.tasks_queues[queue_name]:
+                return self.tasks_queues[queue_name].chooseTask()
+        return None
+
+    def _respectsFastLaneReservation(self, task, worker):
+        """Returns whether a virtual-cpu task may be assigned to the worker.
+
+        Tasks outside the fast lane must leave enough vcpu slots free for
+        the fast lane to use ``fast_lane_share`` of all the slots. Real-cpu
+        tasks aren't restricted.
+        """
+        if task.fast_lane or not self.fast_lane_share:
+            return True
+        reserved = (
+            int(math.ceil(self.fast_lane_share * self.total_vcpu_slots))
+            - self.fast_lane_used_slots
+        )
+        return self.free_vcpu_slots - worker.getTaskSlots(task) >= reserved
+
     def _getNumberOfBlockedAnyCpuWorkers(self):
         """Returns the number of any cpu workers that are "blocked".
 
@@ -561,74 +1373,99 @@ class PrioritizingScheduler(Scheduler):
         the any-cpu worker queue is returned (which means all of them
         should be considered blocked).
         """
-        if self.manager.minAnyCpuWorkerRam is None or not self.waiting_real_cpu_tasks:
+        workers_ram = self.any_cpu_workers_ram
+        if not workers_ram or not self.waiting_real_cpu_tasks:
             return 0
 
         waiting_real_cpu_tasks_ram = self.waiting_real_cpu_tasks.getTasksRequiredRam()
 
         # This is the most common case, and we should handle this in O(1).
-        if self.manager.minAnyCpuWorkerRam >= waiting_real_cpu_tasks_ram[-1]:
+        if workers_ram[0] >= waiting_real_cpu_tasks_ram[-1]:
             return len(self.waiting_real_cpu_tasks)
 
-        workers_ram = [
-            w.available_ram_mb
-            for _, w in six.iteritems(self.manager.getWorkers())
-            if w.can_run_cpu_exec
-        ]
-
-        workers_ram.sort()
+        # Otherwise the result only changes with the waiting tasks or
+        # the set of workers, so it is cached in the meantime.
+        version = self.waiting_real_cpu_tasks.version
+        if version == self._blocked_any_cpu_workers_version:
+            return self._blocked_any_cpu_workers
 
         next_worker_index = 0
-        # This list is sorted.
+        # Both lists are sorted, each task is matched with the smallest
+        # worker left that can fit it.
         for task_ram in waiting_real_cpu_tasks_ram:
-            while (
-                next_worker_index < len(workers_ram)
-                and workers_ram[next_worker_index] < task_ram
-            ):
-                next_worker_index += 1
-
+            next_worker_index = max(
+                next_worker_index, workers_ram.bisect_left(task_ram)
+            )
             if next_worker_index < len(workers_ram):
                 next_worker_index += 1
             else:
                 # All workers are blocked.
-                return len(workers_ram)
+                next_worker_index = len(workers_ram)
+                break
 
+        self._blocked_any_cpu_workers = next_worker_index
+        self._blocked_any_cpu_workers_version = version
         return next_worker_index
 
-    def _scheduleOnce(self):
-        """Selects one task to be executed.
+    def _assignVirtualCpuTaskToVcpuOnlyWorker(self):
+        """If there is a virtual-cpu task, and a suitable vcpu-only worker,
+        associates them.
 
-        Returns a pair ``(task_id, worker_id)`` or ``None`` if it is not
-        possible.
+        Returns a pair ``(task_id, worker_id)`` or ``None``.
         """
-
-        # If there is a virtual-cpu task, and a suitable vcpu-only worker,
-        # associate them.
-        if self.tasks_queues['virtual-cpu']:
-            vcpu_task = self.tasks_queues['virtual-cpu'].chooseTask()
-            if vcpu_task:
-                vcpu_worker = self._getBestVcpuOnlyWorkerForVirtualCpuTask(
-                    vcpu_task.required_ram_mb
-                )
-                if vcpu_worker:
+        vcpu_task = self._chooseVirtualCpuTask()
+        if vcpu_task:
+            vcpu_worker = self._getBestVcpuOnlyWorkerForVirtualCpuTask(vcpu_task)
+            if vcpu_worker:
+                vcpu_worker = self._preferCachingWorker(vcpu_task, vcpu_worker)
+                if self._respectsFastLaneReservation(vcpu_task, vcpu_worker):
                     self._removeTaskFromQueues(vcpu_task)
                     self._attachTaskToWorker(vcpu_task, vcpu_worker)
                     return vcpu_task.id, vcpu_worker.id
+        return None
 
-        # If there is an any-cpu worker suitable for the first queued real-cpu
-        # task, associate them.
+    def _assignWaitingRealCpuTask(self):
+        """If there is a worker suitable for the first queued real-cpu
+        task, associates them.
+
+        Returns a pair ``(task_id, worker_id)`` or ``None``.
+        """
         # Usually any empty any-cpu worker will do, since worker RAM amount is
         # typically higher than all of the tasks RAM limits.
         waiting_rcpu_task = self.waiting_real_cpu_tasks.left()
         if waiting_rcpu_task:
-            rcpu_worker = self._getBestAnyCpuWorkerForRealCpuTask(
-                waiting_rcpu_task.required_ram_mb
-            )
+            rcpu_worker = self._getBestWorkerForRealCpuTask(waiting_rcpu_task)
             if rcpu_worker:
+                rcpu_worker = self._preferCachingWorker(waiting_rcpu_task, rcpu_worker)
                 self.waiting_real_cpu_tasks.popleft()
                 self._attachTaskToWorker(waiting_rcpu_task, rcpu_worker)
                 return waiting_rcpu_task.id, rcpu_worker.id
+        return None
+
+    def _assignRealCpuTaskToCpuExecSlot(self):
+        """If there is a real-cpu task, and a worker with a free dedicated
+        core suitable for it, associates them.
 
+        Returns a pair ``(task_id, worker_id)`` or ``None``.
+        """
+        if self.cpu_exec_workers and self.tasks_queues['real-cpu']:
+            task = self.tasks_queues['real-cpu'].chooseTask()
+            worker = self._getBestCpuExecSlotForRealCpuTask(task)
+            if worker:
+                worker = self._preferCachingWorker(task, worker)
+                self._removeTaskFromQueues(task)
+                self._attachTaskToWorker(task, worker)
+                return task.id, worker.id
+        return None
+
+    def _assignTaskToAnyCpuWorker(self):
+        """Chooses a task of any type and associates it with a suitable
+        any-cpu worker, unless the workers are blocked.
+
+        Returns a pair ``(task_id, worker_id)`` or ``None``. If the chosen
+        task is a real-cpu one, and no worker can run it right now, it is
+        moved to ``self.waiting_real_cpu_tasks`` and ``None`` is returned.
+        """
         # The logic used below is that each queued real-cpu tasks "blocks"
         # one partially busy any-cpu worker from running virtual-cpu tasks.
         # If all partially busy workers are "blocked", we do not schedule
@@ -647,25 +1484,28 @@ class PrioritizingScheduler(Scheduler):
         #
         # The logic above allows to assign any-cpu workers to both virtual-cpu
         # and real-cpu tasks without starving any of them.
-        if (
-            self._getAnyCpuQueueSize() > self._getNumberOfBlockedAnyCpuWorkers()
-            and self.tasks_queues['both']
+        if self._getAnyCpuQueueSize() > self._getNumberOfBlockedAnyCpuWorkers() and (
+            self.tasks_queues['fast-lane'] or self.tasks_queues['both']
         ):
-            task = self.tasks_queues['both'].chooseTask()
+            if self.tasks_queues['fast-lane']:
+                task = self.tasks_queues['fast-lane'].chooseTask()
+            else:
+                task = self.tasks_queues['both'].chooseTask()
             if not task.real_cpu:
-                worker = self._getBestAnyCpuWorkerForVirtualCpuTask(
-                    task.required_ram_mb
-                )
+                worker = self._getBestAnyCpuWorkerForVirtualCpuTask(task)
                 # It's possible that no worker has enough RAM for this task.
                 # In this case, we do nothing and simply wait until some worker
                 # (possibly vcpu-only) is now available.
                 if worker:
+                    worker = self._preferCachingWorker(task, worker)
+                if worker and self._respectsFastLaneReservation(task, worker):
                     self._removeTaskFromQueues(task)
                     self._attachTaskToWorker(task, worker)
                     return task.id, worker.id
             else:
-                worker = self._getBestAnyCpuWorkerForRealCpuTask(task.required_ram_mb)
+                worker = self._getBestWorkerForRealCpuTask(task)
                 if worker:
+                    worker = self._preferCachingWorker(task, worker)
                     self._removeTaskFromQueues(task)
                     self._attachTaskToWorker(task, worker)
                     return task.id, worker.id
@@ -673,21 +1513,209 @@ class PrioritizingScheduler(Scheduler):
                     # Reserve an any-cpu worker for this task.
                     self._removeTaskFromQueues(task)
                     self.waiting_real_cpu_tasks.add(task)
+        elif self.backfill and (
+            self.tasks_queues['fast-lane'] or self.tasks_queues['virtual-cpu']
+        ):
+            return self._backfillBlockedWorker()
+
+        return None
+
+    def _backfillBlockedWorker(self):
+        """Chooses a virtual-cpu task and associates it with a partially
+        busy any-cpu worker, even though the worker is blocked, if the
+        task's time limit guarantees that it ends before the tasks which
+        the worker is running. So the real-cpu tasks waiting for the
+        worker to become empty aren't delayed.
+
+        Among such workers, the one which becomes empty the earliest is
+        chosen, leaving the others for longer tasks.
+
+        Returns a pair ``(task_id, worker_id)`` or ``None``.
+        """
+        task = self._chooseVirtualCpuTask()
+        if task.time_limit is None:
+            return None
+        end = self._seconds() + task.time_limit
+        best = None
+        for worker in self.workers_queues['any-cpu']:
+            if worker.running_tasks == 0:
+                continue
+            drain = worker.getDrainDeadline()
+            if (
+                drain is not None
+                and drain >= end
+                and worker.canRunVirtualCpuTask(task)
+                and (best is None or drain < best[0])
+            ):
+                best = (drain, worker)
+        if best is None or not self._respectsFastLaneReservation(task, best[1]):
+            return None
+        worker = best[1]
+        self._removeTaskFromQueues(task)
+        self._attachTaskToWorker(task, worker)
+        return task.id, worker.id
+
+    def _scheduleOnce(self):
+        """Selects one task to be executed.
+
+        Returns a pair ``(task_id, worker_id)`` or ``None`` if it is not
+        possible.
+        """
+        association = (
+            self._assignVirtualCpuTaskToVcpuOnlyWorker()
+            or self._assignWaitingRealCpuTask()
+            or self._assignRealCpuTaskToCpuExecSlot()
+        )
+        if association is not None:
+            return association
 
-                    # There may be other tasks we can schedule right now.
-                    return self._scheduleOnce()
+        waiting_version = self.waiting_real_cpu_tasks.version
+        association = self._assignTaskToAnyCpuWorker()
+        reserved = self.waiting_real_cpu_tasks.version != waiting_version
+        if association is None and reserved:
+            # A worker has been reserved for a real-cpu task.
+            # There may be other tasks we can schedule right now.
+            return self._scheduleOnce()
 
         # Sorry, no match...
-        return None
+        return association
+
+    def _scheduleBatch(self):
+        """Assigns virtual-cpu tasks to vcpu-only workers in batches.
+
+        Unlike repeated ``_scheduleOnce`` calls, each contest draw takes
+        up to ``BATCH_TASKS_PER_DRAW`` tasks, and a worker chosen for
+        a task is taken out of the queues once and filled with the next
+        tasks as long as they fit, so that it's updated in the queues once
+        per run of tasks instead of per task. The tasks still go to the
+        best fitting workers, but the ones that follow may fill the chosen
+        worker instead. Any-cpu workers are left to ``_scheduleOnce``,
+        because the real-cpu tasks block them one assignment at a time.
+
+        Stops at the first task which no vcpu-only worker can run, like
+        ``_scheduleOnce`` does. Returns a list of pairs
+        ``(task_id, worker_id)``.
+        """
+        result = []
+        worker = None  # The worker taken out of the queues
+        while self.workers_queues['vcpu-only'] or worker is not None:
+            if self.tasks_queues['fast-lane']:
+                queue = self.tasks_queues['fast-lane']
+            elif self.tasks_queues['virtual-cpu']:
+                queue = self.tasks_queues['virtual-cpu']
+            else:
+                break
+            for task in queue.chooseTasks(self.BATCH_TASKS_PER_DRAW):
+                # Degraded workers only get the tasks no other one can run.
+                if (
+                    worker is None
+                    or worker.degraded
+                    or not worker.canRunVirtualCpuTask(task)
+                ):
+                    if worker is not None:
+                        self._returnWorkerToQueue(worker)
+                    worker = self._getBestVcpuOnlyWorkerForVirtualCpuTask(task)
+                    if worker is None:
+                        return result
+                    worker = self._preferCachingWorker(task, worker)
+                    self._takeWorkerFromQueue(worker)
+                if not self._respectsFastLaneReservation(task, worker):
+                    self._returnWorkerToQueue(worker)
+                    return result
+                self._removeTaskFromQueues(task)
+                slots = worker.getAvailableVcpuSlots()
+                self._bindTaskToWorker(task, worker)
+                self.free_vcpu_slots -= slots - worker.getAvailableVcpuSlots()
+                result.append((task.id, worker.id))
+                if not worker.getAvailableVcpuSlots():
+                    self._returnWorkerToQueue(worker)
+                    worker = None
+        if worker is not None:
+            self._returnWorkerToQueue(worker)
+        return result
+
+    def _takeWorkerFromQueue(self, worker):
+        """Removes a vcpu-only worker from the queues for _scheduleBatch,
+        still counting its free vcpu slots."""
+        self._removeWorkerFromQueue(worker)
+        self.free_vcpu_slots += worker.getAvailableVcpuSlots()
+
+    def _returnWorkerToQueue(self, worker):
+        self.free_vcpu_slots -= worker.getAvailableVcpuSlots()
+        self._insertWorkerToQueue(worker)
 
     def schedule(self):
         """Return a list of tasks to be executed now, as a list of pairs
         (task_id, worker_id).
+
+        If at least ``BATCH_SCHEDULING_MIN_FREE_SLOTS`` vcpu slots are free,
+        vcpu-only workers get their tasks in batches first, see
+        ``_scheduleBatch``.
         """
         result = []
+        if self.free_vcpu_slots >= self.BATCH_SCHEDULING_MIN_FREE_SLOTS:
+            result = self._scheduleBatch()
         while True:
             association = self._scheduleOnce()
             if association is None:
                 break
             result.append(association)
         return result
+
+    def prefetch(self):
+        """Return a list of virtual-cpu tasks reserved for workers whose
+        slots are all taken, as a list of pairs (task_id, worker_id).
+
+        Each worker gets up to ``prefetch_depth`` tasks per slot, as long
+        as they fit in its free RAM, CPU shares and disk space, which they
+        take right away. Tasks are chosen like the ones assigned by
+        ``schedule``, and so are the workers, from the queues of the full
+        ones: vcpu-only workers first, then any-cpu ones, which get none
+        while real-cpu tasks wait, so that they become empty as soon as
+        possible. When a task of the worker is deleted, the first reserved
+        one takes its slot.
+        """
+        result = []
+        if not self.prefetch_depth:
+            return result
+        queue_names = ['vcpu-only']
+        if not (self.waiting_real_cpu_tasks or self.tasks_queues['real-cpu']):
+            queue_names.append('any-cpu')
+        while True:
+            task = self._chooseVirtualCpuTask()
+            if task is None:
+                break
+            for queue_name in queue_names:
+                worker = self._getBestWorkerForVirtualCpuTask(
+                    self.prefetch_queues[queue_name], task
+                )
+                if worker is not None:
+                    break
+            if worker is None:
+                break
+            worker = self._preferCachingWorker(task, worker, reserve=True)
+            if not self._respectsFastLaneReservation(task, worker):
+                break
+            self._removeTaskFromQueues(task)
+            task.reserved_worker = worker
+            self._removeWorkerFromQueue(worker)
+            worker.reserveTask(task)
+            self._insertWorkerToQueue(worker)
+            # The worker downloads the files to its cache.
+            self._addCachedFiles(worker, task.files)
+            result.append((task.id, worker.id))
+        return result
+
+
+class LongestFirstPrioritizingScheduler(PrioritizingScheduler):
+    """Runs the longest tasks of a group first (LPT), so that the whole
+    group is judged sooner."""
+
+    DURATION_ORDER = 'longest-first'
+
+
+class ShortestFirstPrioritizingScheduler(PrioritizingScheduler):
+    """Runs the shortest tasks of a group first, so that tasks wait
+    less on average."""
+
+    DURATION_ORDER = 'shortest-first'
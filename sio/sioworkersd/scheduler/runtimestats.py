@@ -0,0 +1,89 @@
+"""Statistics of task durations, for schedulers which order tasks by them.
+
+Durations are kept per job type and the main file of the task (the input
+file of exec jobs, the executable of ingen and the like), which identifies
+a test of a problem. For each such key only the most recent ``SAMPLES``
+durations are kept, in a fixed-size array, and only the ``MAX_KEYS``
+most recently used keys are kept at all.
+"""
+
+from __future__ import absolute_import
+from array import array
+from collections import OrderedDict
+
+
+class _RingBuffer(object):
+    """The last ``size`` values added, with their mean."""
+
+    def __init__(self, size):
+        self._values = array('d', [0.0] * size)
+        self._next = 0
+        self._count = 0
+        self._total = 0.0
+
+    def add(self, value):
+        if self._count == len(self._values):
+            self._total -= self._values[self._next]
+        else:
+            self._count += 1
+        self._values[self._next] = value
+        self._total += value
+        self._next = (self._next + 1) % len(self._values)
+
+    def mean(self):
+        return self._total / self._count
+
+
+class RuntimeStatistics(object):
+    """Recent durations of tasks, fed with result envs of finished tasks."""
+
+    SAMPLES = 8
+    MAX_KEYS = 65536
+
+    def __init__(self):
+        # Map: key -> _RingBuffer, least recently used first
+        self._buffers = OrderedDict()
+
+    @staticmethod
+    def _getKey(env):
+        path = env.get('in_file') or env.get('exe_file')
+        if path is None:
+            return None
+        return env['job_type'], path
+
+    @staticmethod
+    def _getDuration(env):
+        """Returns the duration of a finished task in seconds, or None."""
+        # The wall clock time is what occupies the worker.
+        used = env.get('real_time_used', env.get('time_used'))
+        if used is None:
+            return None
+        return used / 1000.0
+
+    def addResult(self, env):
+        """Records the duration of a finished task."""
+        key = self._getKey(env)
+        duration = self._getDuration(env)
+        if key is None or duration is None:
+            return
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = _RingBuffer(self.SAMPLES)
+            if len(self._buffers) > self.MAX_KEYS:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(key)
+        buf.add(duration)
+
+    def estimate(self, env):
+        """Returns the expected duration of a task in seconds.
+
+        Tasks without statistics are assumed to take their time limit
+        (``exec_time_limit``, which is an upper bound), or 0 if they
+        have none.
+        """
+        key = self._getKey(env)
+        buf = self._buffers.get(key) if key is not None else None
+        if buf is not None:
+            return buf.mean()
+        return env.get('exec_time_limit', 0) / 1000.0
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 import random
 import unittest
 
-from sio.sioworkersd.scheduler import prioritizing
+from sio.sioworkersd.scheduler import prioritizing, runtimestats
 import six
 from six.moves import range
 
@@ -134,6 +134,110 @@ class WorkerInfoTest(unittest.TestCase):
         self.assertEqual(worker.getAvailableVcpuSlots(), 2)
 
 
+class WorkersQueueTest(unittest.TestCase):
+    @staticmethod
+    def _linear_choice(queue, task, prefer_busy):
+        # The original linear scan of the whole queue.
+        def suitability(worker):
+            worker_optimal_ram = (
+                worker.getAvailableRam() / worker.getAvailableVcpuSlots()
+            )
+            difference = abs(
+                worker_optimal_ram - task.required_ram_mb / worker.getTaskSlots(task)
+            )
+            if prefer_busy:
+                return worker.running_tasks > 0, -difference
+            else:
+                return -difference
+
+        best = None
+        for worker in queue:
+            if worker.canRunVirtualCpuTask(task) and (
+                best is None or suitability(worker) > suitability(best)
+            ):
+                best = worker
+        return best
+
+    def test_should_choose_same_workers_as_linear_scan(self):
+        rand = random.Random(0)
+        for key in [
+            lambda w: w.id,
+            lambda w: (w.running_tasks > 0, w.getAvailableRam(), w.id),
+        ]:
+            queue = prioritizing._WorkersQueue(key=key)
+            for i in range(200):
+                worker = create_worker_info(
+                    id=i,
+                    concurrency=rand.randint(1, 8),
+                    ram=rand.choice([1024, 2048, 3000, 4096, 8192]),
+                )
+                for _ in range(rand.randint(0, worker.concurrency - 1)):
+                    ram = rand.choice([64, 256, 300, 512])
+                    if worker.getAvailableRam() >= ram:
+                        worker.attachTask(create_task_info(ram=ram))
+                queue.add(worker)
+            for _ in range(500):
+                task_ram = rand.choice([16, 64, 256, 300, 512, 1000, 1024, 4096])
+                prefer_busy = bool(rand.randint(0, 1))
+                task = create_task_info(ram=task_ram)
+                self.assertIs(
+                    queue.getBestWorkerForVirtualCpuTask(task, prefer_busy),
+                    self._linear_choice(queue, task, prefer_busy),
+                )
+                # Move a worker around, like the scheduler does.
+                worker = rand.choice(list(queue))
+                queue.remove(worker)
+                if worker.running_tasks and rand.randint(0, 1):
+                    worker.running_tasks -= 1
+                elif worker.running_tasks + 1 < worker.concurrency:
+                    worker.running_tasks += 1
+                queue.add(worker)
+
+
+    def test_should_choose_same_workers_as_linear_scan_with_cpu_shares(self):
+        rand = random.Random(0)
+        contest = create_contest_info()
+
+        def random_task():
+            job_type = rand.choice(['vcpu-exec', 'compile', 'ingen'])
+            env = {'task_id': 0, 'job_type': job_type}
+            env['exec_mem_limit'] = rand.choice([64, 256, 512, 1000]) * 1024
+            return prioritizing.TaskInfo(env, contest)
+
+        queue = prioritizing._WorkersQueue(key=lambda w: w.id)
+        tasks = {}  # Map: worker -> attached tasks
+        for i in range(200):
+            worker = create_worker_info(
+                id=i,
+                concurrency=rand.randint(1, 8),
+                ram=rand.choice([1024, 2048, 4096, 8192]),
+                cpu_shares=rand.choice([None, 2, 4, 8]),
+                disk=rand.choice([None, 1024, 2048]),
+            )
+            tasks[worker] = []
+            queue.add(worker)
+        for _ in range(1000):
+            task = random_task()
+            prefer_busy = bool(rand.randint(0, 1))
+            best = queue.getBestWorkerForVirtualCpuTask(task, prefer_busy)
+            self.assertIs(best, self._linear_choice(queue, task, prefer_busy))
+            # Detach a task, or attach this one, like the scheduler does.
+            worker = rand.choice(list(tasks))
+            if tasks[worker] and rand.randint(0, 1):
+                if worker.getQueueName() is not None:
+                    queue.remove(worker)
+                worker.detachTask(tasks[worker].pop())
+            elif best is not None:
+                worker = best
+                queue.remove(worker)
+                worker.attachTask(task)
+                tasks[worker].append(task)
+            else:
+                continue
+            if worker.getQueueName() is not None:
+                queue.add(worker)
+
+
 class TasksQueuesTest(unittest.TestCase):
     def test_should_prefer_tasks_from_higher_priority_contests(self):
         contest_1 = create_contest_info(id=1, priority=5)
@@ -193,6 +297,99 @@ class TasksQueuesTest(unittest.TestCase):
         self.assertGreater(tasks_from_2, 0)
         self.assertGreater(tasks_from_2, 2 * tasks_from_1)
 
+    def test_choose_tasks_should_take_best_tasks_of_one_contest(self):
+        contest_1 = create_contest_info(id=1, priority=5)
+        contest_2 = create_contest_info(id=2, priority=10)
+        tasks = [create_task_info(contest=contest_2, priority=i) for i in range(5)]
+
+        queues = prioritizing.TasksQueues(random.Random())
+        queues.addTask(create_task_info(contest=contest_1, priority=100))
+        for task in tasks:
+            queues.addTask(task)
+
+        self.assertEqual(queues.chooseTasks(3), tasks[:1:-1])
+        self.assertEqual(queues.chooseTasks(10), tasks[::-1])
+
+    def test_should_follow_contest_updates(self):
+        contest_1 = create_contest_info(id=1, priority=5, weight=1)
+        contest_2 = create_contest_info(id=2, priority=10, weight=1)
+        task_1 = create_task_info(contest=contest_1)
+        task_2 = create_task_info(contest=contest_2)
+
+        queues = prioritizing.TasksQueues(random.Random())
+        queues.addTask(task_1)
+        queues.addTask(task_2)
+        self.assertEqual(queues.chooseTask(), task_2)
+
+        contest_1.priority = 20
+        queues.updateContest(contest_1)
+        self.assertEqual(queues.chooseTask(), task_1)
+
+        # Weights of contests with lower priority don't matter.
+        contest_2.weight = 10 ** 9
+        queues.updateContest(contest_2)
+        self.assertEqual(queues.chooseTask(), task_1)
+
+    def test_should_choose_same_contests_as_linear_scan(self):
+        def linear_choice(queues, rand):
+            max_priority = max(c.priority for c in queues.queues)
+            contests = [c for c in queues.queues if c.priority == max_priority]
+            value = rand.randint(1, sum(c.weight for c in contests))
+            for contest in contests:
+                value -= contest.weight
+                if value <= 0:
+                    return queues.queues[contest][-1]
+
+        rand = random.Random(0)
+        contests = [
+            create_contest_info(
+                id=i, priority=rand.randint(0, 2), weight=rand.randint(1, 100)
+            )
+            for i in range(50)
+        ]
+        queues = prioritizing.TasksQueues(random.Random(1))
+        reference = random.Random(1)
+        tasks = []
+        for _ in range(2000):
+            if tasks and rand.random() < 0.45:
+                queues.delTask(tasks.pop(rand.randrange(len(tasks))))
+            else:
+                task = create_task_info(contest=rand.choice(contests))
+                queues.addTask(task)
+                tasks.append(task)
+            if tasks:
+                expected = linear_choice(queues, reference)
+                self.assertIs(queues.chooseTask(), expected)
+
+
+class RuntimeStatisticsTest(unittest.TestCase):
+    def test_should_average_recent_durations(self):
+        stats = runtimestats.RuntimeStatistics()
+        stats.SAMPLES = 2
+        env = {'job_type': 'vcpu-exec', 'in_file': '/in', 'exec_time_limit': 5000}
+        self.assertEqual(stats.estimate(env), 5)
+        self.assertEqual(stats.estimate({'job_type': 'compile'}), 0)
+
+        stats.addResult(dict(env, time_used=1000))
+        self.assertEqual(stats.estimate(env), 1)
+        stats.addResult(dict(env, time_used=1000, real_time_used=2000))
+        self.assertEqual(stats.estimate(env), 1.5)
+        stats.addResult(dict(env, time_used=4000))
+        self.assertEqual(stats.estimate(env), 3)
+        # Other tests and job types are separate.
+        self.assertEqual(stats.estimate(dict(env, in_file='/in2')), 5)
+        self.assertEqual(stats.estimate(dict(env, job_type='cpu-exec')), 5)
+
+    def test_should_forget_least_recently_used_keys(self):
+        stats = runtimestats.RuntimeStatistics()
+        stats.MAX_KEYS = 2
+        for path in ['/a', '/b', '/a', '/c']:
+            stats.addResult({'job_type': 'ingen', 'exe_file': path, 'time_used': 1})
+        self.assertEqual(stats.estimate({'job_type': 'ingen', 'exe_file': '/b'}), 0)
+        self.assertNotEqual(
+            stats.estimate({'job_type': 'ingen', 'exe_file': '/a'}), 0
+        )
+
 
 class PrioritizingSchedulerTest(unittest.TestCase):
     def test_should_prefer_vcpu_only_workers_for_virtual_cpu_tasks(self):
@@ -428,6 +625,481 @@ class PrioritizingSchedulerTest(unittest.TestCase):
         # Now it should be OK.
         self.assertEqual(len(scheduled_tasks), 2)
 
+    def test_scheduling_should_respect_blocking(self):
+        workers = [
+            {'id': i, 'concurrency': 2, 'ram': 4096, 'is_real_cpu': True}
+            for i in range(1, 4)
+        ]
+        scheduler = prioritizing.PrioritizingScheduler(WorkerManagerStub(*workers))
+        for worker in workers:
+            scheduler.addWorker(worker['id'])
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        passes = []
+        for i in range(1, 4):
+            add_task_to_scheduler(scheduler, i, is_real_cpu=False)
+        passes.append(sorted(scheduler.schedule()))
+        # The real-cpu tasks block the partially busy workers.
+        for i in range(4, 7):
+            add_task_to_scheduler(scheduler, i, is_real_cpu=True)
+        for i in range(7, 10):
+            add_task_to_scheduler(scheduler, i, is_real_cpu=False)
+        passes.append(sorted(scheduler.schedule()))
+        for i in range(1, 4):
+            scheduler.delTask(i)
+        passes.append(sorted(scheduler.schedule()))
+        # Tasks 5 and 6 wait for workers 1 and 2, so tasks 7-9 aren't run.
+        self.assertEqual(passes, [[(1, 1), (2, 1), (3, 2)], [(4, 3)], [(5, 1), (6, 2)]])
+
+    def test_batch_scheduling_should_assign_same_tasks(self):
+        def run(batch_min_free_slots):
+            # Six vcpu-only workers and two any-cpu ones, each of which can
+            # fit any four tasks.
+            workers = [
+                {'id': i, 'concurrency': 4, 'ram': 4096, 'is_real_cpu': i > 6}
+                for i in range(1, 9)
+            ]
+            scheduler = prioritizing.PrioritizingScheduler(WorkerManagerStub(*workers))
+            scheduler.BATCH_SCHEDULING_MIN_FREE_SLOTS = batch_min_free_slots
+            for worker in workers:
+                scheduler.addWorker(worker['id'])
+            scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+            updates = []
+            remove = scheduler._removeWorkerFromQueue
+            scheduler._removeWorkerFromQueue = lambda w: updates.append(w) or remove(w)
+
+            passes = []
+            for i in range(1, 51):
+                add_task_to_scheduler(
+                    scheduler,
+                    i,
+                    is_real_cpu=i % 10 == 0,
+                    ram=[256, 512, 1024][i % 3],
+                    priority=i % 4,
+                )
+            passes.append(sorted(task for task, _ in scheduler.schedule()))
+            for task in passes[0][:10]:
+                scheduler.delTask(task)
+            passes.append(sorted(task for task, _ in scheduler.schedule()))
+            return passes, len(updates)
+
+        passes, updates = run(10**9)
+        batch_passes, batch_updates = run(0)
+        self.assertEqual(batch_passes, passes)
+        self.assertLess(batch_updates, updates)
+
+    def test_blocked_workers_should_follow_workers_and_waiting_tasks(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub(
+                {'id': 1, 'ram': 512, 'is_real_cpu': True},
+                {'id': 2, 'ram': 2048, 'is_real_cpu': True},
+                {'id': 3, 'ram': 8192, 'is_real_cpu': True},
+                {'id': 4, 'ram': 256, 'is_real_cpu': False},
+            )
+        )
+        for worker_id in range(1, 5):
+            scheduler.addWorker(worker_id)
+        self.assertEqual(scheduler.any_cpu_workers_ram, [512, 2048, 8192])
+
+        task_1 = create_task_info(ram=1024, is_real_cpu=True)
+        task_2 = create_task_info(ram=1024, is_real_cpu=True)
+        scheduler.waiting_real_cpu_tasks.add(task_1)
+        scheduler.waiting_real_cpu_tasks.add(task_2)
+        # The 512 MiB worker can't run any of the tasks.
+        self.assertEqual(scheduler._getNumberOfBlockedAnyCpuWorkers(), 3)
+
+        scheduler.delWorker(3)
+        self.assertEqual(scheduler._getNumberOfBlockedAnyCpuWorkers(), 2)
+
+        scheduler.waiting_real_cpu_tasks.remove(task_2)
+        self.assertEqual(scheduler._getNumberOfBlockedAnyCpuWorkers(), 2)
+
+        scheduler.delWorker(1)
+        self.assertEqual(scheduler._getNumberOfBlockedAnyCpuWorkers(), 1)
+
+    def test_should_prefer_workers_with_cached_files(self):
+        manager = WorkerManagerStub(
+            {'id': 1, 'concurrency': 2},
+            {'id': 2, 'concurrency': 2, 'cached_files': ['/in']},
+            {'id': 3, 'concurrency': 2, 'cached_files': ['/in', '/chk']},
+        )
+        scheduler = prioritizing.PrioritizingScheduler(manager)
+        for worker_id in range(1, 4):
+            scheduler.addWorker(worker_id)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        def add_task(id, **files):
+            env = {'task_id': id, 'contest_uid': 1, 'job_type': 'vcpu-exec'}
+            env.update(files)
+            scheduler.addTask(env)
+            return scheduler.schedule()
+
+        self.assertEqual(add_task(1), [(1, 1)])
+        # Worker 2 would be chosen otherwise.
+        self.assertEqual(add_task(2, chk_file='/chk'), [(2, 3)])
+        # Ties are resolved in favour of the usual choice.
+        self.assertEqual(add_task(3, in_file='/in'), [(3, 2)])
+        self.assertEqual(add_task(4, exe_file='/exe'), [(4, 1)])
+        # Files of assigned tasks are assumed to be cached.
+        self.assertEqual(scheduler.file_locations['/exe'], {scheduler.workers[1]})
+        scheduler.delTask(1)
+        self.assertEqual(add_task(5, chk_file='/chk'), [(5, 3)])
+
+        for task_id in range(2, 6):
+            scheduler.delTask(task_id)
+        manager.getWorkers()[1].cached_files = {'/in'}
+        scheduler.updateWorkerCache(1)
+        self.assertNotIn('/exe', scheduler.file_locations)
+        self.assertEqual(len(scheduler.file_locations['/in']), 3)
+
+        scheduler.delWorker(3)
+        self.assertNotIn('/chk', scheduler.file_locations)
+
+    def test_cached_files_should_not_override_ram_fit(self):
+        manager = WorkerManagerStub(
+            {'id': 1, 'concurrency': 2, 'ram': 1024},
+            {'id': 2, 'concurrency': 2, 'ram': 4096, 'cached_files': ['/in']},
+            {'id': 3, 'concurrency': 2, 'ram': 1024, 'cached_files': ['/chk']},
+        )
+        scheduler = prioritizing.PrioritizingScheduler(manager)
+        for worker_id in range(1, 4):
+            scheduler.addWorker(worker_id)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        def add_task(id, **files):
+            env = {
+                'task_id': id,
+                'contest_uid': 1,
+                'job_type': 'vcpu-exec',
+                'exec_mem_limit': 512 * 1024,
+            }
+            env.update(files)
+            scheduler.addTask(env)
+            return scheduler.schedule()
+
+        # Worker 2 has more RAM per slot than the task needs.
+        self.assertEqual(add_task(1, in_file='/in'), [(1, 1)])
+        self.assertEqual(add_task(2, chk_file='/chk'), [(2, 3)])
+
+    def test_degraded_workers_should_get_tasks_only_if_others_cannot(self):
+        manager = WorkerManagerStub(
+            {'id': 1, 'concurrency': 1},
+            {'id': 2, 'concurrency': 2, 'cached_files': ['/in'], 'rtt': 1.0},
+        )
+        scheduler = prioritizing.PrioritizingScheduler(manager, slow_rtt=0.5)
+        scheduler.addWorker(1)
+        scheduler.addWorker(2)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        def add_task(id, **files):
+            env = {'task_id': id, 'contest_uid': 1, 'job_type': 'vcpu-exec'}
+            env.update(files)
+            scheduler.addTask(env)
+            return scheduler.schedule()
+
+        # Worker 2 has the files, but its heartbeats are slow.
+        self.assertEqual(add_task(1, in_file='/in'), [(1, 1)])
+        self.assertEqual(add_task(2), [(2, 2)])
+
+        manager.getWorkers()[2].rtt = 0.1
+        scheduler.updateWorkerRtt(2)
+        scheduler.delTask(1)
+        # Worker 2 fits the task better now.
+        self.assertEqual(add_task(3, in_file='/in'), [(3, 2)])
+
+    def test_cached_files_should_not_take_empty_any_cpu_workers(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub(
+                {'id': 1, 'is_real_cpu': True},
+                {'id': 2, 'is_real_cpu': True, 'cached_files': ['/in']},
+            )
+        )
+        scheduler.addWorker(1)
+        scheduler.addWorker(2)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        add_task_to_scheduler(scheduler, 1, is_real_cpu=False)
+        self.assertEqual(scheduler.schedule(), [(1, 1)])
+        scheduler.addTask(
+            {'task_id': 2, 'contest_uid': 1, 'job_type': 'vcpu-exec', 'in_file': '/in'}
+        )
+        self.assertEqual(scheduler.schedule(), [(2, 1)])
+        # Real-cpu tasks need an empty worker anyway.
+        scheduler.addTask(
+            {'task_id': 3, 'contest_uid': 1, 'job_type': 'cpu-exec', 'in_file': '/in'}
+        )
+        self.assertEqual(scheduler.schedule(), [(3, 2)])
+
+    def _run_backfilled(self, backfill):
+        class Clock(object):
+            now = 100.0
+
+            def seconds(self):
+                return self.now
+
+        clock = Clock()
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub({'id': 1, 'is_real_cpu': True}),
+            backfill=backfill,
+            clock=clock,
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+
+        def add_task(id, job_type='vcpu-exec', **limits):
+            env = {'task_id': id, 'contest_uid': 1, 'job_type': job_type}
+            env.update(limits)
+            scheduler.addTask(env)
+            return scheduler.schedule()
+
+        passes = [add_task(1, exec_time_limit=10000)]
+        clock.now += 5
+        # The worker is blocked for this task.
+        passes.append(add_task(2, job_type='cpu-exec'))
+        passes.append(add_task(3, exec_time_limit=5000))
+        # This one would end after task 1.
+        passes.append(add_task(4, exec_time_limit=5001))
+        scheduler.delTask(4)
+        passes.append(add_task(5, job_type='compile'))
+        scheduler.delTask(5)
+        passes.append(add_task(6))
+        return passes
+
+    def test_should_backfill_blocked_workers_if_enabled(self):
+        self.assertEqual(
+            self._run_backfilled(backfill=False), [[(1, 1)], [], [], [], [], []]
+        )
+        self.assertEqual(
+            self._run_backfilled(backfill=True),
+            [[(1, 1)], [], [(3, 1)], [], [], []],
+        )
+
+    def test_should_pack_tasks_by_cpu_shares_and_disk(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub({'id': 1, 'cpu_shares': 4, 'disk': 1024})
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        for id, job_type in enumerate(['compile', 'compile', 'exec', 'ingen'], 1):
+            scheduler.addTask({'task_id': id, 'contest_uid': 1, 'job_type': job_type})
+
+        # Two compilations take all the shares.
+        self.assertEqual(sorted(scheduler.schedule()), [(1, 1), (2, 1)])
+        scheduler.delTask(1)
+        self.assertEqual(scheduler.schedule(), [(3, 1)])
+        scheduler.delTask(2)
+        # The input generator needs all the disk space.
+        self.assertEqual(scheduler.schedule(), [])
+        scheduler.delTask(3)
+        self.assertEqual(scheduler.schedule(), [(4, 1)])
+
+    def test_should_run_real_cpu_tasks_on_dedicated_cores_alongside_others(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub(
+                {'id': 1, 'concurrency': 2, 'is_real_cpu': True, 'cpu_exec_slots': 1}
+            )
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        add_task_to_scheduler(scheduler, 1, is_real_cpu=False)
+        add_task_to_scheduler(scheduler, 2, is_real_cpu=True)
+        add_task_to_scheduler(scheduler, 3, is_real_cpu=True)
+        add_task_to_scheduler(scheduler, 4, is_real_cpu=False)
+        add_task_to_scheduler(scheduler, 5, is_real_cpu=False)
+
+        self.assertEqual(sorted(scheduler.schedule()), [(1, 1), (2, 1), (4, 1)])
+        scheduler.delTask(2)
+        self.assertEqual(scheduler.schedule(), [(3, 1)])
+        scheduler.delTask(1)
+        self.assertEqual(scheduler.schedule(), [(5, 1)])
+
+    def test_should_schedule_fast_lane_tasks_first(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub({'id': 1, 'concurrency': 1}), fast_lane=['compile']
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        add_task_to_scheduler(scheduler, 1, is_real_cpu=False, priority=10)
+        add_task_to_scheduler(scheduler, 2, is_real_cpu=False, priority=10)
+        scheduler.addTask({'task_id': 3, 'contest_uid': 1, 'job_type': 'compile'})
+
+        self.assertEqual(scheduler.getTaskClass({'job_type': 'compile'}), 'fast-lane')
+        self.assertEqual(scheduler.getTaskClass({'job_type': 'exec'}), 'default')
+        self.assertEqual(scheduler.schedule(), [(3, 1)])
+        scheduler.delTask(3)
+        self.assertEqual(scheduler.schedule(), [(1, 1)])
+
+    def test_should_reserve_slots_for_fast_lane(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub({'id': 1, 'concurrency': 4}),
+            fast_lane=['compile'],
+            fast_lane_share=0.5,
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        for id in range(1, 5):
+            add_task_to_scheduler(scheduler, id, is_real_cpu=False)
+        scheduler.addTask({'task_id': 5, 'contest_uid': 1, 'job_type': 'compile'})
+
+        # Two slots are reserved, one of them is taken by the compilation.
+        self.assertEqual(sorted(scheduler.schedule()), [(1, 1), (2, 1), (5, 1)])
+        scheduler.delTask(5)
+        self.assertEqual(scheduler.schedule(), [])
+        scheduler.addTask({'task_id': 6, 'contest_uid': 1, 'job_type': 'compile'})
+        self.assertEqual(scheduler.schedule(), [(6, 1)])
+
+    def test_reattached_tasks_should_take_slots_of_worker(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub({'id': 1, 'concurrency': 2})
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        scheduler.reattachTask(
+            {'task_id': 1, 'contest_uid': 1, 'job_type': 'vcpu-exec'}, 1
+        )
+        add_task_to_scheduler(scheduler, 2, is_real_cpu=False)
+        add_task_to_scheduler(scheduler, 3, is_real_cpu=False)
+
+        self.assertEqual(scheduler.schedule(), [(2, 1)])
+        scheduler.delTask(1)
+        self.assertEqual(scheduler.schedule(), [(3, 1)])
+        scheduler.delTask(2)
+        scheduler.delTask(3)
+        scheduler.delWorker(1)
+
+    def test_should_prefetch_tasks_for_busy_workers(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub(
+                {'id': 1, 'concurrency': 2, 'ram': 2048, 'can_queue': True}
+            ),
+            prefetch_depth=1,
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        for id in range(1, 6):
+            add_task_to_scheduler(scheduler, id, is_real_cpu=False, priority=-id)
+
+        self.assertEqual(scheduler.prefetch(), [])
+        self.assertEqual(sorted(scheduler.schedule()), [(1, 1), (2, 1)])
+        self.assertEqual(scheduler.prefetch(), [(3, 1), (4, 1)])
+        self.assertEqual(scheduler.workers[1].getAvailableRam(), 1024)
+        # Reserved tasks take the slots of the running ones.
+        scheduler.delTask(1)
+        self.assertEqual(scheduler.schedule(), [])
+        self.assertEqual(scheduler.prefetch(), [(5, 1)])
+        scheduler.delTask(4)
+        scheduler.delTask(2)
+        scheduler.delTask(3)
+        self.assertEqual(scheduler.workers[1].running_tasks, 1)
+        add_task_to_scheduler(scheduler, 6, is_real_cpu=False, ram=1024)
+        self.assertEqual(scheduler.schedule(), [(6, 1)])
+        # The worker has no RAM left for another task.
+        add_task_to_scheduler(scheduler, 7, is_real_cpu=False, ram=1024)
+        self.assertEqual(scheduler.prefetch(), [])
+        scheduler.delTask(5)
+        scheduler.delTask(6)
+        self.assertEqual(scheduler.schedule(), [(7, 1)])
+
+    def test_should_prefetch_tasks_for_best_fitting_workers(self):
+        manager = WorkerManagerStub(
+            {'id': 1, 'concurrency': 1, 'ram': 4096, 'can_queue': True},
+            {'id': 2, 'concurrency': 1, 'ram': 1024, 'can_queue': True},
+            {
+                'id': 3,
+                'concurrency': 1,
+                'ram': 1024,
+                'can_queue': True,
+                'cached_files': ['/in'],
+            },
+        )
+        scheduler = prioritizing.PrioritizingScheduler(manager, prefetch_depth=1)
+        for worker_id in range(1, 4):
+            scheduler.addWorker(worker_id)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        for id in range(1, 4):
+            add_task_to_scheduler(scheduler, id, is_real_cpu=False)
+        self.assertEqual(len(scheduler.schedule()), 3)
+
+        def add_task(id, **files):
+            env = {
+                'task_id': id,
+                'contest_uid': 1,
+                'job_type': 'vcpu-exec',
+                'exec_mem_limit': 512 * 1024,
+            }
+            env.update(files)
+            scheduler.addTask(env)
+            return scheduler.prefetch()
+
+        # Worker 2 would be chosen otherwise.
+        self.assertEqual(add_task(4, in_file='/in'), [(4, 3)])
+        self.assertEqual(add_task(5), [(5, 2)])
+        self.assertEqual(add_task(6), [(6, 1)])
+        self.assertEqual(add_task(7), [])
+
+    def test_should_not_prefetch_tasks_for_workers_which_cant_queue_them(self):
+        scheduler = prioritizing.PrioritizingScheduler(
+            WorkerManagerStub({'id': 1, 'concurrency': 1}), prefetch_depth=1
+        )
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        add_task_to_scheduler(scheduler, 1, is_real_cpu=False)
+        add_task_to_scheduler(scheduler, 2, is_real_cpu=False)
+
+        self.assertEqual(scheduler.schedule(), [(1, 1)])
+        self.assertEqual(scheduler.prefetch(), [])
+
+    def _run_duration_ordered(self, scheduler_class):
+        scheduler = scheduler_class(WorkerManagerStub({'id': 1, 'concurrency': 1}))
+        scheduler.addWorker(1)
+        scheduler.updateContest(contest_uid=1, priority=10, weight=10)
+        for path, duration in [('/short', 100), ('/long', 3000), ('/mid', 1000)]:
+            scheduler.taskFinished(
+                {'job_type': 'vcpu-exec', 'in_file': path, 'time_used': duration}
+            )
+
+        def add_task(id, group_id, path):
+            scheduler.addTask(
+                {
+                    'task_id': id,
+                    'group_id': group_id,
+                    'contest_uid': 1,
+                    'job_type': 'vcpu-exec',
+                    'in_file': path,
+                }
+            )
+
+        add_task(1, 'g1', '/short')
+        add_task(2, 'g1', '/long')
+        add_task(3, 'g1', '/mid')
+        add_task(4, 'g2', '/long')
+        order = []
+        for _ in range(4):
+            [(task_id, _)] = scheduler.schedule()
+            order.append(task_id)
+            scheduler.delTask(task_id)
+        self.assertEqual(scheduler.groups, {})
+        return order
+
+    def test_should_order_tasks_of_a_group_by_duration_if_enabled(self):
+        self.assertEqual(
+            self._run_duration_ordered(prioritizing.PrioritizingScheduler),
+            [1, 2, 3, 4],
+        )
+        # Groups are still judged in arrival order.
+        self.assertEqual(
+            self._run_duration_ordered(
+                prioritizing.LongestFirstPrioritizingScheduler
+            ),
+            [2, 3, 1, 4],
+        )
+        self.assertEqual(
+            self._run_duration_ordered(
+                prioritizing.ShortestFirstPrioritizingScheduler
+            ),
+            [1, 3, 2, 4],
+        )
+
 
 class WorkerManagerStub(object):
     class WorkerDataStub(object):
@@ -435,8 +1107,14 @@ class WorkerManagerStub(object):
             self.concurrency = wdata.get('concurrency', 4)
             self.available_ram_mb = wdata.get('ram', 4096)
             self.can_run_cpu_exec = wdata.get('is_real_cpu', False)
+            self.cpu_exec_slots = wdata.get('cpu_exec_slots', 0)
+            self.cpu_shares = wdata.get('cpu_shares')
+            self.scratch_disk_mb = wdata.get('disk')
             self.is_running_cpu_exec = False
             self.tasks = []
+            self.cached_files = set(wdata.get('cached_files', ()))
+            self.can_queue = wdata.get('can_queue', False)
+            self.rtt = wdata.get('rtt')
 
     def __init__(self, *workers):
         self.workerData = {
@@ -465,14 +1143,21 @@ class WorkerManagerStub(object):
         return self.workerData
 
 
-def create_worker_info(id=0, concurrency=4, ram=4096, is_real_cpu=False):
+def create_worker_info(
+    id=0, concurrency=4, ram=4096, is_real_cpu=False, cpu_shares=None, disk=None
+):
     class WorkerDataStub(object):
         def __init__(self):
             self.concurrency = concurrency
             self.available_ram_mb = ram
             self.can_run_cpu_exec = is_real_cpu
+            self.cpu_exec_slots = 0
+            self.cpu_shares = cpu_shares
+            self.scratch_disk_mb = disk
             self.is_running_cpu_exec = False
             self.tasks = []
+            self.cached_files = set()
+            self.can_queue = False
 
     return prioritizing.WorkerInfo(id, WorkerDataStub())
 
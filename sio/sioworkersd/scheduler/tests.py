@@ -1,141 +1,31 @@
 # pylint: disable=no-name-in-module
 from __future__ import absolute_import
 from __future__ import print_function
-from random import Random
 import importlib
 
-from sio.assertion_utils import eq_
-
-from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
-from sio.sioworkersd.scheduler.prioritizing import PrioritizingScheduler
+from sio.sioworkersd.scheduler import benchmark, getDefaultSchedulerClassName
+from sio.sioworkersd.scheduler.prioritizing import (
+    LongestFirstPrioritizingScheduler,
+    PrioritizingScheduler,
+    ShortestFirstPrioritizingScheduler,
+)
+from sio.sioworkersd.scheduler.stubs import Manager
 import six
 
-# Constructors of all schedulers, used in generic tests.
-schedulers = [PrioritizingScheduler]
-
-# Worker class copied from manager.py to keep this test twisted-free :-)
-class Worker(object):
-    """Information about a worker.
-    ``info``: clientInfo dictionary, passed from worker
-        (see sio.protocol.worker.WorkerProtocol.getHelloData)
-    ``tasks``: set() of currently executing ``task_id``s
-    ``is_running_cpu_exec``: bool, True if the worker is running cpu-exec job
-    """
-
-    def __init__(self, info, tasks, can_run_cpu_exec=True):
-        self.info = info
-        self.tasks = tasks
-        self.is_running_cpu_exec = False
-        self.count_cpu_exec = 0
-        self.concurrency = int(info.get('concurrency', 1))
-        # These old tests don't account for RAM, so we just put a large value.
-        self.available_ram_mb = 8192
-        self.can_run_cpu_exec = can_run_cpu_exec
-
-    def printInfo(self):
-        print('%s, %s' % (str(self.info), str(self.tasks)))
-
-
-# --------------------------------------------------------------------------#
 
+class BatchPrioritizingScheduler(PrioritizingScheduler):
+    """Always assigns tasks to vcpu-only workers in batches."""
 
-class Manager(object):
-    def __init__(self):
-        self.contests = dict()
-        self.workers = dict()
-        self.tasks = dict()
-        self.scheduler = None
-        self.random = Random(0)
-
-        # The tests here don't account for memory limits, so we just put
-        # some bogus values.
-        self.minAnyCpuWorkerRam = 4096
-        self.maxAnyCpuWorkerRam = 4096
-        self.minVcpuOnlyWorkerRam = 4096
-        self.maxVcpuOnlyWorkerRam = 4096
-
-    def _assignTaskToWorker(self, wid, task):
-        assert task['assigned_worker_id'] is None
-        task['assigned_worker_id'] = wid
-        if task['job_type'] == 'cpu-exec':
-            self.workers[wid].count_cpu_exec += 1
-            self.workers[wid].is_running_cpu_exec = True
-        self.workers[wid].tasks.append(task['task_id'])
-
-    def _checkInnerState(self):
-        for wid, w in six.iteritems(self.workers):
-            if len(w.tasks) > w.info['concurrency']:
-                return 'Worker %s has too many jobs - can have %s and has %d' % (
-                    str(wid),
-                    str(w.info['concurrency']),
-                    len(w.tasks),
-                )
-            if (
-                any([self.tasks[t]['job_type'] == 'cpu-exec' for t in w.tasks])
-                and len(w.tasks) > 1
-            ):
-                return 'Worker %s is running cpu-exec task and other task' % str(wid)
-        return 'OK'
-
-    def _showInnerState(self):
-        for wid, w in six.iteritems(self.workers):
-            print(
-                'Worker (id: %d, concurr: %d) does %s'
-                % (wid, w.info['concurrency'], w.tasks)
-            )
+    BATCH_SCHEDULING_MIN_FREE_SLOTS = 0
 
-    def getWorkers(self):
-        return self.workers
 
-    def setScheduler(self, scheduler):
-        self.scheduler = scheduler
-
-    def updateContest(self, contest_uid, priority, weight):
-        self.contests[contest_uid] = (priority, priority)
-        self.scheduler.updateContest(contest_uid, priority, weight)
-
-    def addWorker(self, wid, conc, can_run_cpu_exec=True):
-        self.workers[wid] = Worker(
-            {'concurrency': conc}, [], can_run_cpu_exec=can_run_cpu_exec
-        )
-        self.scheduler.addWorker(wid)
-
-    def delWorker(self, wid):
-        del self.workers[wid]
-        self.scheduler.delWorker(wid)
-
-    def addTask(self, tid, cpu_concerned, contest_uid=None, task_priority=0):
-        task = {
-            'task_id': tid,
-            'job_type': 'cpu-exec' if cpu_concerned else 'vcpu-exec',
-            'contest_uid': contest_uid,
-            'task_priority': task_priority,
-            'assigned_worker_id': None,
-        }
-        self.tasks[task['task_id']] = task
-        self.scheduler.addTask(task)
-
-    def completeOneTask(self, wid):
-        if self.workers[wid].tasks:
-            w_tasks = self.workers[wid].tasks
-            tid_position = self.random.randint(0, len(w_tasks) - 1)
-            # Swap with last element
-            w_tasks[tid_position], w_tasks[len(w_tasks) - 1] = (
-                w_tasks[len(w_tasks) - 1],
-                w_tasks[tid_position],
-            )
-            tid = w_tasks.pop()
-            self.workers[wid].count_cpu_exec -= 1
-            self.workers[wid].is_running_cpu_exec = self.workers[wid].count_cpu_exec > 0
-            del self.tasks[tid]
-            self.scheduler.delTask(tid)
-
-    def schedule(self):
-        res = self.scheduler.schedule()
-        for tid, wid in res:
-            assert tid in self.tasks
-            self._assignTaskToWorker(wid, self.tasks[tid])
-        eq_(self._checkInnerState(), 'OK')
+# Constructors of all schedulers, used in generic tests.
+schedulers = [
+    PrioritizingScheduler,
+    BatchPrioritizingScheduler,
+    LongestFirstPrioritizingScheduler,
+    ShortestFirstPrioritizingScheduler,
+]
 
 
 def testDefaultSchedulerExistence():
@@ -296,3 +186,20 @@ def testSmallRandom():
 def testBigRandom():
     _randomTesting1(PrioritizingScheduler, 10, 10 ** 3, 10 ** 3)
     _randomTesting1(PrioritizingScheduler, 10 ** 3, 10 ** 2, 10 ** 2)
+
+
+def testBenchmark():
+    for mk_sch in schedulers:
+        trace = benchmark.synthetic_trace(200, passes=50)
+        report = benchmark.run_benchmark(mk_sch, trace, check=True)
+        assert report['assignments'] > 0
+        assert report['schedule_calls'] == 50
+        assert report['peak_memory'] > 0
+
+
+def testSyntheticTraceChangesWorkersAndContests():
+    events = [event[0] for event in benchmark.synthetic_trace(200, passes=200)]
+    passes = events[events.index('schedule') :]
+    assert 'delWorker' in passes
+    assert 'addWorker' in passes
+    assert 'updateContest' in passes
@@ -30,6 +30,12 @@ class WorkerServer(rpc.WorkerRPC):
         log.info('{addr!s} connected, name: {name}', addr=addr, name=self.name)
         return self.factory.workerConnected(self)
 
+    def cmd_update_cache_summary(self, cached_files):
+        self.factory.manager.updateWorkerCache(self, cached_files)
+
+    def rttUpdated(self):
+        self.factory.manager.updateWorkerRtt(self, self.rtt)
+
     def connectionLost(self, reason):
         rpc.WorkerRPC.connectionLost(self, reason)
         self.factory.workerDisconnected(self)
@@ -44,10 +50,16 @@ class WorkerServerFactory(ServerFactory):
     protocol = WorkerServer
     workers = {}
 
-    def __init__(self, manager):
+    def __init__(self, manager, heartbeat_interval=rpc.DEFAULT_HEARTBEAT_INTERVAL):
         self.manager = manager
+        self.heartbeatInterval = heartbeat_interval
         self.ignore_set = set()
 
+    def buildProtocol(self, addr):
+        proto = ServerFactory.buildProtocol(self, addr)
+        proto.heartbeatInterval = self.heartbeatInterval
+        return proto
+
     @defer.inlineCallbacks
     def workerConnected(self, proto):
         self.workers[proto.uniqueID] = proto
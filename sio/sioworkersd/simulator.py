@@ -0,0 +1,408 @@
+"""Discrete-event simulator of a sioworkersd fleet.
+
+Runs the real :class:`~sio.sioworkersd.taskmanager.TaskManager`,
+:class:`~sio.sioworkersd.workermanager.WorkerManager` and scheduler on a
+simulated clock, with simulated workers instead of connected ones, and
+reports the latencies seen by the submissions. It is meant for capacity
+planning (how many workers are needed for a contest) and for evaluating
+scheduler changes offline.
+
+The simulation is described by three files:
+
+``workers``: a JSON list of worker definitions, in the format of the hello
+    data sent by workers (``concurrency``, ``available_ram_mb``,
+    ``can_run_cpu_exec`` and optionally ``cpu_exec_slots``), optionally with
+    ``name`` and ``count`` (the number of such workers, 1 by default)
+``submissions``: one JSON object per line, ``{"time": t, "group": env}``,
+    where ``t`` is the time of the submission (in seconds from the start
+    of the simulation) and ``env`` is a group env as passed to ``run_group``
+``history``: result envs of already judged tasks, one JSON object per
+    line, either a single result env or a group env with
+    ``workers_jobs.results`` (as returned to oioioi); task durations are
+    sampled from their ``real_time_used`` (or ``time_used``)
+
+For example::
+
+    python -m sio.sioworkersd.simulator --workers workers.json \\
+        --submissions submissions.jsonl --history results.jsonl
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import heapq
+import json
+import sys
+from collections import defaultdict
+from random import Random
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
+from sio.sioworkersd.scheduler.prioritizing import PrioritizingScheduler
+from sio.sioworkersd.taskmanager import TaskManager
+from sio.sioworkersd.utils import load_class
+from sio.sioworkersd.workermanager import WorkerManager
+import six
+
+# Duration (in seconds) of tasks of job types absent from the history.
+DEFAULT_TASK_DURATION = 1.0
+# Percentiles of latencies shown in the report.
+LATENCY_PERCENTILES = (50, 90, 99, 100)
+
+
+class DurationModel(object):
+    """Samples durations of tasks from historical result envs.
+
+    Durations are sampled from the results of the same job type. The wall
+    clock time (``real_time_used``) is preferred to the CPU time
+    (``time_used``), as it is the time for which the worker is occupied.
+    ``overhead`` (in seconds) is added to every duration, to account for
+    e.g. downloading files.
+    """
+
+    def __init__(
+        self, result_envs=(), default=DEFAULT_TASK_DURATION, overhead=0.0, seed=0
+    ):
+        self.default = default
+        self.overhead = overhead
+        self.random = Random(seed)
+        self._samples = defaultdict(list)  # Map: job_type -> [duration]
+        for env in result_envs:
+            self.addResult(env)
+
+    def addResult(self, env):
+        used = env.get('real_time_used', env.get('time_used'))
+        if used is None or 'job_type' not in env:
+            return
+        # Both are in milliseconds.
+        self._samples[env['job_type']].append(used / 1000.0)
+
+    def sample(self, task_env):
+        samples = self._samples.get(task_env['job_type'])
+        if samples:
+            duration = self.random.choice(samples)
+        else:
+            duration = self.default
+        return duration + self.overhead
+
+
+class SimulatedWorker(object):
+    """Stands in for the connection of a worker (see
+    :class:`sio.sioworkersd.server.WorkerServerProtocol`), running the
+    tasks for durations chosen by the simulation."""
+
+    def __init__(self, simulation, name, info):
+        self.simulation = simulation
+        self.name = name
+        self.clientInfo = info
+
+    def call(self, method, *args, **kwargs):
+        if method == 'get_running':
+            return defer.succeed([])
+        if method == 'run':
+            return self.simulation._runTask(self.name, args[0])
+        raise ValueError('Method %s is not simulated' % method)
+
+
+class Simulation(object):
+    """Simulates the judging of submissions by a fleet of workers."""
+
+    def __init__(
+        self,
+        workers,
+        durations,
+        scheduler_class=None,
+        max_task_ram_mb=None,
+        schedule_interval=0,
+        scheduler_options=None,
+    ):
+        if scheduler_class is None:
+            scheduler_class = load_class(getDefaultSchedulerClassName())
+        self.clock = Clock()
+        scheduler_options = dict(scheduler_options or {})
+        if issubclass(scheduler_class, PrioritizingScheduler):
+            scheduler_options['clock'] = self.clock
+        self.durations = durations
+        self.workerm = WorkerManager()
+        if max_task_ram_mb is None:
+            max_task_ram_mb = max(info['available_ram_mb'] for info in workers)
+        # Groups without return_url aren't stored, so the database is unused.
+        self.taskm = TaskManager(
+            ':memory:',
+            self.workerm,
+            scheduler_class(self.workerm, **scheduler_options),
+            max_task_ram_mb,
+            schedule_interval=schedule_interval,
+            clock=self.clock,
+        )
+        # Normally done in TaskManager.startService, which also resumes
+        # the groups from the database and needs a running reactor.
+        self.workerm.notifyOnNewWorker(self.taskm._newWorker)
+        self.workerm.notifyOnLostWorker(self.taskm._lostWorker)
+
+        self.slots = 0
+        for i, info in enumerate(workers):
+            name = info.get('name', 'worker%d' % i)
+            self.workerm.newWorker(i, SimulatedWorker(self, name, info))
+            self.slots += info['concurrency'] + info.get('cpu_exec_slots', 0)
+
+        # Heap of triples (time, number, group env) of future submissions.
+        # They are added to the clock only when it reaches them, as it
+        # keeps its calls in a sorted list.
+        self._submissions = []
+        self._groups_count = 0
+        self._groups_submitted = 0
+        self._submitted = {}  # Map: task_id -> time of the submission
+        self.queue_waits = []
+        self.class_queue_waits = {}  # Map: task class -> queue waits
+        self.group_latencies = []
+        self.rejected_groups = 0
+        self.busy_time = 0.0  # Sum of durations of the tasks
+        self.end_time = 0.0
+
+    def submit(self, time, group_env):
+        """Adds a group submitted at ``time``, like ``sync_run_group``."""
+        heapq.heappush(self._submissions, (time, self._groups_count, group_env))
+        self._groups_count += 1
+
+    def _submit(self, group_env):
+        now = self.clock.seconds()
+        # Returning the results isn't simulated.
+        group_env.pop('return_url', None)
+        group_id = 'GROUP_%d' % self._groups_submitted
+        self._groups_submitted += 1
+        group_env['group_id'] = group_id
+        for name, task in six.iteritems(group_env['workers_jobs']):
+            task['group_id'] = group_id
+            task['task_id'] = '%s/%s' % (group_id, name)
+            self._submitted[task['task_id']] = now
+        d = self.taskm.addTaskGroup(group_env)
+        d.addCallback(self._groupDone, now)
+
+    def _groupDone(self, group_env, submitted):
+        if 'error' in group_env:
+            self.rejected_groups += 1
+            for task in six.itervalues(group_env['workers_jobs']):
+                del self._submitted[task['task_id']]
+            return
+        self.end_time = self.clock.seconds()
+        self.group_latencies.append(self.end_time - submitted)
+
+    def _runTask(self, worker, task):
+        now = self.clock.seconds()
+        wait = now - self._submitted.pop(task['task_id'])
+        self.queue_waits.append(wait)
+        task_class = self.taskm.scheduler.getTaskClass(task)
+        self.class_queue_waits.setdefault(task_class, []).append(wait)
+        duration = self.durations.sample(task)
+        self.busy_time += duration
+        result = dict(task, result_code='OK', real_time_used=int(duration * 1000))
+        d = defer.Deferred()
+        self.clock.callLater(duration, d.callback, result)
+        return d
+
+    def run(self):
+        """Runs the simulation until all the submissions are judged."""
+        while self._submissions or self.clock.getDelayedCalls():
+            calls = self.clock.getDelayedCalls()
+            if self._submissions and (
+                not calls or self._submissions[0][0] <= calls[0].getTime()
+            ):
+                time, _, group_env = heapq.heappop(self._submissions)
+                self.clock.advance(max(0, time - self.clock.seconds()))
+                self._submit(group_env)
+            else:
+                self.clock.advance(max(0, calls[0].getTime() - self.clock.seconds()))
+        self.taskm.database.close()
+
+    def report(self):
+        """Returns a dict of the results, times are in seconds."""
+        if self.end_time and self.slots:
+            utilization = self.busy_time / (self.end_time * self.slots)
+        else:
+            utilization = None
+        return {
+            'groups': len(self.group_latencies),
+            'rejected_groups': self.rejected_groups,
+            'tasks': len(self.queue_waits),
+            'unfinished_tasks': len(self._submitted),
+            'end_time': self.end_time,
+            'utilization': utilization,
+            'queue_wait': _percentiles(self.queue_waits),
+            'class_queue_wait': {
+                task_class: _percentiles(waits)
+                for task_class, waits in six.iteritems(self.class_queue_waits)
+            },
+            'group_latency': _percentiles(self.group_latencies),
+            'scheduling_passes': self.taskm.schedulingPasses,
+        }
+
+
+def _percentiles(values):
+    values = sorted(values)
+    percentiles = {}
+    for p in LATENCY_PERCENTILES:
+        if values:
+            percentiles[p] = values[min(len(values) - 1, len(values) * p // 100)]
+        else:
+            percentiles[p] = None
+    return percentiles
+
+
+def read_workers(f):
+    """Reads worker definitions, expanding their ``count``s."""
+    workers = []
+    for i, definition in enumerate(json.load(f)):
+        definition = dict(definition)
+        count = definition.pop('count', 1)
+        name = definition.pop('name', 'worker%d' % i)
+        for j in range(count):
+            info = dict(definition)
+            info['name'] = name if count == 1 else '%s-%d' % (name, j)
+            workers.append(info)
+    return workers
+
+
+def _read_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_submissions(f):
+    """Reads pairs (time, group env) of a submission trace."""
+    for submission in _read_json_lines(f):
+        yield submission['time'], submission['group']
+
+
+def read_result_envs(f):
+    """Reads result envs, also from the results of groups."""
+    for env in _read_json_lines(f):
+        if 'workers_jobs.results' in env:
+            for result in six.itervalues(env['workers_jobs.results']):
+                yield result
+        else:
+            yield env
+
+
+def simulate(workers, submissions, durations, **kwargs):
+    """Runs a :class:`Simulation` of ``submissions`` (pairs (time, group
+    env)) and returns its report."""
+    simulation = Simulation(workers, durations, **kwargs)
+    for time, group_env in submissions:
+        simulation.submit(time, group_env)
+    simulation.run()
+    return simulation.report()
+
+
+def _format_percentiles(percentiles):
+    return ', '.join(
+        'p%d %.2f s' % (p, value)
+        for p, value in sorted(six.iteritems(percentiles))
+        if value is not None
+    )
+
+
+def _format_report(report):
+    lines = [
+        '%d groups (%d rejected), %d tasks judged in %.1f s'
+        % (
+            report['groups'],
+            report['rejected_groups'],
+            report['tasks'],
+            report['end_time'],
+        ),
+        '  queue wait: %s' % _format_percentiles(report['queue_wait']),
+    ]
+    if len(report['class_queue_wait']) > 1:
+        for task_class, percentiles in sorted(
+            six.iteritems(report['class_queue_wait'])
+        ):
+            lines.append('    %s: %s' % (task_class, _format_percentiles(percentiles)))
+    lines.append('  group latency: %s' % _format_percentiles(report['group_latency']))
+    if report['utilization'] is not None:
+        lines.append('  utilization: %.1f%%' % (report['utilization'] * 100))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', required=True, help='worker definitions')
+    parser.add_argument('--submissions', required=True, help='submission trace')
+    parser.add_argument('--history', help='historical result envs')
+    parser.add_argument(
+        '--scheduler',
+        default=getDefaultSchedulerClassName(),
+        help='dotted path of the scheduler class',
+    )
+    parser.add_argument(
+        '--max-task-ram',
+        type=int,
+        help='maximum RAM of a task in MiB (default: RAM of the largest worker)',
+    )
+    parser.add_argument(
+        '--default-duration',
+        type=float,
+        default=DEFAULT_TASK_DURATION,
+        help='duration of tasks of job types missing from the history',
+    )
+    parser.add_argument(
+        '--overhead', type=float, default=0.0, help='added to each task duration'
+    )
+    parser.add_argument(
+        '--backfill',
+        action='store_true',
+        help='backfill blocked any-cpu workers (PrioritizingScheduler only)',
+    )
+    parser.add_argument(
+        '--fast-lane',
+        help='comma-separated job types scheduled before the others '
+        '(PrioritizingScheduler only)',
+    )
+    parser.add_argument(
+        '--fast-lane-share',
+        type=float,
+        default=0,
+        help='fraction of vcpu slots reserved for the fast lane '
+        '(PrioritizingScheduler only)',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with open(args.workers) as f:
+        workers = read_workers(f)
+    result_envs = []
+    if args.history:
+        with open(args.history) as f:
+            result_envs = list(read_result_envs(f))
+    durations = DurationModel(
+        result_envs,
+        default=args.default_duration,
+        overhead=args.overhead,
+        seed=args.seed,
+    )
+    scheduler_options = {}
+    if args.backfill:
+        scheduler_options['backfill'] = True
+    if args.fast_lane:
+        scheduler_options['fast_lane'] = args.fast_lane.split(',')
+    if args.fast_lane_share:
+        scheduler_options['fast_lane_share'] = args.fast_lane_share
+    with open(args.submissions) as f:
+        report = simulate(
+            workers,
+            read_submissions(f),
+            durations,
+            scheduler_class=load_class(args.scheduler),
+            max_task_ram_mb=args.max_task_ram,
+            scheduler_options=scheduler_options,
+        )
+    print(_format_report(report))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
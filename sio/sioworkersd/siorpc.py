@@ -47,6 +47,7 @@ class SIORPC(XMLRPC):
                     'info': v.info,
                     'tasks': list(v.tasks),
                     'is_running_cpu_exec': v.is_running_cpu_exec,
+                    'rtt': v.rtt,
                 }
             )
         return ret
@@ -54,6 +55,17 @@ class SIORPC(XMLRPC):
     def xmlrpc_get_queue(self):
         return self.taskm.getQueue()
 
+    def xmlrpc_get_stats(self):
+        return self.taskm.getStats()
+
+    def xmlrpc_get_dead_letters(self):
+        return self.taskm.getDeadLetters()
+
+    @escape_arguments
+    def xmlrpc_replay_dead_letters(self, ids=None):
+        """Tries again to return the given dead letters, or all of them."""
+        return self.taskm.replayDeadLetters(ids)
+
     def _prepare_group(self, env):
         tasks = env['workers_jobs']
         group_id = 'GROUP_' + uuid4().urn
@@ -67,7 +79,16 @@ class SIORPC(XMLRPC):
         self._prepare_group(env)
         d = self.taskm.addTaskGroup(env)
         d.addBoth(self.taskm.returnToSio, url=env['return_url'], orig_env=env)
-        return env['group_id']
+        # Respond only when the group is safely stored, so that a server
+        # failure can't lose a group which oioioi believes was accepted.
+        sync = self.taskm.database.sync()
+        sync.addCallback(lambda _: env['group_id'])
+        return sync
+
+    def xmlrpc_cancel_group(self, group_id):
+        """Cancels a group added with run_group, which is then returned
+        with an error. Returns whether it was being judged."""
+        return self.taskm.cancelGroup(group_id)
 
     @escape_arguments
     def xmlrpc_sync_run_group(self, env):
@@ -2,40 +2,216 @@ from __future__ import absolute_import
 import traceback
 from twisted.application.service import Service
 from twisted.internet import defer, reactor
-from twisted.internet.task import deferLater, LoopingCall
+from twisted.internet.task import cooperate, deferLater, TaskFinished, TaskStopped
 from twisted.python.failure import Failure
 from twisted.web import client
 from twisted.web.http_headers import Headers
-from collections import namedtuple
-import json
+from collections import deque, namedtuple
+import gzip
+import heapq
+import random
 import six
-from six import BytesIO
+import six.moves.urllib.parse
 from six.moves import range
+import tempfile
 import time
-from operator import itemgetter
 from sio.protocol.rpc import RemoteError
+from sio.sioworkersd.database import SQLiteDatabase
 from sio.sioworkersd.utils import get_required_ram_for_job
 from sio.sioworkersd.workermanager import WorkerGone
-from sio.workers.util import json_dumps
+from sio.workers.util import CompatibleJSONEncoder
 from twisted.logger import Logger, LogLevel
-from urllib3 import encode_multipart_formdata
-
-
-import berkeleydb as bsddb
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
 
 log = Logger()
 
 Task = namedtuple('Task', 'env d')
 
+# Keys added to the group env while judging, which are stored separately
+# from the original env, see sio.sioworkersd.database.
+RESULT_KEYS = ('workers_jobs.results', 'error')
+
 MAX_RETRIES_OF_RESULT_RETURNING = 6
 # How many seconds wait between following retry attempts.
 RETRY_DELAY_OF_RESULT_RETURNING = [
     10 ** i for i in range(1, MAX_RETRIES_OF_RESULT_RETURNING + 1)
 ]
-DB_SYNC_INTERVAL_IN_SEC = 10
-# Should not be too small. We want to avoid lots of errors in case of server
-# failure.
-DB_SYNC_RESTART_INTERVAL_IN_SEC = 60 * 60
+# Retry delays are randomized by up to this fraction in both directions,
+# so that results which failed together aren't retried together.
+RETRY_JITTER_OF_RESULT_RETURNING = 0.5
+# After this many consecutive failures of returning to a host, no results
+# are sent there for a cooldown period...
+RETURN_CIRCUIT_FAILURE_THRESHOLD = 5
+RETURN_CIRCUIT_COOLDOWN_IN_SEC = 30
+# ...which is doubled every time a probe sent after it fails, up to:
+RETURN_CIRCUIT_MAX_COOLDOWN_IN_SEC = 30 * 60
+# How many results may be returned to a single host at the same time.
+RETURN_CONCURRENCY_PER_HOST = 4
+# How long idle connections used for returning results are kept open.
+RETURN_KEEPALIVE_IN_SEC = 240
+# Encoded results larger than this (in bytes) are kept in a temporary file
+# instead of memory until they are returned.
+RETURN_SPOOL_THRESHOLD = 2 ** 20
+# How many old results may be returned per second after a restart.
+RECOVERY_RETURNS_PER_SEC = 20
+# How many of the most recent queue waits of each task class are kept
+# for the statistics.
+QUEUE_WAIT_SAMPLES = 1000
+
+
+class _Rewound(object):
+    """Read-only view of a file, starting from its beginning.
+
+    FileBodyProducer closes the file it has sent, closing the view leaves
+    the underlying file open, so that it can be sent again.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        f.seek(0)
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        pass
+
+
+def encode_result(env, compress=False):
+    """Encodes ``env`` as multipart/form-data with a single field ``data``.
+
+    The JSON is encoded incrementally into a temporary file, which is kept
+    in memory only if it is smaller than ``RETURN_SPOOL_THRESHOLD``.
+    If ``compress`` is true, the whole body is gzipped.
+
+    Returns a pair (file, content type).
+    """
+    boundary = choose_boundary()
+    spool = tempfile.SpooledTemporaryFile(max_size=RETURN_SPOOL_THRESHOLD)
+    out = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+    out.write(('--%s\r\n' % boundary).encode('latin-1'))
+    out.write(RequestField.from_tuples('data', '').render_headers().encode('utf-8'))
+    buf = []
+    buf_len = 0
+    for chunk in CompatibleJSONEncoder().iterencode(env):
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= 2 ** 16:
+            out.write(''.join(buf).encode('utf-8'))
+            buf = []
+            buf_len = 0
+    out.write(''.join(buf).encode('utf-8'))
+    out.write(('\r\n--%s--\r\n' % boundary).encode('latin-1'))
+    if compress:
+        out.close()
+    spool.seek(0)
+    return spool, 'multipart/form-data; boundary=%s' % boundary
+
+
+class CircuitBreaker(object):
+    """Tracks failures of returning results to a single host.
+
+    The circuit opens after ``threshold`` consecutive failures. While it
+    is open, no results should be sent to the host. When the cooldown
+    ends, a single probe is let through: if it succeeds, the circuit
+    closes, otherwise it opens again with a doubled cooldown.
+
+    Each attempt gets a token from ``allows``, which tells the probe apart
+    from the attempts started before the circuit opened.
+    """
+
+    # The token of attempts made while the circuit is closed.
+    ATTEMPT = object()
+
+    def __init__(
+        self,
+        threshold=RETURN_CIRCUIT_FAILURE_THRESHOLD,
+        cooldown=RETURN_CIRCUIT_COOLDOWN_IN_SEC,
+        max_cooldown=RETURN_CIRCUIT_MAX_COOLDOWN_IN_SEC,
+    ):
+        self.threshold = threshold
+        self.minCooldown = cooldown
+        self.maxCooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        # Time when the cooldown ends, None if the circuit is closed.
+        self.openUntil = None
+        # Token of the probe in flight, if any.
+        self.probe = None
+
+    def allows(self, now):
+        """Returns None if no result may be sent to the host at ``now``,
+        otherwise the token of the attempt. It must be passed to
+        ``succeeded`` or ``failed`` when the attempt ends, or to
+        ``cancelled`` if it isn't made after all."""
+        if self.openUntil is None:
+            return self.ATTEMPT
+        if self.probe is not None or now < self.openUntil:
+            return None
+        self.probe = object()
+        return self.probe
+
+    def succeeded(self, token):
+        self.failures = 0
+        self.openUntil = None
+        self.probe = None
+        self.cooldown = self.minCooldown
+
+    def failed(self, now, token):
+        self.failures += 1
+        if token is self.probe:
+            self.probe = None
+            self.cooldown = min(2 * self.cooldown, self.maxCooldown)
+            self.openUntil = now + self.cooldown
+        elif self.openUntil is None and self.failures >= self.threshold:
+            self.openUntil = now + self.cooldown
+
+    def cancelled(self, token):
+        if token is self.probe:
+            self.probe = None
+
+
+class QueueWaits(object):
+    """Times which tasks of a single class spent in the scheduler queue.
+
+    Totals are kept for all the tasks, percentiles are computed over
+    the last ``samples`` waits.
+    """
+
+    def __init__(self, samples=QUEUE_WAIT_SAMPLES):
+        self.queued = 0
+        self.started = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def add(self, wait):
+        self.started += 1
+        self.total += wait
+        self.recent.append(wait)
+
+    def getStats(self):
+        waits = sorted(self.recent)
+        stats = {
+            'queued': self.queued,
+            'started': self.started,
+            'wait_mean': self.total / self.started if self.started else None,
+        }
+        for name, p in (('p50', 50), ('p90', 90), ('p99', 99)):
+            index = min(len(waits) - 1, len(waits) * p // 100)
+            stats['wait_' + name] = waits[index] if waits else None
+        stats['wait_max'] = waits[-1] if waits else None
+        return stats
+
+
+class GroupCancelled(Exception):
+    """The group of the task was cancelled before the task was run."""
 
 
 class MultiException(Exception):
@@ -48,137 +224,274 @@ class MultiException(Exception):
         super(MultiException, self).__init__(s)
 
 
-class DBWrapper(object):
-    def __init__(self, db_filename):
-        # hashopen, cause we operate on single keys and do full scan at start.
-        self.db = bsddb.hashopen(db_filename)
-        # For better performance we are allowing some tasks to be executed
-        # multiple times in case of server failure. Hence, we are skipping
-        # specific database sync and doing it later with LoopingCall.
-        self.db_sync_task = LoopingCall(self.db.sync)
-
-    def start_periodic_sync(self):
-        def restart_db_sync_task(failure, task):
-            log.error("Failed to sync database. Error:", failure)
-            d = deferLater(
-                reactor,
-                DB_SYNC_RESTART_INTERVAL_IN_SEC,
-                lambda: task.start(DB_SYNC_INTERVAL_IN_SEC),
-            )
-            d.addErrback(restart_db_sync_task, task=task)
-            return d
-
-        self.db_sync_task.start(DB_SYNC_INTERVAL_IN_SEC).addErrback(
-            restart_db_sync_task, task=self.db_sync_task
-        )
-
-    def get_items(self):
-        loaded = []
-        for k in self.db.keys():
-            try:
-                loaded.append(json.loads(self.db[k].decode()))
-            except ValueError:
-                log.error('Failed to load json from DB: {}'.format(self.db[k].decode()))
-                del self.db[k]
-        return loaded
-
-    def update(self, job_id, dict_update, sync=True):
-        job_id = six.ensure_binary(job_id)
-        job = json.loads(self.db.get(job_id, '{}'))
-        job.update(dict_update)
-        self.db[job_id] = six.ensure_binary(json_dumps(job))
-        if sync:
-            self.db.sync()
-
-    def delete(self, job_id, sync=False):
-        # Check self.db_sync_task to know why sync is False by default
-        del self.db[six.ensure_binary(job_id)]
-        if sync:
-            self.db.sync()
-
-
 class TaskManager(Service):
-    def __init__(self, db_filename, workerm, sched, max_task_ram_mb):
+    def __init__(
+        self,
+        db_filename,
+        workerm,
+        sched,
+        max_task_ram_mb,
+        db_class=None,
+        return_concurrency=RETURN_CONCURRENCY_PER_HOST,
+        return_keepalive=RETURN_KEEPALIVE_IN_SEC,
+        schedule_interval=0,
+        clock=None,
+    ):
         self.workerm = workerm
-        self.database = DBWrapper(db_filename)
+        if db_class is None:
+            db_class = SQLiteDatabase
+        self.database = db_class(db_filename)
         self.scheduler = sched
         self.max_task_ram_mb = max_task_ram_mb
         self.inProgress = {}
-        # If a connection pool and/or keepalive is necessary
-        # in the future, add it here.
-        self.agent = client.Agent(reactor)
+        # Minimal delay (in seconds) of a scheduling pass after it has been
+        # requested. With 0, there is at most one pass per reactor iteration.
+        self.scheduleInterval = schedule_interval
+        # Scheduling passes are run by the clock, which is replaced with
+        # a simulated one by sio.sioworkersd.simulator.
+        self.clock = reactor if clock is None else clock
+        self._schedulingCall = None
+        self.schedulingRequests = 0
+        self.schedulingPasses = 0
+        # Ids of groups which are being returned to oioioi.
+        self.beingReturned = set()
+        self._recoveryTasks = []
+        # Fires when all the unfinished groups from the database are resumed.
+        self.recovery = None
+        # Results are returned over persistent connections, with at most
+        # return_concurrency requests to a single host at a time. Others
+        # wait in a queue of the host's semaphore.
+        self.returnConcurrency = return_concurrency
+        self.pool = client.HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = return_concurrency
+        self.pool.cachedConnectionTimeout = return_keepalive
+        self.agent = client.Agent(reactor, pool=self.pool)
+        self._returnSemaphores = {}  # Map: netloc -> DeferredSemaphore
+        self._returnCircuits = {}  # Map: netloc -> CircuitBreaker
+        # Failed returns waiting for another attempt. The queue is a heap
+        # of pairs (time of the attempt, tid), the attempt itself is
+        # described in _pendingRetries. Entries of the heap whose time
+        # doesn't match the attempt are stale (the group was queued
+        # again since), and are skipped. Both are restored from the
+        # database after a restart.
+        self._retryQueue = []
+        # Map: tid -> (env, url, retry count, time of the attempt)
+        self._pendingRetries = {}
+        self._retryCall = None
+        # Queue waits are measured per class of tasks, as reported by
+        # the scheduler (e.g. its fast lane).
+        self.queueWaits = {}  # Map: class -> QueueWaits
+        # Prefetched tasks wait on their workers until they start, see
+        # _startedTask.
+        self._queuedAt = {}  # Map: tid -> (class, time of queueing)
+        # Ids of tasks which wait for their worker to reconnect (see
+        # WorkerManager.workerLost), they are out of the scheduler meanwhile.
+        self._detached = set()
+        # Ids of groups which were rejected without being stored, and
+        # wait to be returned, see _returnFailed.
+        self._rejectedGroups = set()
 
     @defer.inlineCallbacks
     def startService(self):
         log.info('Starting task manager...')
         yield Service.startService(self)
-        self.database.start_periodic_sync()
-        all_jobs = self.database.get_items()
-        all_jobs.sort(key=itemgetter('timestamp'))
-
-        if len(all_jobs) > 0:
-            log.info("Unfinished jobs found in database, resuming them...")
-
-        for job in all_jobs:
-            if job['status'] == 'to_judge':
-                d = self._addGroup(job['env'])
-                log.debug("added again unfinished task {tid}", tid=job['id'])
-                d.addBoth(
-                    self.returnToSio,
-                    url=job['env']['return_url'],
-                    orig_env=job['env'],
-                    tid=job['id'],
-                )
-            elif job['status'] == 'to_return':
-                log.warn("Trying again to return old task {tid}", tid=job['id'])
-                self.returnToSio(
-                    job['env'],
-                    url=job['env']['return_url'],
-                    orig_env=job['env'],
-                    tid=job['id'],
-                    count=job['retry_cnt'],
-                )
+        self.database.start_periodic_compaction()
         self.workerm.notifyOnNewWorker(self._newWorker)
         self.workerm.notifyOnLostWorker(self._lostWorker)
+        self.workerm.notifyOnWorkerCacheUpdate(self._workerCacheUpdated)
+        self.workerm.notifyOnWorkerRttUpdate(self._workerRttUpdated)
+        self.workerm.notifyOnReattachedTask(self._reattachedTask)
+        self.workerm.notifyOnStartedTask(self._startedTask)
+
+        # Unfinished groups are resumed in the background, a few at a time
+        # in each reactor iteration, so that workers and new groups are
+        # accepted right away.
+        self._recoveryTasks = [
+            cooperate(self._resumeGroups()),
+            cooperate(self._resumeReturns()),
+        ]
+        self.recovery = defer.gatherResults(
+            [t.whenDone() for t in self._recoveryTasks], consumeErrors=True
+        )
+        self.recovery.addErrback(self._recoveryFailed)
         self._tryExecute()
 
+    def stopService(self):
+        for t in self._recoveryTasks:
+            try:
+                t.stop()
+            except TaskFinished:
+                pass
+        if self._schedulingCall is not None:
+            self._schedulingCall.cancel()
+            self._schedulingCall = None
+        if self._retryCall is not None:
+            self._retryCall.cancel()
+            self._retryCall = None
+        self.database.close()
+        Service.stopService(self)
+        return self.pool.closeCachedConnections()
+
+    def _recoveryFailed(self, failure):
+        if failure.value.subFailure.check(TaskStopped):
+            return
+        log.failure('Failed to resume unfinished jobs', failure.value.subFailure)
+
+    def _resumeGroups(self):
+        """Generator re-adding groups stored as ``to_judge``, one per step."""
+        for job in self.database.iter_items('to_judge'):
+            # It may have been added since the recovery started.
+            if job['id'] in self.inProgress:
+                continue
+            d = self._addGroup(job['env'], job.get('task_results'))
+            log.debug("added again unfinished task {tid}", tid=job['id'])
+            d.addBoth(
+                self.returnToSio,
+                url=job['env']['return_url'],
+                orig_env=job['env'],
+                tid=job['id'],
+            )
+            yield
+
+    def _resumeReturns(self):
+        """Generator returning groups stored as ``to_return``, at most
+        ``RECOVERY_RETURNS_PER_SEC`` per second."""
+        for job in self.database.iter_items('to_return'):
+            # It may have been judged and returned since the recovery started.
+            if job['id'] in self.beingReturned:
+                continue
+            env = job['env']
+            env.update(job.get('results') or {})
+            next_retry = job.get('next_retry')
+            if next_retry is not None and next_retry > time.time():
+                self.beingReturned.add(job['id'])
+                self._queueReturn(
+                    env, env['return_url'], job['id'], job['retry_cnt'], next_retry
+                )
+                continue
+            log.warn("Trying again to return old task {tid}", tid=job['id'])
+            self.returnToSio(
+                env,
+                url=job['env']['return_url'],
+                orig_env=job['env'],
+                tid=job['id'],
+                count=job['retry_cnt'],
+            )
+            yield deferLater(reactor, 1.0 / RECOVERY_RETURNS_PER_SEC, lambda: None)
+
     def _newWorker(self, name):
         self.scheduler.addWorker(name)
         self._tryExecute()
 
     def _lostWorker(self, name):
+        for tid in self.workerm.getDetachedTasks(name):
+            self._detached.add(tid)
+            self.scheduler.delTask(tid)
         self.scheduler.delWorker(name)
         self._tryExecute()
 
-    def _tryExecute(self, x=None):
-        # Note: this function might be called _very_ often, which might be
-        # a performance problem for complex schedulers, especially during
-        # rejudges. A solution exists, but it is a bit complex.
-        jobs = self.scheduler.schedule()
-        for (task_id, worker) in jobs:
-            task = self.inProgress[task_id]
-            d = self.workerm.runOnWorker(worker, task.env)
-
-            def _retry_on_disconnect(failure, task_id=task_id, task=task):
-                exc = failure.check(WorkerGone)
-                # Handle WorkerGone and don't return anything. For other
-                # exceptions, errback the original Deferred.
-                if exc is None:
-                    return task.d.errback(failure)
-                log.warn(
-                    'Worker executing task {t} disappeared. ' 'Will retry on another.',
-                    t=task_id,
-                )
-                # someone could write a scheduler that requires this
-                self.scheduler.delTask(task_id)
-                self.scheduler.addTask(task.env)
+    def _reattachedTask(self, name, tid):
+        self._detached.remove(tid)
+        self.scheduler.reattachTask(self.inProgress[tid].env, name)
+
+    def _startedTask(self, tid):
+        self._recordQueueWait(tid)
+
+    def _recordQueueWait(self, tid):
+        task_class, queued_at = self._queuedAt.pop(tid)
+        self.queueWaits[task_class].add(self.clock.seconds() - queued_at)
+
+    def _unscheduleTask(self, tid):
+        """Removes a task from the scheduler, unless it's detached."""
+        if tid in self._detached:
+            self._detached.remove(tid)
+        else:
+            self.scheduler.delTask(tid)
+
+    def _workerCacheUpdated(self, name):
+        self.scheduler.updateWorkerCache(name)
+
+    def _workerRttUpdated(self, name):
+        self.scheduler.updateWorkerRtt(name)
 
-            # chain manually - we don't want to errback d when retrying
-            d.addCallbacks(task.d.callback, _retry_on_disconnect)
+    def _tryExecute(self, x=None):
+        # Note: this function might be called _very_ often (for every
+        # finished task, added group and worker change), especially during
+        # rejudges. So it only requests a scheduling pass, and all the
+        # requests made until the pass runs are served by it.
+        self.schedulingRequests += 1
+        if self._schedulingCall is None:
+            self._schedulingCall = self.clock.callLater(
+                self.scheduleInterval, self._runScheduler
+            )
         # Return the argument to allow this function to be used
         # as a (transparent) callback
         return x
 
+    def _runScheduler(self):
+        self._schedulingCall = None
+        self.schedulingPasses += 1
+        jobs = self.scheduler.schedule()
+        for (task_id, worker) in jobs:
+            self._runTask(task_id, worker)
+        # Tasks which wait on the workers for the running ones to end.
+        for (task_id, worker) in self.scheduler.prefetch():
+            self._runTask(task_id, worker, prefetch=True)
+
+    def _runTask(self, task_id, worker, prefetch=False):
+        task = self.inProgress[task_id]
+        if not prefetch:
+            self._recordQueueWait(task_id)
+        d = self.workerm.runOnWorker(worker, task.env, prefetch=prefetch)
+
+        def _retry_on_disconnect(failure):
+            exc = failure.check(WorkerGone)
+            # Handle WorkerGone and don't return anything. For other
+            # exceptions, errback the original Deferred.
+            if exc is None:
+                return task.d.errback(failure)
+            log.warn(
+                'Worker executing task {t} disappeared. ' 'Will retry on another.',
+                t=task_id,
+            )
+            # someone could write a scheduler that requires this
+            self._unscheduleTask(task_id)
+            self._queueTask(task.env)
+
+        # chain manually - we don't want to errback d when retrying
+        d.addCallbacks(task.d.callback, _retry_on_disconnect)
+
+    def getStats(self):
+        """Returns a dict of statistics, for monitoring."""
+        return {
+            'scheduling_requests': self.schedulingRequests,
+            'scheduling_passes': self.schedulingPasses,
+            # Passes saved by serving multiple requests with one pass.
+            'coalesced_scheduling_passes': (
+                self.schedulingRequests - self.schedulingPasses
+            ),
+            'queued_returns': len(self._pendingRetries),
+            'open_return_circuits': sorted(
+                netloc
+                for netloc, circuit in six.iteritems(self._returnCircuits)
+                if circuit.openUntil is not None
+            ),
+            'queue_wait': {
+                task_class: waits.getStats()
+                for task_class, waits in six.iteritems(self.queueWaits)
+            },
+        }
+
+    def _queueTask(self, env):
+        """Adds a task to the scheduler, noting when it was queued."""
+        task_class = self.scheduler.getTaskClass(env)
+        waits = self.queueWaits.get(task_class)
+        if waits is None:
+            waits = self.queueWaits[task_class] = QueueWaits()
+        waits.queued += 1
+        self._queuedAt[env['task_id']] = (task_class, self.clock.seconds())
+        self.scheduler.addTask(env)
+
     def _taskDone(self, x, tid):
         if isinstance(x, Failure):
             self.inProgress[tid].env['error'] = {
@@ -188,22 +501,28 @@ class TaskManager(Service):
         # There is no need to save synchronous task. In case of server
         # failure client is disconnected, so it can't receive the result
         # anyway.
-        save = 'return_url' in self.inProgress[tid].env
+        env = self.inProgress[tid].env
+        save = 'return_url' in env
         if save:
+            # The original env is already stored, so only the keys added
+            # while judging are written.
             self.database.update(
                 tid,
                 {
-                    'env': self.inProgress[tid].env,
+                    'results': {k: env[k] for k in RESULT_KEYS if k in env},
                     'status': 'to_return',
                 },
                 sync=False,
             )
             # No db sync here, because we are allowing some jobs to be done
             # multiple times in case of server failure for better performance.
-            # It should be synced soon with other task
-            # or `self.database` itself.
+            # It should be committed soon with other task
+            # or by `self.database` compaction.
         if self.inProgress[tid].env.get('group_id') != tid:
-            self.scheduler.delTask(tid)
+            if not isinstance(x, Failure):
+                self.scheduler.taskFinished(x)
+            self._unscheduleTask(tid)
+            self._queuedAt.pop(tid, None)
         del self.inProgress[tid]
         log.info("Task {tid} finished.", tid=tid)
         self._tryExecute()
@@ -222,7 +541,14 @@ class TaskManager(Service):
     def getQueue(self):
         return six.text_type(self.scheduler)
 
-    def _addGroup(self, group_env):
+    def _addGroup(self, group_env, finished=None):
+        """Runs the tasks of the group.
+
+        ``finished`` maps names of the tasks which are already done
+        (e.g. before a restart) to their results. They are not run again.
+        """
+        finished = finished or {}
+        save = 'return_url' in group_env
         singleTasks = []
         idMap = {}
         contest_uid = (group_env.get('oioioi_instance'), group_env.get('contest_id'))
@@ -232,16 +558,21 @@ class TaskManager(Service):
             group_env.get('contest_weight', 1),
         )
         for k, v in six.iteritems(group_env['workers_jobs']):
+            if k in finished:
+                continue
             v['contest_uid'] = contest_uid
             idMap[v['task_id']] = k
-            self.scheduler.addTask(v)
-            singleTasks.append(self._deferTask(v))
+            self._queueTask(v)
+            d = self._deferTask(v)
+            if save:
+                d.addCallback(self._saveTaskResult, gid=group_env['group_id'], key=k)
+            singleTasks.append(d)
         self.inProgress[group_env['group_id']] = Task(group_env, None)
         d = defer.DeferredList(singleTasks, consumeErrors=True)
         self._tryExecute()
 
         def _collect(x):
-            ret = {}
+            ret = dict(finished)
             failed = []  # list of tuples (exception, traceback string)
             for success, result in x:
                 if success:
@@ -264,6 +595,12 @@ class TaskManager(Service):
         d.addBoth(self._taskDone, tid=group_env['group_id'])
         return d
 
+    def _saveTaskResult(self, result, gid, key):
+        # Not synced, like the group results in _taskDone. A result lost
+        # in a crash only means the task is run again.
+        self.database.add_task_result(gid, key, result, sync=False)
+        return result
+
     @defer.inlineCallbacks
     def addTaskGroup(self, group_env):
         # Start with validating the tasks.
@@ -274,6 +611,8 @@ class TaskManager(Service):
                     'message': error,
                     'traceback': traceback.format_exc(),
                 }
+                if 'return_url' in group_env:
+                    self._rejectedGroups.add(group_env['group_id'])
                 defer.returnValue(group_env)
                 return
 
@@ -282,10 +621,12 @@ class TaskManager(Service):
         # anyway.
         save = 'return_url' in group_env
         if save:
+            # The record is committed together with all the groups added
+            # in this reactor iteration, wait for self.database.sync()
+            # to know when it is durable.
             self.database.update(
                 group_env['group_id'],
                 {
-                    'id': group_env['group_id'],
                     'env': group_env,
                     'status': 'to_judge',
                     'timestamp': time.time(),
@@ -295,7 +636,36 @@ class TaskManager(Service):
         ret = yield self._addGroup(group_env)
         defer.returnValue(ret)
 
+    def cancelGroup(self, group_id):
+        """Cancels the unfinished tasks of a group.
+
+        Queued tasks fail with ``GroupCancelled`` and running ones are
+        killed on their workers, the other tasks of the workers are left
+        alone. The group is then finished with an error, as usual when its
+        tasks fail.
+
+        Returns whether the group was being judged.
+        """
+        group = self.inProgress.get(group_id)
+        if group is None or group.d is not None:
+            return False
+        log.info("Cancelling group {gid}", gid=group_id)
+        for task_env in six.itervalues(group.env['workers_jobs']):
+            tid = task_env['task_id']
+            if tid not in self.inProgress:
+                continue
+            if self.workerm.isTaskAssigned(tid):
+                self.workerm.cancelTask(tid)
+            else:
+                self.inProgress[tid].d.errback(GroupCancelled())
+        return True
+
     def returnToSio(self, x, url, orig_env=None, tid=None, count=0):
+        """Returns the results of a group to oioioi.
+
+        If it fails, another attempt is queued. The returned Deferred
+        fires after the first attempt, whatever its result is.
+        """
         if isinstance(x, Failure):
             assert orig_env
             env = orig_env
@@ -305,8 +675,32 @@ class TaskManager(Service):
 
         if not tid:
             tid = env['group_id']
+        self.beingReturned.add(tid)
+        return self._attemptReturn(env, url, tid, count)
+
+    def _attemptReturn(self, env, url, tid, count):
+        now = time.time()
+        circuit = self._getReturnCircuit(url)
+        token = circuit.allows(now)
+        if token is None:
+            # Spread the postponed returns over the next cooldown, so that
+            # they don't all hit the host as soon as it is back.
+            self._queueReturn(
+                env,
+                url,
+                tid,
+                count,
+                circuit.openUntil + random.uniform(0, circuit.cooldown),
+            )
+            return defer.succeed(None)
 
-        body, content_type = encode_multipart_formdata({'data': json_dumps(env)})
+        compress = env.get('return_compression') == 'gzip'
+        try:
+            body, content_type = encode_result(env, compress)
+        except BaseException:
+            # Let another attempt probe the host.
+            circuit.cancelled(token)
+            raise
 
         headers = Headers(
             {
@@ -314,76 +708,185 @@ class TaskManager(Service):
                 'Content-Type': [content_type],
             }
         )
+        if compress:
+            headers.addRawHeader('Content-Encoding', 'gzip')
 
-        def do_return():
-            # This looks a bit too complicated for just POSTing a string,
-            # but there seems to be no other way. Blame Twisted.
-
-            # agent.request() will add content-length based on length
-            # from FileBodyProducer. If we have another in headers,
-            # there will be a duplicate, so remove it.
-            headers.removeHeader('content-length')
-
-            producer = client.FileBodyProducer(BytesIO(body))
-            d = self.agent.request(b'POST', url.encode('utf-8'), headers, producer)
-
-            @defer.inlineCallbacks
-            def _response(r):
-                if r.code != 200:
-                    log.error(
-                        'return error: server responded with status" \
-                            "code {r.code}, response body follows...',
-                        r=r,
-                    )
-                    bodyD = yield client.readBody(r)
-                    log.debug(bodyD)
-                    raise RuntimeError('Failed to return task')
-
-            d.addCallback(_response)
-            return d
-
-        ret = do_return()
-
-        def _updateCount(x, n):
-            self.database.update(tid, {'retry_cnt': n}, sync=False)
-            # No db sync here, because we are allowing more attempts
-            # of retrying returning job result for better performance.
-            # It should be synced soon with other task
-            # or `self.database` itself.
-            return x  # Transparent callback
-
-        def retry(err, retry_cnt):
-            if retry_cnt >= MAX_RETRIES_OF_RESULT_RETURNING:
+        # This looks a bit too complicated for just POSTing a string,
+        # but there seems to be no other way. Blame Twisted.
+        producer = client.FileBodyProducer(_Rewound(body))
+
+        @defer.inlineCallbacks
+        def _post():
+            r = yield self.agent.request(
+                b'POST', url.encode('utf-8'), headers, producer
+            )
+            # The body has to be read even if it's not needed,
+            # otherwise the connection can't go back to the pool.
+            bodyD = yield client.readBody(r)
+            if r.code != 200:
                 log.error(
-                    'Failed to return {tid} {count} times, giving up.',
-                    tid=tid,
-                    count=retry_cnt,
+                    'return error: server responded with status" \
+                        "code {r.code}, response body follows...',
+                    r=r,
                 )
-                return
-            log.warn(
-                'Returning {tid} to url {url} failed, retrying[{n}]...',
+                log.debug(bodyD)
+                raise RuntimeError('Failed to return task')
+
+        def _close(x):
+            body.close()
+            return x
+
+        d = self._getReturnSemaphore(url).run(_post)
+        d.addBoth(_close)
+        d.addCallbacks(
+            self._returnSucceeded,
+            self._returnFailed,
+            callbackArgs=(url, tid, token),
+            errbackArgs=(env, url, tid, count, token),
+        )
+        return d
+
+    def _returnSucceeded(self, _, url, tid, token):
+        self._getReturnCircuit(url).succeeded(token)
+        self._returnDone(None, tid)
+
+    def _returnFailed(self, err, env, url, tid, count, token):
+        now = time.time()
+        self._getReturnCircuit(url).failed(now, token)
+        fields = {}
+        if tid in self._rejectedGroups:
+            # Groups rejected before judging are stored only now, the other
+            # ones were stored when added, and their results when judged.
+            self._rejectedGroups.remove(tid)
+            fields['env'] = {
+                k: v for k, v in six.iteritems(env) if k not in RESULT_KEYS
+            }
+            fields['results'] = {k: env[k] for k in RESULT_KEYS if k in env}
+        if count >= MAX_RETRIES_OF_RESULT_RETURNING:
+            log.error(
+                'Failed to return {tid} {count} times, giving up. It can be '
+                'returned again with the replay_dead_letters RPC.',
                 tid=tid,
-                url=url,
-                n=retry_cnt,
+                count=count,
             )
             log.failure('error was:', err, LogLevel.info)
-            d = deferLater(
-                reactor, RETRY_DELAY_OF_RESULT_RETURNING[retry_cnt], do_return
+            self.beingReturned.discard(tid)
+            fields.update(status='dead_letter', next_retry=None)
+            d = self.database.update(tid, fields)
+            d.addErrback(
+                lambda f: log.failure(
+                    'Failed to store {tid} as a dead letter', f, tid=tid
+                )
             )
-            d.addBoth(_updateCount, n=retry_cnt)
-            d.addErrback(retry, retry_cnt + 1)
-            return d
+            return
+        log.warn(
+            'Returning {tid} to url {url} failed, retrying[{n}]...',
+            tid=tid,
+            url=url,
+            n=count,
+        )
+        log.failure('error was:', err, LogLevel.info)
+        delay = RETRY_DELAY_OF_RESULT_RETURNING[count] * random.uniform(
+            1 - RETRY_JITTER_OF_RESULT_RETURNING, 1 + RETRY_JITTER_OF_RESULT_RETURNING
+        )
+        fields.update(status='to_return', retry_cnt=count + 1, next_retry=now + delay)
+        self.database.update(tid, fields, sync=False)
+        # No db sync here, because we are allowing more attempts
+        # of retrying returning job result for better performance.
+        # It should be committed soon with other task
+        # or by `self.database` compaction.
+        self._queueReturn(env, url, tid, count + 1, now + delay)
+
+    def _queueReturn(self, env, url, tid, count, when):
+        """Queues an attempt of returning ``env`` at time ``when``."""
+        self._pendingRetries[tid] = (env, url, count, when)
+        heapq.heappush(self._retryQueue, (when, tid))
+        if self._retryQueue[0][1] == tid:
+            self._armRetryTimer()
+
+    def _armRetryTimer(self):
+        if self._retryCall is not None:
+            self._retryCall.cancel()
+            self._retryCall = None
+        if self._retryQueue:
+            delay = max(0, self._retryQueue[0][0] - time.time())
+            self._retryCall = reactor.callLater(delay, self._runRetries)
+
+    def _runRetries(self):
+        self._retryCall = None
+        now = time.time()
+        while self._retryQueue and self._retryQueue[0][0] <= now:
+            when, tid = heapq.heappop(self._retryQueue)
+            pending = self._pendingRetries.get(tid)
+            if pending is None or pending[3] != when:
+                continue
+            env, url, count, _ = self._pendingRetries.pop(tid)
+            self._attemptReturn(env, url, tid, count)
+        self._armRetryTimer()
+
+    def getDeadLetters(self):
+        """Returns a list of groups which couldn't be returned."""
+        return [
+            {
+                'id': job['id'],
+                'return_url': job['env'].get('return_url'),
+                'timestamp': job.get('timestamp'),
+                'retry_cnt': job.get('retry_cnt'),
+            }
+            for job in self.database.iter_items('dead_letter')
+        ]
+
+    def replayDeadLetters(self, ids=None):
+        """Tries again to return the given groups which couldn't be
+        returned (all of them if ``ids`` is None).
+
+        Returns a Deferred, which fires with the list of ids of
+        the replayed groups when they were tried to be returned.
+        """
+        replayed = []
+        attempts = []
+        for job in list(self.database.iter_items('dead_letter')):
+            if ids is not None and job['id'] not in ids:
+                continue
+            self.database.update(
+                job['id'],
+                {'status': 'to_return', 'retry_cnt': 0, 'next_retry': None},
+                sync=False,
+            )
+            env = job['env']
+            env.update(job.get('results') or {})
+            attempts.append(
+                self.returnToSio(env, url=env['return_url'], tid=job['id'])
+            )
+            replayed.append(job['id'])
+        d = defer.gatherResults(attempts)
+        d.addCallback(lambda _: replayed)
+        return d
 
-        ret.addErrback(retry, retry_cnt=count)
-        ret.addBoth(self._returnDone, tid=tid)
-        return ret
+    def _getReturnSemaphore(self, url):
+        netloc = six.moves.urllib.parse.urlparse(url).netloc
+        sem = self._returnSemaphores.get(netloc)
+        if sem is None:
+            sem = defer.DeferredSemaphore(self.returnConcurrency)
+            self._returnSemaphores[netloc] = sem
+        return sem
+
+    def _getReturnCircuit(self, url):
+        netloc = six.moves.urllib.parse.urlparse(url).netloc
+        circuit = self._returnCircuits.get(netloc)
+        if circuit is None:
+            circuit = CircuitBreaker()
+            self._returnCircuits[netloc] = circuit
+        return circuit
 
     def _returnDone(self, _, tid):
+        self.beingReturned.discard(tid)
+        self._rejectedGroups.discard(tid)
         self.database.delete(tid, sync=False)
         # No db sync here, because we are allowing some jobs to be done
         # multiple times in case of server failure for better performance.
-        # It should be synced soon with other task
-        # or `self.database` itself.
+        # It should be committed soon with other task
+        # or by `self.database` compaction.
 
     def _isTaskValid(self, task_env):
         """Checks if task should be accepted by sioworkersd.
@@ -2,18 +2,31 @@
 # which hangs on some Twisted test cases. Use trial <module>.
 from __future__ import absolute_import
 from __future__ import print_function
+import gzip
+import json
 import shutil
 import tempfile
+import time
+
+import six
 
 from twisted.trial import unittest
 from twisted.internet import defer, interfaces, reactor, protocol, task
 from twisted.application.service import Application
+from twisted.web import resource, server as web_server
+from urllib3 import encode_multipart_formdata
 from zope.interface import implementer
 
-from sio.sioworkersd import workermanager, taskmanager, server
+from sio.sioworkersd import database, workermanager, taskmanager, server, simulator
 from sio.sioworkersd.scheduler.prioritizing import PrioritizingScheduler
-from sio.sioworkersd.utils import get_required_ram_for_job
+from sio.sioworkersd.utils import (
+    get_cpu_shares_for_job,
+    get_required_disk_for_job,
+    get_required_ram_for_job,
+    get_time_limit_for_job,
+)
 from sio.protocol import rpc
+from sio.workers.util import json_dumps
 
 # debug
 def _print(x):
@@ -36,6 +49,8 @@ class TestWithDB(unittest.TestCase):
     """Abstract class for testing sioworkersd parts that need a database."""
 
     SAVED_TASKS = []
+    # Additional keyword arguments of TaskManager.
+    TASKM_KWARGS = {}
 
     def __init__(self, *args):
         super(TestWithDB, self).__init__(*args)
@@ -50,26 +65,30 @@ class TestWithDB(unittest.TestCase):
         self.db_path = self.db_dir + '/sio_tests.db'
 
     def tearDown(self):
+        d = defer.succeed(None)
         if self.taskm:
-            self.taskm.database.db.close()
-        shutil.rmtree(self.db_dir)
+            d.addCallback(lambda _: self.taskm.stopService())
+        d.addCallback(lambda _: shutil.rmtree(self.db_dir))
+        return d
 
     def _prepare_svc(self):
         self.app = Application('test')
         self.wm = workermanager.WorkerManager()
         self.sched = PrioritizingScheduler(self.wm)
         self.taskm = taskmanager.TaskManager(
-            self.db_path, self.wm, self.sched, max_task_ram_mb=2048
+            self.db_path, self.wm, self.sched, max_task_ram_mb=2048, **self.TASKM_KWARGS
         )
 
         # HACK: tests needs clear twisted's reactor, so we're mocking
         #       method that creates additional deferreds.
-        self.taskm.database.start_periodic_sync = lambda: None
+        self.taskm.database.start_periodic_compaction = lambda: None
 
         for tid, env in self.SAVED_TASKS:
             self.taskm.database.update(tid, env)
 
-        return self.taskm.startService()
+        d = self.taskm.startService()
+        d.addCallback(lambda _: self.taskm.recovery)
+        return d
 
 
 class TaskManagerTest(TestWithDB):
@@ -77,7 +96,6 @@ class TaskManagerTest(TestWithDB):
         (
             b'asdf_group',
             {
-                "id": "asdf_group",
                 "status": "to_judge",
                 "timestamp": "1491407526.72",
                 "retry_cnt": 0,
@@ -113,6 +131,556 @@ class TaskManagerTest(TestWithDB):
         return d
 
 
+class PartialRestoreTest(TestWithDB):
+    SAVED_TASKS = [
+        (
+            'group',
+            {
+                "status": "to_judge",
+                "timestamp": 1.0,
+                "retry_cnt": 0,
+                "env": {
+                    "group_id": "group",
+                    "return_url": "localhost",
+                    "workers_jobs": {
+                        "done": {"task_id": "done", "job_type": "cpu-exec"},
+                        "todo": {"task_id": "todo", "job_type": "cpu-exec"},
+                    },
+                },
+            },
+        )
+    ]
+
+    def setUp(self):
+        super(PartialRestoreTest, self).setUp()
+        db = database.SQLiteDatabase(self.db_path)
+        db.add_task_result('group', 'done', {'task_id': 'done', 'result': 'OK'})
+        db.close()
+
+    def test_only_unfinished_tasks_are_rerun(self):
+        returned = []
+        self.patch(
+            taskmanager.TaskManager,
+            'returnToSio',
+            lambda taskm, x, **kwargs: returned.append(x),
+        )
+        d = self._prepare_svc()
+
+        def check(_):
+            self.assertIn('todo', self.taskm.inProgress)
+            self.assertNotIn('done', self.taskm.inProgress)
+            result = {'task_id': 'todo', 'result': 'WA'}
+            self.taskm.inProgress['todo'].d.callback(result)
+            self.assertEqual(
+                self.taskm.database.get_items()[0]['task_results']['todo'], result
+            )
+            self.assertEqual(
+                returned[0]['workers_jobs.results'],
+                {'done': {'task_id': 'done', 'result': 'OK'}, 'todo': result},
+            )
+
+        d.addCallback(check)
+        return d
+
+
+class SchedulingTest(TestWithDB):
+    def setUp(self):
+        super(SchedulingTest, self).setUp()
+        return self._prepare_svc()
+
+    @defer.inlineCallbacks
+    def test_scheduling_passes_are_coalesced(self):
+        yield task.deferLater(reactor, 0, lambda: None)
+        passes = self.taskm.schedulingPasses
+        for _ in range(10):
+            self.taskm._tryExecute()
+        self.assertEqual(self.taskm.schedulingPasses, passes)
+        yield task.deferLater(reactor, 0, lambda: None)
+        self.assertEqual(self.taskm.schedulingPasses, passes + 1)
+        stats = self.taskm.getStats()
+        self.assertEqual(
+            stats['coalesced_scheduling_passes'],
+            stats['scheduling_requests'] - stats['scheduling_passes'],
+        )
+        self.assertGreaterEqual(stats['coalesced_scheduling_passes'], 9)
+
+
+class SimulatorTest(unittest.TestCase):
+    def _group(self, **tasks):
+        return {'workers_jobs': tasks}
+
+    def test_simulation(self):
+        durations = simulator.DurationModel(
+            [
+                {'job_type': 'vcpu-exec', 'time_used': 1500, 'real_time_used': 2000},
+                {'job_type': 'vcpu-exec', 'result_code': 'RE'},
+            ]
+        )
+        workers = [
+            {
+                'name': 'w',
+                'concurrency': 1,
+                'available_ram_mb': 1024,
+                'can_run_cpu_exec': True,
+            }
+        ]
+        report = simulator.simulate(
+            workers,
+            [
+                (10, self._group(a={'job_type': 'vcpu-exec'})),
+                (0, self._group(a={'job_type': 'vcpu-exec'})),
+                (0, self._group(a={'job_type': 'vcpu-exec'})),
+                # Requires more RAM than the worker has.
+                (5, self._group(a={'job_type': 'cpu-exec', 'exec_mem_limit': 2**21})),
+                # Job type missing from the history.
+                (20, self._group(a={'job_type': 'compile'})),
+            ],
+            durations,
+        )
+        self.assertEqual(report['groups'], 4)
+        self.assertEqual(report['rejected_groups'], 1)
+        self.assertEqual(report['tasks'], 4)
+        self.assertEqual(report['unfinished_tasks'], 0)
+        self.assertEqual(report['end_time'], 21)
+        self.assertAlmostEqual(report['utilization'], 7.0 / 21)
+        self.assertEqual(report['queue_wait'], {50: 0, 90: 2, 99: 2, 100: 2})
+        self.assertEqual(report['group_latency'], {50: 2, 90: 4, 99: 4, 100: 4})
+
+    def test_fast_lane_queue_waits(self):
+        workers = [
+            {'concurrency': 1, 'available_ram_mb': 1024, 'can_run_cpu_exec': False}
+        ]
+        simulation = simulator.Simulation(
+            workers,
+            simulator.DurationModel(),
+            scheduler_options={'fast_lane': ['compile']},
+        )
+        for job_type in ['vcpu-exec', 'vcpu-exec', 'compile']:
+            simulation.submit(0, self._group(a={'job_type': job_type}))
+        simulation.run()
+        # The first task is started before the others are submitted, then
+        # the compilation overtakes the remaining one.
+        report = simulation.report()
+        self.assertEqual(
+            report['class_queue_wait'],
+            {
+                'default': {50: 2, 90: 2, 99: 2, 100: 2},
+                'fast-lane': {50: 1, 90: 1, 99: 1, 100: 1},
+            },
+        )
+        self.assertEqual(
+            simulation.taskm.getStats()['queue_wait'],
+            {
+                'default': {
+                    'queued': 2,
+                    'started': 2,
+                    'wait_mean': 1,
+                    'wait_p50': 2,
+                    'wait_p90': 2,
+                    'wait_p99': 2,
+                    'wait_max': 2,
+                },
+                'fast-lane': {
+                    'queued': 1,
+                    'started': 1,
+                    'wait_mean': 1,
+                    'wait_p50': 1,
+                    'wait_p90': 1,
+                    'wait_p99': 1,
+                    'wait_max': 1,
+                },
+            },
+        )
+
+
+class _ReturnResource(resource.Resource):
+    """Accepts returned results, answering each request after a delay."""
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.active = 0
+        self.max_active = 0
+        self.received = []
+        self.code = 200
+
+    def render_POST(self, request):
+        request.setResponseCode(self.code)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.received.append(json.loads(request.args[b'data'][0]))
+
+        def finish():
+            self.active -= 1
+            request.write(b'OK')
+            request.finish()
+
+        reactor.callLater(0.05, finish)
+        return web_server.NOT_DONE_YET
+
+
+class _CountingSite(web_server.Site):
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return web_server.Site.buildProtocol(self, addr)
+
+
+class ReturnTest(TestWithDB):
+    TASKM_KWARGS = {'return_concurrency': 2}
+
+    def setUp(self):
+        super(ReturnTest, self).setUp()
+        self.resource = _ReturnResource()
+        self.site = _CountingSite(self.resource)
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        return self._prepare_svc()
+
+    @defer.inlineCallbacks
+    def test_returns_share_connections_and_respect_concurrency(self):
+        url = 'http://127.0.0.1:%d/' % self.port.getHost().port
+        yield defer.gatherResults(
+            [
+                self.taskm.returnToSio({'group_id': 'group%d' % i}, url=url)
+                for i in range(6)
+            ]
+        )
+        six.assertCountEqual(
+            self,
+            [env['group_id'] for env in self.resource.received],
+            ['group%d' % i for i in range(6)],
+        )
+        self.assertEqual(self.resource.max_active, 2)
+        self.assertEqual(self.site.connections, 2)
+        self.assertEqual(self.taskm.beingReturned, set())
+
+    def _env(self):
+        url = 'http://127.0.0.1:%d/' % self.port.getHost().port
+        return {'group_id': 'group', 'return_url': url, 'workers_jobs.results': {}}
+
+    @defer.inlineCallbacks
+    def test_failed_return_is_queued(self):
+        self.resource.code = 500
+        env = self._env()
+        yield self.taskm.database.update('group', {'env': env, 'status': 'to_return'})
+        yield self.taskm.returnToSio(env, url=env['return_url'])
+        self.flushLoggedErrors(RuntimeError)
+        self.assertEqual(len(self.resource.received), 1)
+        self.assertIn('group', self.taskm._pendingRetries)
+        self.assertEqual(self.taskm.getStats()['queued_returns'], 1)
+        [job] = self.taskm.database.get_items()
+        self.assertEqual(job['status'], 'to_return')
+        self.assertEqual(job['retry_cnt'], 1)
+        self.assertGreater(job['next_retry'], time.time())
+        # The stored group isn't written again.
+        self.assertNotIn('results', job)
+
+    @defer.inlineCallbacks
+    def test_rejected_group_is_stored_when_return_fails(self):
+        self.resource.code = 500
+        env = self._env()
+        env['workers_jobs'] = {
+            'a': {'task_id': 'a', 'job_type': 'vcpu-exec', 'exec_mem_limit': 2 ** 40}
+        }
+        result = yield self.taskm.addTaskGroup(env)
+        self.assertEqual(self.taskm.database.get_items(), [])
+        yield self.taskm.returnToSio(result, url=env['return_url'])
+        self.flushLoggedErrors(RuntimeError)
+        [job] = self.taskm.database.get_items()
+        self.assertEqual(job['status'], 'to_return')
+        self.assertEqual(job['env']['workers_jobs'], env['workers_jobs'])
+        self.assertIn('error', job['results'])
+
+    @defer.inlineCallbacks
+    def test_open_circuit_postpones_returns(self):
+        env = self._env()
+        circuit = self.taskm._getReturnCircuit(env['return_url'])
+        circuit.openUntil = time.time() + 100
+        yield self.taskm.returnToSio(env, url=env['return_url'])
+        self.assertEqual(self.resource.received, [])
+        self.assertGreaterEqual(self.taskm._retryQueue[0][0], circuit.openUntil)
+        self.assertIn('group', self.taskm.beingReturned)
+
+    def test_queueing_return_again_postpones_it(self):
+        env = self._env()
+        self.taskm._queueReturn(env, env['return_url'], 'group', 1, time.time() - 1)
+        self.taskm._queueReturn(env, env['return_url'], 'group', 2, time.time() + 100)
+        self.taskm._runRetries()
+        # The first attempt has been replaced by the second one.
+        self.assertIn('group', self.taskm._pendingRetries)
+        self.taskm._retryCall.cancel()
+
+    def test_probe_which_fails_to_encode_is_cancelled(self):
+        env = self._env()
+        circuit = self.taskm._getReturnCircuit(env['return_url'])
+        circuit.openUntil = time.time() - 1
+
+        def encode_result(env, compress=False):
+            raise ValueError()
+
+        self.patch(taskmanager, 'encode_result', encode_result)
+        self.assertRaises(
+            ValueError, self.taskm.returnToSio, env, url=env['return_url']
+        )
+        self.assertIsNone(circuit.probe)
+
+    @defer.inlineCallbacks
+    def test_dead_letters_can_be_replayed(self):
+        self.patch(taskmanager, 'MAX_RETRIES_OF_RESULT_RETURNING', 0)
+        self.resource.code = 500
+        env = self._env()
+        yield self.taskm.database.update('group', {'env': env, 'status': 'to_return'})
+        yield self.taskm.returnToSio(env, url=env['return_url'])
+        self.flushLoggedErrors(RuntimeError)
+        yield self.taskm.database.sync()
+        self.assertEqual(
+            self.taskm.getDeadLetters(),
+            [
+                {
+                    'id': 'group',
+                    'return_url': env['return_url'],
+                    'timestamp': None,
+                    'retry_cnt': None,
+                }
+            ],
+        )
+        self.assertEqual(self.taskm.beingReturned, set())
+
+        self.resource.code = 200
+        self.resource.received = []
+        replayed = yield self.taskm.replayDeadLetters(['other'])
+        self.assertEqual(replayed, [])
+        replayed = yield self.taskm.replayDeadLetters()
+        self.assertEqual(replayed, ['group'])
+        self.assertEqual([e['group_id'] for e in self.resource.received], ['group'])
+        yield self.taskm.database.sync()
+        self.assertEqual(self.taskm.database.get_items(), [])
+
+
+    @defer.inlineCallbacks
+    def test_failure_to_store_dead_letter_is_logged(self):
+        self.patch(taskmanager, 'MAX_RETRIES_OF_RESULT_RETURNING', 0)
+        self.resource.code = 500
+
+        updates = []
+
+        def update(job_id, dict_update, sync=True):
+            updates.append(defer.fail(IOError('disk full')))
+            return updates[-1]
+
+        self.patch(self.taskm.database, 'update', update)
+        env = self._env()
+        yield self.taskm.returnToSio(env, url=env['return_url'])
+        self.flushLoggedErrors(RuntimeError)
+        # The failure is handled right away, not left to the garbage collector.
+        self.assertIsNone(updates[0].result)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        self.assertEqual(self.taskm.beingReturned, set())
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_circuit(self):
+        circuit = taskmanager.CircuitBreaker(threshold=2, cooldown=10)
+        circuit.failed(0, circuit.allows(0))
+        stale = circuit.allows(1)
+        self.assertTrue(stale)
+        circuit.failed(1, circuit.allows(1))
+        self.assertIsNone(circuit.allows(5))
+        # A single probe after the cooldown.
+        probe = circuit.allows(11)
+        self.assertTrue(probe)
+        self.assertIsNone(circuit.allows(11))
+        # Attempts started before the circuit opened don't end the probe.
+        circuit.failed(11, stale)
+        self.assertEqual(circuit.openUntil, 11)
+        self.assertIsNone(circuit.allows(11))
+        circuit.failed(12, probe)
+        self.assertEqual(circuit.openUntil, 32)
+        self.assertIsNone(circuit.allows(31))
+        circuit.succeeded(circuit.allows(32))
+        self.assertTrue(circuit.allows(33))
+        self.assertTrue(circuit.allows(33))
+        self.assertEqual(circuit.cooldown, 10)
+
+    def test_cancelled_probe(self):
+        circuit = taskmanager.CircuitBreaker(threshold=1, cooldown=10)
+        circuit.failed(0, circuit.allows(0))
+        circuit.cancelled(circuit.allows(10))
+        self.assertTrue(circuit.allows(10))
+
+
+class EncodeResultTest(unittest.TestCase):
+    ENV = {'group_id': 'group', 'workers_jobs.results': {'a': {'result_code': 'OK'}}}
+
+    def _boundary(self, content_type):
+        return content_type.partition('boundary=')[2]
+
+    def test_encoding_matches_urllib3(self):
+        f, content_type = taskmanager.encode_result(self.ENV)
+        body, _ = encode_multipart_formdata(
+            {'data': json_dumps(self.ENV)}, boundary=self._boundary(content_type)
+        )
+        self.assertEqual(f.read(), body)
+
+    def test_compression(self):
+        f, content_type = taskmanager.encode_result(self.ENV, compress=True)
+        body, _ = encode_multipart_formdata(
+            {'data': json_dumps(self.ENV)}, boundary=self._boundary(content_type)
+        )
+        self.assertEqual(gzip.decompress(f.read()), body)
+
+    def test_large_results_are_spooled_to_disk(self):
+        small, _ = taskmanager.encode_result(self.ENV)
+        self.assertFalse(small._rolled)
+        env = {'results': ['x' * 1024] * (taskmanager.RETURN_SPOOL_THRESHOLD // 1024)}
+        large, _ = taskmanager.encode_result(env)
+        self.assertTrue(large._rolled)
+
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db_path = self.db_dir + '/sio_tests.db'
+        self.db = database.SQLiteDatabase(self.db_path)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def _reopen(self):
+        self.db.close()
+        self.db = database.SQLiteDatabase(self.db_path)
+
+    def test_default_backend_follows_file_format(self):
+        sqlite = 'sio.sioworkersd.database.SQLiteDatabase'
+        self.assertEqual(database.getDefaultDatabaseClassName(self.db_path), sqlite)
+        new_path = self.db_dir + '/new.db'
+        self.assertEqual(database.getDefaultDatabaseClassName(new_path), sqlite)
+        # E.g. a Berkeley DB hash database, written by older versions.
+        with open(new_path, 'wb') as f:
+            f.write(b'\0' * 4096)
+        self.assertEqual(
+            database.getDefaultDatabaseClassName(new_path),
+            'sio.sioworkersd.database.BerkeleyDatabase',
+        )
+
+    @defer.inlineCallbacks
+    def test_group_commit(self):
+        syncs = [
+            self.db.update('group%d' % i, {'status': 'to_judge'}) for i in range(10)
+        ]
+        self.assertFalse(any(d.called for d in syncs))
+        yield defer.gatherResults(syncs)
+        self.assertEqual(self.db.commits, 1)
+        self._reopen()
+        self.assertEqual(len(self.db.get_items()), 10)
+
+    @defer.inlineCallbacks
+    def test_update_and_delete(self):
+        yield self.db.update('group', {'retry_cnt': 0})
+        self.db.update('group', {'retry_cnt': 1}, sync=False)
+        self.assertEqual(self.db.get_items(), [{'id': 'group', 'retry_cnt': 1}])
+        self.db.compact()
+        self._reopen()
+        self.assertEqual(self.db.get_items(), [{'id': 'group', 'retry_cnt': 1}])
+        yield self.db.delete('group', sync=True)
+        self._reopen()
+        self.assertEqual(self.db.get_items(), [])
+
+    @defer.inlineCallbacks
+    def test_fields_are_updated_independently(self):
+        env = {'group_id': 'group', 'workers_jobs': {'a': {'task_id': 'a'}}}
+        yield self.db.update(
+            'group',
+            {'env': env, 'status': 'to_judge', 'timestamp': 1.5, 'retry_cnt': 0},
+        )
+        yield self.db.update(
+            'group', {'status': 'to_return', 'results': {'workers_jobs.results': {}}}
+        )
+        yield self.db.update('group', {'retry_cnt': 2})
+        self.assertEqual(
+            self.db.get_items(),
+            [
+                {
+                    'id': 'group',
+                    'env': env,
+                    'status': 'to_return',
+                    'timestamp': 1.5,
+                    'retry_cnt': 2,
+                    'results': {'workers_jobs.results': {}},
+                }
+            ],
+        )
+
+    def test_iter_items_in_timestamp_order(self):
+        self.db.BATCH_SIZE = 3
+        for i in range(10):
+            self.db.update(
+                'group%d' % i,
+                {'status': 'to_judge' if i % 5 else 'to_return', 'timestamp': 10 - i},
+                sync=False,
+            )
+        items = self.db.iter_items('to_judge')
+        self.assertEqual(six.next(items)['id'], 'group9')
+        # Changes made while iterating don't break the iteration.
+        self.db.delete('group8')
+        self.db.update('group0', {'status': 'to_judge'}, sync=False)
+        self.assertEqual(
+            [job['id'] for job in items],
+            ['group7', 'group6', 'group4', 'group3', 'group2', 'group1', 'group0'],
+        )
+        self.assertEqual(
+            [job['id'] for job in self.db.iter_items('to_return')], ['group5']
+        )
+
+    def test_iter_items_without_timestamps(self):
+        self.db.BATCH_SIZE = 2
+        for i in range(5):
+            fields = {'status': 'to_judge'}
+            if i % 2:
+                fields['timestamp'] = i
+            self.db.update('group%d' % i, fields, sync=False)
+        self.assertEqual(
+            [job['id'] for job in self.db.iter_items('to_judge')],
+            ['group0', 'group2', 'group4', 'group1', 'group3'],
+        )
+
+    @defer.inlineCallbacks
+    def test_task_results(self):
+        yield self.db.update('group', {'status': 'to_judge'})
+        yield self.db.add_task_result('group', 'a', {'result': 'OK'}, sync=True)
+        self.db.add_task_result('group', 'b', {'result': 'WA'})
+        self._reopen()
+        self.assertEqual(
+            list(self.db.iter_items('to_judge')),
+            [
+                {
+                    'id': 'group',
+                    'status': 'to_judge',
+                    'task_results': {'a': {'result': 'OK'}, 'b': {'result': 'WA'}},
+                }
+            ],
+        )
+        yield self.db.delete('group', sync=True)
+        yield self.db.update('group', {'status': 'to_judge'})
+        self.assertEqual(self.db.get_items(), [{'id': 'group', 'status': 'to_judge'}])
+
+    def test_unknown_fields_are_rejected(self):
+        self.assertRaises(ValueError, self.db.update, 'group', {'foo': 'bar'})
+
+    def test_sync_without_changes(self):
+        self.assertTrue(self.db.sync().called)
+
+    def test_close_commits_pending_changes(self):
+        d = self.db.update('group', {'status': 'to_judge'})
+        self._reopen()
+        self.assertTrue(d.called)
+        self.assertEqual(self.db.get_items(), [{'id': 'group', 'status': 'to_judge'}])
+
+
 @implementer(interfaces.ITransport)
 class MockTransport(object):
     def __init__(self):
@@ -152,6 +720,8 @@ class _TestWorker(server.WorkerServer):
                 return defer.Deferred()
         elif method == 'get_running':
             return self.running
+        elif method == 'reattach':
+            return []
 
 
 class WorkerManagerTest(TestWithDB):
@@ -219,6 +789,35 @@ class WorkerManagerTest(TestWithDB):
         self.assertEqual(self.wm.minVcpuOnlyWorkerRam, 64)
         self.assertEqual(self.wm.maxVcpuOnlyWorkerRam, 8192)
 
+    def test_cache_summary(self):
+        updated = []
+        self.wm.notifyOnWorkerCacheUpdate(updated.append)
+        self.assertEqual(self.wm.getWorkers()['test_worker'].cached_files, set())
+
+        self.wm.updateWorkerCache(self.worker_proto, ['/in', '/exe'])
+        self.assertEqual(
+            self.wm.getWorkers()['test_worker'].cached_files, {'/in', '/exe'}
+        )
+        self.assertEqual(updated, ['test_worker'])
+
+        # Updates from connections which weren't accepted are ignored.
+        self.wm.updateWorkerCache(_TestWorker(), ['/chk'])
+        self.assertEqual(
+            self.wm.getWorkers()['test_worker'].cached_files, {'/in', '/exe'}
+        )
+        self.assertEqual(updated, ['test_worker'])
+
+    def test_rtt(self):
+        updated = []
+        self.wm.notifyOnWorkerRttUpdate(updated.append)
+        self.wm.updateWorkerRtt(self.worker_proto, 0.25)
+        self.assertEqual(self.wm.getWorkers()['test_worker'].rtt, 0.25)
+        self.assertEqual(updated, ['test_worker'])
+
+        self.wm.updateWorkerRtt(_TestWorker(), 1)
+        self.assertEqual(self.wm.getWorkers()['test_worker'].rtt, 0.25)
+        self.assertEqual(updated, ['test_worker'])
+
     def test_stats_when_no_workers(self):
         self.wm.workerLost(self.worker_proto)
 
@@ -247,6 +846,37 @@ class WorkerManagerTest(TestWithDB):
             _fill_env({'task_id': 'hang2'}),
         )
 
+    def test_cpu_exec_on_dedicated_cores(self):
+        self.wm.newWorker(
+            'unique2',
+            _TestWorker(
+                {
+                    'name': 'dedicated',
+                    'concurrency': 1,
+                    'available_ram_mb': 4096,
+                    'can_run_cpu_exec': True,
+                    'cpu_exec_slots': 1,
+                }
+            ),
+        )
+        self.wm.runOnWorker(
+            'dedicated', _fill_env({'task_id': 'hang1', 'job_type': 'vcpu-exec'})
+        )
+        self.wm.runOnWorker('dedicated', _fill_env({'task_id': 'hang2'}))
+        self.assertEqual(self.wm.getWorkers()['dedicated'].cpu_exec_tasks, {'hang2'})
+        self.assertRaises(
+            RuntimeError,
+            self.wm.runOnWorker,
+            'dedicated',
+            _fill_env({'task_id': 'hang3'}),
+        )
+        self.assertRaises(
+            RuntimeError,
+            self.wm.runOnWorker,
+            'dedicated',
+            _fill_env({'task_id': 'hang4', 'job_type': 'vcpu-exec'}),
+        )
+
     def test_gone(self):
         d = self.wm.runOnWorker(
             'test_worker', _fill_env({'task_id': 'hang', 'job_type': 'cpu-exec'})
@@ -254,6 +884,67 @@ class WorkerManagerTest(TestWithDB):
         self.wm.workerLost(self.worker_proto)
         return self.assertFailure(d, workermanager.WorkerGone)
 
+    @defer.inlineCallbacks
+    def test_cancel_task_of_disconnected_worker(self):
+        w2 = _TestWorker(
+            dict(self.worker_proto.clientInfo, name='name2', reattach=True)
+        )
+        yield self.wm.newWorker('unique2', w2)
+        d = self.wm.runOnWorker('name2', _fill_env({'task_id': 'hang'}))
+        self.wm.workerLost(w2)
+        self.assertEqual(self.wm.getDetachedTasks('name2'), {'hang'})
+        self.assertFalse(d.called)
+        killed = yield self.wm.cancelTask('hang')
+        self.assertTrue(killed)
+        yield self.assertFailure(d, workermanager.TaskCancelled)
+        self.assertEqual(self.wm.getDetachedTasks('name2'), set())
+
+    @defer.inlineCallbacks
+    def test_prefetch(self):
+        w2 = _TestWorker(
+            dict(self.worker_proto.clientInfo, name='name2', reattach=True, queue=True)
+        )
+        yield self.wm.newWorker('unique2', w2)
+        wd = self.wm.getWorkers()['name2']
+        started = []
+        self.wm.notifyOnStartedTask(started.append)
+
+        def run(task_id, prefetch=False, job_type='vcpu-exec'):
+            env = {'task_id': task_id, 'job_type': job_type}
+            return self.wm.runOnWorker('name2', env, prefetch=prefetch)
+
+        d1 = run('hang1')
+        d2 = run('hang2')
+        d3 = run('hang3', prefetch=True)
+        d4 = run('hang4', prefetch=True)
+        self.assertEqual(wd.prefetched_tasks, ['hang3', 'hang4'])
+        self.assertRaises(RuntimeError, run, 'hang5')
+        self.assertRaises(
+            RuntimeError, run, 'hang6', prefetch=True, job_type='cpu-exec'
+        )
+        # Workers which start every task they get can't prefetch them.
+        self.assertRaises(
+            RuntimeError,
+            self.wm.runOnWorker,
+            'test_worker',
+            {'task_id': 'hang7', 'job_type': 'vcpu-exec'},
+            prefetch=True,
+        )
+
+        # The worker starts the first prefetched task when one ends.
+        d1.callback({'task_id': 'hang1'})
+        self.assertEqual(wd.prefetched_tasks, ['hang4'])
+        self.assertEqual(wd.tasks, {'hang2', 'hang3', 'hang4'})
+        self.assertEqual(started, ['hang3'])
+        # Prefetched tasks are run elsewhere when the worker is lost.
+        self.wm.workerLost(w2)
+        self.assertEqual(self.wm.getDetachedTasks('name2'), {'hang2', 'hang3'})
+        yield self.assertFailure(d4, workermanager.WorkerGone)
+        yield self.wm.cancelTask('hang2')
+        yield self.wm.cancelTask('hang3')
+        yield self.assertFailure(d2, workermanager.TaskCancelled)
+        yield self.assertFailure(d3, workermanager.TaskCancelled)
+
     def test_duplicate(self):
         w2 = _TestWorker()
         d = self.wm.newWorker('unique2', w2)
@@ -309,6 +1000,18 @@ class WorkerManagerTest(TestWithDB):
         d = self.wm.newWorker('unique7', w7)
         self.assertFailure(d, server.WorkerRejected)
 
+        w8 = _TestWorker(
+            {
+                'name': 'unique8',
+                'concurrency': 2,
+                'can_run_cpu_exec': True,
+                'available_ram_mb': 256,
+                'cpu_shares': 1,
+            }
+        )
+        d = self.wm.newWorker('unique8', w8)
+        self.assertFailure(d, server.WorkerRejected)
+
 
 class _TestClient(rpc.WorkerRPC):
     def __init__(self, running, can_run_cpu_exec=True, name='test'):
@@ -346,6 +1049,58 @@ class _TestClient(rpc.WorkerRPC):
         return d
 
 
+class _CancellableTestClient(_TestClient):
+    def __init__(self, *args):
+        _TestClient.__init__(self, *args)
+        self.hanging = {}
+        self.cancelled = []
+
+    def do_run(self, env):
+        d = _TestClient.do_run(self, env)
+        if not d.called:
+            self.hanging[env['task_id']] = d
+        return d
+
+    def cmd_cancel(self, task_id):
+        self.cancelled.append(task_id)
+        self.hanging.pop(task_id).errback(Exception('cancelled'))
+        return True
+
+
+class _ReattachingTestClient(_TestClient):
+    """Worker whose tasks outlive its connections, like the ones of
+    sio.protocol.worker.WorkerFactory. They end when the test fires them."""
+
+    def __init__(self, tasks):
+        _TestClient.__init__(self, set())
+        # Shared by the connections, maps ids of the tasks to Deferreds
+        # of their results.
+        self.tasks = tasks
+
+    def getHelloData(self):
+        data = _TestClient.getHelloData(self)
+        data['reattach'] = True
+        data['queue'] = True
+        return data
+
+    def cmd_get_running(self):
+        return list(self.tasks)
+
+    def cmd_run(self, env):
+        d = self.tasks[env['task_id']] = defer.Deferred()
+        return d
+
+    def cmd_reattach(self, task_ids):
+        for task_id in list(self.tasks):
+            if task_id not in task_ids:
+                del self.tasks[task_id]
+        return [task_id for task_id in task_ids if task_id in self.tasks]
+
+    def cmd_get_result(self, task_id):
+        d = self.tasks[task_id] = defer.Deferred()
+        return d
+
+
 class IntegrationTest(TestWithDB):
     def __init__(self, *args, **kwargs):
         super(IntegrationTest, self).__init__(*args, **kwargs)
@@ -431,6 +1186,168 @@ class IntegrationTest(TestWithDB):
 
         return self._wrap_test(cb, {}, set())
 
+    def _connect(self, client_class, *args):
+        creator = protocol.ClientCreator(reactor, client_class, *args)
+        d = creator.connectTCP('127.0.0.1', self.port.getHost().port)
+
+        def cb(client):
+            self.addCleanup(client.transport.loseConnection)
+            return task.deferLater(reactor, 0.5, lambda: client)
+
+        return d.addCallback(cb)
+
+    @defer.inlineCallbacks
+    def test_timed_out_task_is_cancelled(self):
+        client = yield self._connect(_CancellableTestClient, set())
+        d = self.taskm.addTaskGroup(
+            _wrap_into_group_env(_fill_env({'task_id': 'hang'}))
+        )
+        failure = yield self.assertFailure(d, taskmanager.MultiException)
+        self.assertIn('TimeoutError', str(failure))
+        self.assertEqual(client.cancelled, ['hang'])
+        # The worker is still there, with its slot free.
+        self.assertIn('test', self.wm.workers)
+        self.assertEqual(self.wm.workerData['test'].tasks, set())
+        d = self.taskm.addTaskGroup(
+            _wrap_into_group_env(_fill_env({'task_id': 'ok'}))
+        )
+        result = yield d
+        self.assertIn('ok', result['workers_jobs.results'])
+
+    @defer.inlineCallbacks
+    def test_cancel_group(self):
+        client = yield self._connect(_CancellableTestClient, set())
+        env = {
+            'group_id': 'g',
+            'workers_jobs': {
+                'a': {'task_id': 'hang_a', 'group_id': 'g', 'job_type': 'cpu-exec'},
+                'b': {'task_id': 'hang_b', 'group_id': 'g', 'job_type': 'cpu-exec'},
+            },
+        }
+        d = self.taskm.addTaskGroup(env)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        # One task runs on the worker, the other one waits for it.
+        self.assertEqual(len(client.hanging), 1)
+        assigned = [
+            tid for tid in ('hang_a', 'hang_b') if self.wm.isTaskAssigned(tid)
+        ]
+        self.assertEqual(len(assigned), 1)
+        self.assertTrue(self.taskm.cancelGroup('g'))
+        self.assertFalse(self.taskm.cancelGroup('g2'))
+        yield self.assertFailure(d, taskmanager.MultiException)
+        self.assertEqual(len(client.cancelled), 1)
+        self.assertEqual(client.running, set())
+        self.assertIn('test', self.wm.workers)
+        self.assertNotIn('hang_a', self.taskm.inProgress)
+        self.assertNotIn('hang_b', self.taskm.inProgress)
+
+    @defer.inlineCallbacks
+    def test_reconnected_worker_reattaches_tasks(self):
+        tasks = {}
+        client = yield self._connect(_ReattachingTestClient, tasks)
+        d = self.taskm.addTaskGroup(
+            _wrap_into_group_env(_fill_env({'task_id': 'hang'}))
+        )
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(list(tasks), ['hang'])
+        client.transport.loseConnection()
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        # The task waits for the worker instead of being run elsewhere.
+        self.assertEqual(self.wm.workers, {})
+        self.assertFalse(self.sched.tasks_queues['both'])
+        self.assertFalse(d.called)
+
+        client = yield self._connect(_ReattachingTestClient, tasks)
+        self.assertEqual(self.wm.workerData['test'].tasks, {'hang'})
+        self.assertEqual(self.sched.workers['test'].running_tasks, 1)
+        tasks.pop('hang').callback({'task_id': 'hang', 'foo': 'bar'})
+        result = yield d
+        self.assertEqual(result['workers_jobs.results']['hang']['foo'], 'bar')
+        self.assertEqual(self.wm.workerData['test'].tasks, set())
+        self.assertEqual(self.sched.workers['test'].running_tasks, 0)
+
+    @defer.inlineCallbacks
+    def test_tasks_of_worker_which_is_late_are_run_again(self):
+        self.wm.reattachTimeout = 0.2
+        tasks = {}
+        client = yield self._connect(_ReattachingTestClient, tasks)
+        d = self.taskm.addTaskGroup(
+            _wrap_into_group_env(_fill_env({'task_id': 'hang'}))
+        )
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        first_run = tasks['hang']
+        client.transport.loseConnection()
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        self.assertEqual(self.sched.tasks_queues['both'].chooseTask().id, 'hang')
+
+        # The old run isn't reattached, but the task is run again.
+        yield self._connect(_ReattachingTestClient, tasks)
+        self.assertEqual(self.wm.workerData['test'].tasks, {'hang'})
+        self.assertIsNot(tasks['hang'], first_run)
+        tasks.pop('hang').callback({'task_id': 'hang'})
+        yield d
+
+    @defer.inlineCallbacks
+    def test_busy_worker_gets_prefetched_tasks(self):
+        self.sched.prefetch_depth = 1
+        tasks = {}
+        yield self._connect(_ReattachingTestClient, tasks)
+        env = {
+            'group_id': 'g',
+            'workers_jobs': {
+                'a': {'task_id': 'a', 'group_id': 'g', 'job_type': 'vcpu-exec'},
+                'b': {'task_id': 'b', 'group_id': 'g', 'job_type': 'vcpu-exec'},
+            },
+        }
+        d = self.taskm.addTaskGroup(env)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        # Both are on the worker, which has a single slot.
+        self.assertEqual(sorted(tasks), ['a', 'b'])
+        self.assertEqual(len(self.wm.workerData['test'].prefetched_tasks), 1)
+        self.assertEqual(len(self.sched.workers['test'].reserved_tasks), 1)
+        (prefetched,) = self.wm.workerData['test'].prefetched_tasks
+        (running,) = set(tasks) - {prefetched}
+
+        def started():
+            return sum(
+                stats['started']
+                for stats in self.taskm.getStats()['queue_wait'].values()
+            )
+
+        # The prefetched task waits in the queue until it starts.
+        self.assertEqual(started(), 1)
+        tasks.pop(running).callback({'task_id': running})
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(started(), 2)
+        tasks.pop(prefetched).callback({'task_id': prefetched})
+        yield d
+        self.assertEqual(self.wm.workerData['test'].tasks, set())
+        self.assertEqual(self.sched.workers['test'].running_tasks, 0)
+
+    def test_hung_worker_is_dropped(self):
+        class HungClient(_TestClient):
+            def _processMessage(self, msg):
+                # Runs the task, and then stops answering.
+                if msg['type'] != 'ping':
+                    _TestClient._processMessage(self, msg)
+
+        self.wm.serverFactory.heartbeatInterval = 0.1
+        creator = protocol.ClientCreator(reactor, HungClient, set())
+
+        def cb2(d):
+            self.assertFalse(d.called)
+            self.assertDictEqual(self.wm.workers, {})
+            self.assertEqual(self.sched.tasks_queues['both'].chooseTask().id, 'hang')
+
+        def cb(client):
+            self.addCleanup(client.transport.loseConnection)
+            d = self.taskm.addTaskGroup(
+                _wrap_into_group_env(_fill_env({'task_id': 'hang'}))
+            )
+            return task.deferLater(reactor, 1, cb2, d)
+
+        return creator.connectTCP('127.0.0.1', self.port.getHost().port).addCallback(cb)
+
     def test_cpu_exec(self):
         def cb4(d):
             self.assertTrue(d.called)
@@ -517,3 +1434,22 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(get_required_ram_for_job(env), 256)
         env['abc_mem_limit'] = 768 * 1024
         self.assertEqual(get_required_ram_for_job(env), 768)
+
+    def test_time_limit(self):
+        env = {'task_id': 'asdf', 'job_type': 'cpu-exec'}
+        self.assertIsNone(get_time_limit_for_job(env))
+        env['exec_time_limit'] = 1500
+        self.assertEqual(get_time_limit_for_job(env), 1500)
+        env = {'task_id': 'asdf', 'job_type': 'compile'}
+        self.assertEqual(get_time_limit_for_job(env), 30000)
+        env['compilation_time_limit'] = 1000
+        self.assertEqual(get_time_limit_for_job(env), 1000)
+        self.assertIsNone(get_time_limit_for_job({'job_type': 'ping'}))
+
+    def test_cpu_shares_and_disk(self):
+        self.assertEqual(get_cpu_shares_for_job({'job_type': 'compile'}), 2)
+        self.assertEqual(get_cpu_shares_for_job({'job_type': 'sio2jail-exec'}), 1)
+        self.assertEqual(get_cpu_shares_for_job({'job_type': 'abc'}), 1)
+        self.assertEqual(get_required_disk_for_job({'job_type': 'ingen'}), 1024)
+        self.assertEqual(get_required_disk_for_job({'job_type': 'cpu-exec'}), 128)
+        self.assertEqual(get_required_disk_for_job({'job_type': 'abc'}), 256)
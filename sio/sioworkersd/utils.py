@@ -1,3 +1,6 @@
+from __future__ import absolute_import
+import importlib
+
 # Default ram requirements in KiB
 # This is in KiB because oioioi apparently mostly uses KiB,
 # while sioworkersd uses MiB.
@@ -12,6 +15,31 @@ DEFAULT_RAM_REQUIREMENTS = {
 }
 
 
+# Default CPU shares used by jobs. Workers which advertise their
+# ``cpu_shares`` (roughly, CPUs) are assigned jobs as long as the shares
+# of the jobs add up to at most that, instead of counting every job as
+# one of ``concurrency`` slots.
+DEFAULT_CPU_SHARES = {
+    'ping': 1,
+    'ingen': 1,
+    'inwer': 1,
+    'compile': 2,
+    'exec': 1,
+    'default': 1,
+}
+
+# Default scratch disk space requirements in MiB, accounted for on workers
+# which advertise their ``scratch_disk_mb``.
+DEFAULT_DISK_REQUIREMENTS = {
+    'ping': 0,
+    'ingen': 1024,
+    'inwer': 128,
+    'compile': 512,
+    'exec': 128,
+    'default': 256,
+}
+
+
 # Returns ram required for specific job in MiB
 def get_required_ram_for_job(env):
     job_type = env['job_type']
@@ -31,3 +59,46 @@ def get_required_ram_for_job(env):
 
     # Convert KiB to MiB
     return required_ram / 1024
+
+
+def _get_default_for_job(defaults, job_type):
+    if job_type.endswith('exec'):
+        return defaults['exec']
+    return defaults.get(job_type, defaults['default'])
+
+
+# Returns CPU shares used by specific job
+def get_cpu_shares_for_job(env):
+    return _get_default_for_job(DEFAULT_CPU_SHARES, env['job_type'])
+
+
+# Returns scratch disk space required for specific job in MiB
+def get_required_disk_for_job(env):
+    return _get_default_for_job(DEFAULT_DISK_REQUIREMENTS, env['job_type'])
+
+
+# Default time limits in ms (see sio.compilers.common and sio.executors),
+# and prefixes of the keys of the time limits in task env.
+DEFAULT_TIME_LIMITS = {
+    'compile': 30000,
+    'ingen': 600 * 1000,
+    'inwer': 300000,
+}
+TIME_LIMIT_PREFIXES = {
+    'compile': 'compilation_',
+}
+
+
+# Returns the declared time limit of a job in ms, or None if it's unknown
+def get_time_limit_for_job(env):
+    job_type = env['job_type']
+    if job_type.endswith('exec'):
+        return env.get('exec_time_limit')
+    prefix = TIME_LIMIT_PREFIXES.get(job_type, job_type + '_')
+    return env.get(prefix + 'time_limit', DEFAULT_TIME_LIMITS.get(job_type))
+
+
+# Returns the class given by its dotted path, e.g. the --scheduler option
+def load_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
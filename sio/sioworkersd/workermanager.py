@@ -1,14 +1,25 @@
 from __future__ import absolute_import
 from sio.sioworkersd import server
-from sio.protocol.rpc import TimeoutError
+from sio.sioworkersd.utils import DEFAULT_CPU_SHARES, DEFAULT_DISK_REQUIREMENTS
+from sio.protocol.rpc import (
+    DEFAULT_HEARTBEAT_INTERVAL,
+    NoSuchMethodError,
+    TimeoutError,
+)
 from twisted.application import service
 from twisted.internet import reactor, defer
 from twisted.logger import Logger
+from sortedcontainers import SortedList
 import six
 
 log = Logger()
 
 TASK_TIMEOUT = 60 * 60
+# How long to wait for a worker to kill a cancelled task.
+CANCEL_TIMEOUT = 60
+# How long (in seconds) the tasks of a disconnected worker wait for it
+# to reconnect, before they are run on another one.
+REATTACH_TIMEOUT = 60
 
 
 class WorkerGone(Exception):
@@ -17,6 +28,12 @@ class WorkerGone(Exception):
     pass
 
 
+class TaskCancelled(Exception):
+    """Task was cancelled while its worker was disconnected."""
+
+    pass
+
+
 class Worker(object):
     """Information about a worker.
     ``info``: clientInfo dictionary, passed from worker
@@ -25,7 +42,27 @@ class Worker(object):
     ``is_running_cpu_exec``: bool, True if the worker is executing cpu-exec
         job, and (because such jobs are exclusive) can't run any other job
     ``concurrency``: number of tasks that worker can handle at the same time
+    ``cpu_exec_slots``: number of cpu-exec jobs that worker can run at the
+        same time on cores dedicated to them, alongside other jobs (they
+        don't count towards ``concurrency``); 0 if cpu-exec jobs are
+        exclusive
+    ``cpu_exec_tasks``: set() of ``task_id``s of cpu-exec jobs running on
+        the dedicated cores
+    ``can_queue``: bool, True if the worker queues tasks sent when all its
+        slots are taken, so that they may be prefetched
+    ``prefetched_tasks``: list of ``task_id``s of tasks sent to the worker
+        ahead of time (they are in ``tasks`` too), which it starts in this
+        order when its other tasks end, see ``runOnWorker``
     ``available_ram_mb``: total amount of RAM that worker can dedicate to tasks
+    ``cpu_shares``: total CPU shares of tasks that worker can run at the same
+        time (see sio.sioworkersd.utils.DEFAULT_CPU_SHARES), or None if
+        every task takes one of ``concurrency`` slots
+    ``scratch_disk_mb``: total scratch disk space that worker can dedicate
+        to tasks, or None if it isn't accounted for
+    ``cached_files``: set of filetracker paths of files recently used by
+        the worker, which are likely to be in its cache
+    ``rtt``: average round-trip time (in seconds) of heartbeats sent to
+        the worker, or None if not measured yet
     """
 
     def __init__(self, info, tasks, is_running_cpu_exec):
@@ -35,22 +72,67 @@ class Worker(object):
         self.concurrency = info['concurrency']
         self.available_ram_mb = info['available_ram_mb']
         self.can_run_cpu_exec = info['can_run_cpu_exec']
+        # Older workers don't send these.
+        self.cpu_exec_slots = info.get('cpu_exec_slots', 0)
+        self.cpu_exec_tasks = set()
+        self.can_queue = info.get('queue', False)
+        self.prefetched_tasks = []
+        self.cpu_shares = info.get('cpu_shares')
+        self.scratch_disk_mb = info.get('scratch_disk_mb')
+        self.cached_files = set(info.get('cached_files', ()))
+        self.rtt = None
         # These arguments should have been already parsed with json.loads
         assert isinstance(self.concurrency, int)
         assert isinstance(self.available_ram_mb, int)
         assert isinstance(self.can_run_cpu_exec, bool)
+        assert isinstance(self.cpu_exec_slots, int)
+        assert self.cpu_exec_slots == 0 or self.can_run_cpu_exec
+        # Every job must fit on the worker.
+        assert self.cpu_shares is None or (
+            isinstance(self.cpu_shares, int)
+            and self.cpu_shares >= max(six.itervalues(DEFAULT_CPU_SHARES))
+        )
+        assert self.scratch_disk_mb is None or (
+            isinstance(self.scratch_disk_mb, int)
+            and self.scratch_disk_mb >= max(six.itervalues(DEFAULT_DISK_REQUIREMENTS))
+        )
 
 
 class WorkerManager(service.MultiService):
-    def __init__(self):
+    def __init__(
+        self,
+        heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+        reattach_timeout=REATTACH_TIMEOUT,
+    ):
+        """``heartbeat_interval`` is how often (in seconds) workers are
+        pinged, so that the hung ones are dropped, or None to only notice
+        broken connections.
+
+        ``reattach_timeout`` is how long the tasks of a disconnected worker
+        wait for it to reconnect, or None to run them on other workers
+        right away. Only workers which say that they can reattach tasks
+        get the chance.
+        """
         service.MultiService.__init__(self)
+        self.heartbeatInterval = heartbeat_interval
+        self.reattachTimeout = reattach_timeout
         self.workers = {}
         self.workerData = {}
         self.deferreds = {}
+        # Cancel calls of tasks which have timed out, see runOnWorker.
+        self._timeoutCancels = {}  # Map: task_id -> Deferred
+        # Lost workers whose tasks wait for them to reconnect, see workerLost.
+        self._detached = {}  # Map: name -> (Worker, timer)
         self.serverFactory = None
         self.newWorkerCallback = None
         self.lostWorkerCallback = None
+        self.workerCacheCallback = None
+        self.workerRttCallback = None
+        self.reattachedTaskCallback = None
+        self.startedTaskCallback = None
 
+        # RAM of connected workers, sorted, see _updateWorkerStats().
+        self._workersRam = {True: SortedList(), False: SortedList()}
         # Various worker statistics, check out _updateWorkerStats().
         self.minAnyCpuWorkerRam = None
         self.maxAnyCpuWorkerRam = None
@@ -58,7 +140,7 @@ class WorkerManager(service.MultiService):
         self.maxVcpuOnlyWorkerRam = None
 
     def makeFactory(self):
-        f = server.WorkerServerFactory(self)
+        f = server.WorkerServerFactory(self, self.heartbeatInterval)
         self.serverFactory = f
         return f
 
@@ -72,6 +154,28 @@ class WorkerManager(service.MultiService):
             raise ValueError()
         self.lostWorkerCallback = callback
 
+    def notifyOnWorkerCacheUpdate(self, callback):
+        if not callable(callback):
+            raise ValueError()
+        self.workerCacheCallback = callback
+
+    def notifyOnWorkerRttUpdate(self, callback):
+        if not callable(callback):
+            raise ValueError()
+        self.workerRttCallback = callback
+
+    def notifyOnReattachedTask(self, callback):
+        if not callable(callback):
+            raise ValueError()
+        self.reattachedTaskCallback = callback
+
+    def notifyOnStartedTask(self, callback):
+        """The callback gets the id of a prefetched task when the worker
+        starts it."""
+        if not callable(callback):
+            raise ValueError()
+        self.startedTaskCallback = callback
+
     @defer.inlineCallbacks
     def newWorker(self, uid, proto):
         log.info('New worker {w} uid={uid}', w=proto.name, uid=uid)
@@ -80,9 +184,55 @@ class WorkerManager(service.MultiService):
             proto.transport.loseConnection()
             log.warn('WARNING: Worker {w} connected twice and was dropped', w=name)
             raise server.DuplicateWorker()
+        # Tasks of the previous connection, which wait for this one.
+        lost = None
+        if name in self._detached:
+            lost, timer = self._detached.pop(name)
+            timer.cancel()
+        try:
+            worker, attached = yield self._acceptWorker(proto, lost)
+        except:
+            if lost is not None:
+                self._abandonTasks(lost.tasks)
+            raise
+        self.workers[name] = proto
+        self.workerData[name] = worker
+
+        self._workersRam[worker.can_run_cpu_exec].add(worker.available_ram_mb)
+        self._updateWorkerStats()
+        if self.newWorkerCallback:
+            self.newWorkerCallback(name)
+        if lost is not None:
+            for tid in lost.tasks.copy():
+                if tid in attached:
+                    self._reattachTask(name, lost, tid)
+                else:
+                    # The worker has lost it, e.g. it has been restarted.
+                    self.deferreds[tid].errback(WorkerGone())
+
+    @defer.inlineCallbacks
+    def _acceptWorker(self, proto, lost):
+        """Checks whether the worker may be used. Returns a pair of
+        the worker's ``Worker`` and the ids of the tasks of the ``lost``
+        one which it has reattached, or raises ``WorkerRejected``."""
+        name = proto.name
+        attached = []
+        if proto.clientInfo.get('reattach') and self.reattachTimeout:
+            wanted = sorted(lost.tasks) if lost is not None else []
+            # The worker kills the other tasks of its previous connections.
+            try:
+                attached = yield proto.call('reattach', wanted, timeout=CANCEL_TIMEOUT)
+            except Exception as e:
+                log.warn(
+                    'Rejecting worker {w} because it failed to reattach'
+                    ' tasks ({e})',
+                    w=name,
+                    e=e,
+                )
+                raise server.WorkerRejected()
         running = yield proto.call('get_running', timeout=5)
-        # if running is non-empty the worker is executing something
-        if running:
+        # if the worker is executing something else, reject it
+        if set(running) - set(attached):
             log.warn('Rejecting worker {w} because it is running tasks', w=name)
             raise server.WorkerRejected()
         # if information received from worker doesn't meet expectations
@@ -98,37 +248,176 @@ class WorkerManager(service.MultiService):
                 d=proto.clientInfo,
             )
             raise server.WorkerRejected()
-        self.workers[name] = proto
-        self.workerData[name] = worker
+        defer.returnValue((worker, set(attached)))
 
-        self._updateWorkerStats()
-        if self.newWorkerCallback:
-            self.newWorkerCallback(name)
+    def _reattachTask(self, name, lost, tid):
+        """Binds a task of the lost connection of the worker to the new
+        one, which delivers its result."""
+        log.info('Reattaching {tid} to {w}', tid=tid, w=name)
+        wd = self.workerData[name]
+        wd.tasks.add(tid)
+        if tid in lost.cpu_exec_tasks:
+            wd.cpu_exec_tasks.add(tid)
+        elif lost.is_running_cpu_exec:
+            wd.is_running_cpu_exec = True
+        d = self.workers[name].call('get_result', tid, timeout=TASK_TIMEOUT)
+        d.chainDeferred(self.deferreds[tid])
+        if self.reattachedTaskCallback:
+            self.reattachedTaskCallback(name, tid)
+
+    def _abandonTasks(self, tids):
+        """Fails the tasks of a lost worker, so that they are run on
+        other ones."""
+        for tid in tids.copy():
+            self.deferreds[tid].errback(WorkerGone())
+
+    def _reattachTimedOut(self, name):
+        lost, _ = self._detached.pop(name)
+        log.warn(
+            'Worker {w} has not reconnected, its tasks will be run on other ones',
+            w=name,
+        )
+        self._abandonTasks(lost.tasks)
+
+    def getDetachedTasks(self, name):
+        """Returns the ids of the tasks of the lost worker, which wait for it
+        to reconnect."""
+        if name not in self._detached:
+            return set()
+        return set(self._detached[name][0].tasks)
 
     def workerLost(self, proto):
         wd = self.workerData[proto.name]
-        # _free in runOnWorker will delete from wd.tasks, so copy here
         del self.workers[proto.name]
         del self.workerData[proto.name]
-        for i in wd.tasks.copy():
-            self.deferreds[i].errback(WorkerGone())
+        detach = bool(self.reattachTimeout) and wd.info.get('reattach', False)
+        detached = set()
+        for i in wd.tasks:
+            if i in self._timeoutCancels:
+                # The task has already failed, it waits for the cancel call.
+                self._timeoutCancels.pop(i).errback(WorkerGone())
+            elif detach and i not in wd.prefetched_tasks:
+                # Prefetched tasks have (probably) not started yet, so
+                # they are run on other workers right away.
+                detached.add(i)
+            else:
+                self.deferreds[i].errback(WorkerGone())
+        wd.tasks = detached
+        if detached:
+            log.info(
+                'Tasks of {w} wait {t} s for it to reconnect',
+                w=proto.name,
+                t=self.reattachTimeout,
+            )
+            timer = reactor.callLater(
+                self.reattachTimeout, self._reattachTimedOut, proto.name
+            )
+            self._detached[proto.name] = (wd, timer)
 
+        self._workersRam[wd.can_run_cpu_exec].remove(wd.available_ram_mb)
         self._updateWorkerStats()
         if self.lostWorkerCallback:
             self.lostWorkerCallback(proto.name)
 
+    def updateWorkerCache(self, proto, cached_files):
+        """Updates the summary of the worker's filetracker cache."""
+        name = proto.name
+        # Rejected and duplicate workers aren't registered.
+        if self.workers.get(name) is not proto:
+            return
+        self.workerData[name].cached_files = set(cached_files)
+        if self.workerCacheCallback:
+            self.workerCacheCallback(name)
+
+    def updateWorkerRtt(self, proto, rtt):
+        """Updates the round-trip time measured by the worker's heartbeats."""
+        name = proto.name
+        if self.workers.get(name) is not proto:
+            return
+        self.workerData[name].rtt = rtt
+        if self.workerRttCallback:
+            self.workerRttCallback(name)
+
     def getWorkers(self):
         return self.workerData
 
-    def runOnWorker(self, worker, task):
+    def _cancelOnWorker(self, worker, tid):
+        """Kills the task on the worker. Returns a Deferred, which fires
+        with True when it's done, False if the task isn't running, or None
+        if it's impossible."""
+        w = self.workers[worker]
+        d = w.call('cancel', tid, timeout=CANCEL_TIMEOUT)
+
+        def _failed(failure):
+            if failure.check(NoSuchMethodError):
+                log.warn('Worker {w} is too old to cancel tasks', w=worker)
+            elif not failure.check(WorkerGone):
+                log.failure(
+                    'Failed to cancel {tid} on {w}', failure, tid=tid, w=worker
+                )
+            return None
+
+        d.addErrback(_failed)
+        return d
+
+    def isTaskAssigned(self, tid):
+        """Returns whether the task has been sent to a worker (including
+        the prefetched tasks and the ones of disconnected workers) and
+        hasn't finished yet."""
+        return tid in self.deferreds
+
+    def cancelTask(self, tid):
+        """Kills a running task on its worker, which then fails.
+
+        Returns a Deferred, which fires with True when the task is killed,
+        False if it isn't running, or None if it can't be killed.
+        """
+        for name, wd in six.iteritems(self.workerData):
+            if tid in wd.tasks and tid not in self._timeoutCancels:
+                log.info('Cancelling {tid} on {w}', tid=tid, w=name)
+                return self._cancelOnWorker(name, tid)
+        for name, (lost, timer) in six.iteritems(self._detached):
+            if tid in lost.tasks:
+                # It's not reattached, so the worker kills it when it's back.
+                log.info('Cancelling {tid} of disconnected {w}', tid=tid, w=name)
+                lost.tasks.remove(tid)
+                if not lost.tasks:
+                    timer.cancel()
+                    del self._detached[name]
+                self.deferreds[tid].errback(TaskCancelled())
+                return defer.succeed(True)
+        return defer.succeed(False)
+
+    def runOnWorker(self, worker, task, prefetch=False):
+        """Runs a task on the worker. With ``prefetch``, the worker's slots
+        may be all taken, and it starts the task when one of its tasks ends
+        (except cpu-exec jobs on dedicated cores), after the tasks prefetched
+        earlier."""
         w = self.workers[worker]
         wd = self.workerData[worker]
         job_type = task['job_type']
+        # Whether it's a cpu-exec job running on a dedicated core.
+        dedicated = job_type == 'cpu-exec' and wd.cpu_exec_slots > 0
         if wd.is_running_cpu_exec:
             raise RuntimeError('Tried to send task to worker running cpu-exec job')
-        if len(wd.tasks) >= wd.concurrency:
+        if prefetch:
+            if not wd.can_queue:
+                raise RuntimeError(
+                    "Tried to prefetch task on worker which can't queue it"
+                )
+            if job_type == 'cpu-exec':
+                raise RuntimeError('Tried to prefetch cpu-exec job')
+        elif dedicated:
+            if len(wd.cpu_exec_tasks) >= wd.cpu_exec_slots:
+                raise RuntimeError(
+                    'Tried to send cpu-exec job to worker with no free cpu-exec slots'
+                )
+        elif (
+            len(wd.tasks) - len(wd.cpu_exec_tasks) - len(wd.prefetched_tasks)
+            >= wd.concurrency
+        ):
             raise RuntimeError('Tried to send task to fully loaded worker')
-        if job_type == 'cpu-exec':
+        elif job_type == 'cpu-exec':
             if wd.tasks:
                 raise RuntimeError('Tried to send cpu-exec job to busy worker')
             if not wd.can_run_cpu_exec:
@@ -139,15 +428,57 @@ class WorkerManager(service.MultiService):
             wd.is_running_cpu_exec = True
         tid = task['task_id']
         log.info(
-            'Running {job_type} {tid} on {w}', job_type=job_type, tid=tid, w=worker
+            '{what} {job_type} {tid} on {w}',
+            what='Prefetching' if prefetch else 'Running',
+            job_type=job_type,
+            tid=tid,
+            w=worker,
         )
         wd.tasks.add(tid)
+        if prefetch:
+            wd.prefetched_tasks.append(tid)
+        elif dedicated:
+            wd.cpu_exec_tasks.add(tid)
         d = w.call('run', task, timeout=TASK_TIMEOUT)
         self.deferreds[tid] = d
 
+        def _trap_timeout(failure):
+            failure.trap(TimeoutError)
+            log.warn(
+                'WARNING: Worker {w} timed out while executing {tid}', w=worker, tid=tid
+            )
+            # The task is freed once it's killed, so that the worker
+            # doesn't get more tasks than it can run.
+            cancel = self._timeoutCancels[tid] = self._cancelOnWorker(worker, tid)
+
+            def _cancelled(killed):
+                # It's gone already if the worker has been lost.
+                self._timeoutCancels.pop(tid, None)
+                if killed is None and worker in self.workers:
+                    # The task would keep its slot, so drop the whole worker.
+                    self.workers[worker].transport.loseConnection()
+                return failure
+
+            cancel.addCallback(_cancelled)
+            return cancel
+
         def _free(x):
-            wd.tasks.discard(tid)
             del self.deferreds[tid]
+            # The task may have been reattached to a new connection of
+            # the worker since, or the worker may be gone.
+            wd = self.workerData.get(worker)
+            if wd is None or tid not in wd.tasks:
+                return x
+            wd.tasks.discard(tid)
+            if tid in wd.prefetched_tasks:
+                # It's been cancelled before it started.
+                wd.prefetched_tasks.remove(tid)
+            elif tid not in wd.cpu_exec_tasks and wd.prefetched_tasks:
+                # The worker starts the first prefetched task in its slot.
+                started = wd.prefetched_tasks.pop(0)
+                if self.startedTaskCallback:
+                    self.startedTaskCallback(started)
+            wd.cpu_exec_tasks.discard(tid)
             if wd.is_running_cpu_exec and wd.tasks:
                 log.critical(
                     'FATAL: impossible happened: worker was running '
@@ -157,38 +488,20 @@ class WorkerManager(service.MultiService):
             wd.is_running_cpu_exec = False
             return x
 
-        def _trap_timeout(failure):
-            failure.trap(TimeoutError)
-            # This is probably the ugliest, most blunt solution possible,
-            # but it at least works. TODO kill the task on the worker.
-            w.transport.loseConnection()
-            log.warn(
-                'WARNING: Worker {w} timed out while executing {tid}', w=worker, tid=tid
-            )
-            return failure
-
-        d.addBoth(_free)
         d.addErrback(_trap_timeout)
+        d.addBoth(_free)
         return d
 
     def _updateWorkerStats(self):
-        """Recalculates all worker statistics.
+        """Updates all worker statistics.
 
-        This method should be called when some worker joins or leaves.
+        This method should be called when some worker joins or leaves,
+        after updating ``self._workersRam``.
         """
-        any_cpus_ram = [
-            worker.available_ram_mb
-            for _, worker in six.iteritems(self.workerData)
-            if worker.can_run_cpu_exec
-        ]
-
-        vcpu_onlys_ram = [
-            worker.available_ram_mb
-            for _, worker in six.iteritems(self.workerData)
-            if not worker.can_run_cpu_exec
-        ]
-
-        self.minAnyCpuWorkerRam = min(any_cpus_ram) if any_cpus_ram else None
-        self.maxAnyCpuWorkerRam = max(any_cpus_ram) if any_cpus_ram else None
-        self.minVcpuOnlyWorkerRam = min(vcpu_onlys_ram) if vcpu_onlys_ram else None
-        self.maxVcpuOnlyWorkerRam = max(vcpu_onlys_ram) if vcpu_onlys_ram else None
+        any_cpus_ram = self._workersRam[True]
+        vcpu_onlys_ram = self._workersRam[False]
+
+        self.minAnyCpuWorkerRam = any_cpus_ram[0] if any_cpus_ram else None
+        self.maxAnyCpuWorkerRam = any_cpus_ram[-1] if any_cpus_ram else None
+        self.minVcpuOnlyWorkerRam = vcpu_onlys_ram[0] if vcpu_onlys_ram else None
+        self.maxVcpuOnlyWorkerRam = vcpu_onlys_ram[-1] if vcpu_onlys_ram else None
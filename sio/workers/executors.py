@@ -114,6 +114,9 @@ def execute_command(
 
     ``stdout``
       Only when ``capture_output=True``: output of the command
+
+    If the job which the thread runs (see ``sio.workers.util.RunningJob``)
+    is cancelled, the command is killed and ``JobCancelled`` is raised.
     """
     # Using temporary file is way faster than using subproces.PIPE
     # and it prevents deadlocks.
@@ -121,6 +124,13 @@ def execute_command(
 
     logger.debug('Executing: %s', command)
 
+    job = util.current_job()
+    if job is not None and job.cancelled:
+        # The descriptors are handed over to the command, which won't run.
+        for fd in fds_to_close:
+            os.close(fd)
+        raise util.JobCancelled()
+
     stdout = capture_output and tempfile.TemporaryFile() or stdout
     # redirect output to /dev/null if None given
     devnull = open(os.devnull, 'wb')
@@ -148,6 +158,9 @@ def execute_command(
         preexec_fn=os.setpgrp,
     )
 
+    if job is not None:
+        job.add_process_group(p.pid)
+
     for fd in fds_to_close:
         os.close(fd)
 
@@ -163,6 +176,8 @@ def execute_command(
 
     rc = p.wait()
     ret_env['return_code'] = rc
+    if job is not None:
+        job.remove_process_group(p.pid)
 
     if kill_timer:
         kill_timer.cancel()
@@ -184,6 +199,8 @@ def execute_command(
         if split_lines:
             ret_env['stdout'] = ret_env['stdout'].split(b'\n')
 
+    if job is not None and job.cancelled:
+        raise util.JobCancelled()
     if rc and not ignore_errors and rc not in extra_ignore_errors:
         raise ExecError(
             'Failed to execute command: %s. Returned with code %s\n' % (command, rc)
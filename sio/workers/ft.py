@@ -7,6 +7,7 @@ import six.moves.urllib.request
 import time
 import shutil
 import logging
+import tempfile
 import threading
 import hashlib
 
@@ -117,6 +118,24 @@ def download(environ, key, dest=None, skip_if_exists=False, **kwargs):
     return dest
 
 
+def fetch_to_cache(environ, paths):
+    """Downloads the files from filetracker ``paths`` to the cache of the
+    client, so that the jobs which need them later get them from there.
+
+    Paths not to be taken from filetracker (see :func:`download`) are
+    skipped.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for i, path in enumerate(paths):
+            if _use_filetracker(path, environ):
+                logger.debug("Prefetching %s", path)
+                dest = os.path.join(tmpdir, str(i))
+                instance().get_file(path, dest, add_to_cache=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def upload(environ, key, source, dest=None, **kwargs):
     """Uploads the file from ``source`` to filetracker under ``environ[key]``
     name.
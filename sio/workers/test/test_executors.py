@@ -3,6 +3,8 @@ import glob
 import os.path
 import re
 import filecmp
+import threading
+import time
 
 from sio.assertion_utils import (
     ok_,
@@ -36,9 +38,16 @@ from sio.workers.executors import (
     Sio2JailExecutor,
     RealTimeSio2JailExecutor,
     ExecError,
+    execute_command,
 )
 from sio.workers.file_runners import get_file_runner
-from sio.workers.util import tempcwd, TemporaryCwd
+from sio.workers.util import (
+    tempcwd,
+    TemporaryCwd,
+    CancellableJob,
+    JobCancelled,
+    RunningJob,
+)
 import six
 
 import pytest
@@ -855,6 +864,38 @@ def test_execute():
         in_(b'spam', out)
 
 
+def test_cancelling_job():
+    job = CancellableJob()
+    errors = []
+
+    def run():
+        with RunningJob(job), TemporaryCwd():
+            try:
+                # The sleep is in another process of the group.
+                execute(['sh', '-c', 'sleep 60; true'])
+            except JobCancelled as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=run)
+    start = time.time()
+    thread.start()
+    time.sleep(0.5)
+    job.cancel()
+    thread.join(10)
+    ok_(not thread.is_alive())
+    ok_(time.time() - start < 10)
+    eq_(len(errors), 1)
+
+    with RunningJob(job), TemporaryCwd():
+        assert_raises(JobCancelled, execute, ['true'])
+
+    r, w = os.pipe()
+    with RunningJob(job), TemporaryCwd():
+        assert_raises(JobCancelled, execute_command, ['true'], fds_to_close=(r,))
+    assert_raises(OSError, os.fstat, r)
+    os.close(w)
+
+
 def test_checker_percentage_parsing():
     eq_(output_to_fraction('42'), (42, 1))
     eq_(output_to_fraction('42.123'), (42123, 1000))
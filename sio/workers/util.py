@@ -8,6 +8,7 @@ import os
 import json
 import tempfile
 import shutil
+import signal
 import threading
 import six
 
@@ -137,6 +138,74 @@ class TemporaryCwd(object):
         threadlocal_dir.tmpdir = self.old_path
 
 
+threadlocal_job = threading.local()
+
+
+class JobCancelled(Exception):
+    """Raised by commands run by a cancelled job."""
+
+
+class CancellableJob(object):
+    """Process groups of the commands run by a job, so that they can be
+    killed when the job is cancelled.
+
+    ``execute_command`` registers the commands in the job which the thread
+    runs (see ``RunningJob``), and refuses to start new ones when it is
+    cancelled. Threads started by the job should run in it as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process_groups = set()
+        self.cancelled = False
+
+    def add_process_group(self, pgid):
+        with self._lock:
+            if not self.cancelled:
+                self._process_groups.add(pgid)
+                return
+        self._kill(pgid)
+
+    def remove_process_group(self, pgid):
+        with self._lock:
+            self._process_groups.discard(pgid)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for pgid in self._process_groups:
+                self._kill(pgid)
+
+    @staticmethod
+    def _kill(pgid):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError:
+            # It has just finished.
+            pass
+
+
+def current_job():
+    """Returns the ``CancellableJob`` run by the thread, or None."""
+    return getattr(threadlocal_job, 'job', None)
+
+
+class RunningJob(object):
+    """Helper class for running a ``CancellableJob`` (or None) in the thread."""
+
+    def __init__(self, job):
+        self.job = job
+        self.old_job = None
+
+    def __enter__(self):
+        self.old_job = current_job()
+        threadlocal_job.job = self.job
+        return self.job
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        threadlocal_job.job = self.old_job
+
+
 def path_join_abs(base, subpath):
     """Joins two absolute paths making ``subpath`` relative to ``base``.
 
@@ -178,6 +247,16 @@ def json_dumps(obj, **kwargs):
     return json.dumps(obj, **kwargs)
 
 
+# Keys of task env with files which executors download through the
+# worker's filetracker cache (with add_to_cache=True), shared by many tasks.
+CACHED_FILE_KEYS = ('exe_file', 'in_file', 'hint_file', 'chk_file', 'interactor_file')
+
+
+def get_cached_files(env):
+    """Returns filetracker paths of files the task gets through the cache."""
+    return [env[key] for key in CACHED_FILE_KEYS if env.get(key)]
+
+
 def decode_fields(fields):
     def _decode_decorator(func):
         def _wrapper(*args, **kwargs):
@@ -1,6 +1,5 @@
 from __future__ import absolute_import
 from __future__ import print_function
-import importlib
 import json
 import logging.config
 import platform
@@ -12,17 +11,32 @@ from twisted.plugin import IPlugin
 from twisted.application import service
 from twisted.application import internet
 
+from sio.protocol.rpc import DEFAULT_HEARTBEAT_INTERVAL, WorkerRPC
 from sio.protocol.worker import WorkerFactory
-from sio.sioworkersd.workermanager import WorkerManager
+from sio.sioworkersd.workermanager import REATTACH_TIMEOUT, WorkerManager
 from sio.sioworkersd.scheduler import getDefaultSchedulerClassName
-from sio.sioworkersd.taskmanager import TaskManager
+from sio.sioworkersd.database import getDefaultDatabaseClassName
+from sio.sioworkersd.taskmanager import (
+    TaskManager,
+    RETURN_CONCURRENCY_PER_HOST,
+    RETURN_KEEPALIVE_IN_SEC,
+)
 from sio.sioworkersd import siorpc
+from sio.sioworkersd.utils import load_class
 
 
 def _host_from_url(url):
     return six.moves.urllib.parse.urlparse(url).hostname
 
 
+def _load_class(path, kind):
+    try:
+        return load_class(path)
+    except (ImportError, AttributeError):
+        print("[ERROR] Invalid " + kind + " class: " + path + "\n")
+        raise
+
+
 class WorkerOptions(usage.Options):
     # TODO: default concurrency to number of detected cpus
     optParameters = [
@@ -31,6 +45,39 @@ class WorkerOptions(usage.Options):
         ['ram', 'r', 1024, "available RAM in MiB", int],
         ['log-config', 'l', '', "log config for python logging"],
         ['name', 'n', platform.node(), "worker name"],
+        [
+            'cpu-exec-slots',
+            None,
+            0,
+            "number of physical cores dedicated to cpu-exec jobs, which "
+            "then run alongside other jobs (implies --can-run-cpu-exec, "
+            "not counted in --concurrency)",
+            int,
+        ],
+        [
+            'cpu-shares',
+            None,
+            0,
+            "CPU shares available for jobs, divided according to job types "
+            "(e.g. a compilation takes 2, an execution 1); 0 to count every "
+            "job as one of --concurrency slots",
+            int,
+        ],
+        [
+            'scratch-disk',
+            None,
+            0,
+            "scratch disk space available for jobs in MiB, 0 to ignore it",
+            int,
+        ],
+        [
+            'heartbeat-interval',
+            None,
+            DEFAULT_HEARTBEAT_INTERVAL,
+            "how often (in seconds) sioworkersd is pinged to notice hung "
+            "connections, 0 to disable",
+            float,
+        ],
     ]
     optFlags = [
         [
@@ -77,6 +124,10 @@ class WorkerServiceMaker(object):
                 # Twisted argument parser set this to 0 or 1.
                 can_run_cpu_exec=bool(options['can-run-cpu-exec']),
                 name=options['name'],
+                cpu_exec_slots=options['cpu-exec-slots'],
+                cpu_shares=options['cpu-shares'] or None,
+                scratch_disk_mb=options['scratch-disk'] or None,
+                heartbeat_interval=options['heartbeat-interval'] or None,
             ),
         )
 
@@ -88,6 +139,13 @@ class ServerOptions(usage.Options):
         ['rpc-listen', 'r', '', "RPC listen address"],
         ['rpc-port', '', 7889, "RPC listen port"],
         ['database', 'db', 'sioworkersd.db', "database file path"],
+        [
+            'database-backend',
+            '',
+            None,
+            "database backend class, by default chosen by the format of "
+            "the database file",
+        ],
         ['scheduler', 's', getDefaultSchedulerClassName(), "scheduler class"],
         [
             'max-task-ram',
@@ -95,6 +153,90 @@ class ServerOptions(usage.Options):
             2048,
             "maximum task required RAM (in MiB) allowed by the scheduler",
         ],
+        [
+            'return-concurrency',
+            '',
+            RETURN_CONCURRENCY_PER_HOST,
+            "maximum number of results returned to a single host at once",
+            int,
+        ],
+        [
+            'return-keepalive',
+            '',
+            RETURN_KEEPALIVE_IN_SEC,
+            "how long (in seconds) idle connections for returning results "
+            "are kept open",
+            int,
+        ],
+        [
+            'schedule-interval',
+            '',
+            0,
+            "delay (in seconds) between a scheduling request and the pass "
+            "which serves it and all the requests made meanwhile, 0 to run "
+            "the pass in the next event loop iteration",
+            float,
+        ],
+        [
+            'fast-lane',
+            '',
+            '',
+            "comma-separated job types (e.g. compile) which are scheduled "
+            "before all the other jobs (PrioritizingScheduler only)",
+        ],
+        [
+            'fast-lane-share',
+            '',
+            0,
+            "fraction (from 0 to 1) of all the vcpu slots reserved for "
+            "the fast lane jobs (PrioritizingScheduler only)",
+            float,
+        ],
+        [
+            'prefetch-depth',
+            '',
+            0,
+            "number of jobs per slot sent to busy workers ahead of time, "
+            "so that they download the files while the running jobs end "
+            "(PrioritizingScheduler only)",
+            int,
+        ],
+        [
+            'slow-worker-rtt',
+            '',
+            0,
+            "round-trip time (in seconds) of heartbeats above which workers "
+            "only get jobs which no other worker can run right now, 0 to "
+            "disable (PrioritizingScheduler only)",
+            float,
+        ],
+        [
+            'heartbeat-interval',
+            '',
+            DEFAULT_HEARTBEAT_INTERVAL,
+            "how often (in seconds) workers are pinged, the ones which "
+            "don't answer for %d intervals are dropped; 0 to disable"
+            % WorkerRPC.HEARTBEAT_MISSES,
+            float,
+        ],
+        [
+            'reattach-timeout',
+            '',
+            REATTACH_TIMEOUT,
+            "how long (in seconds) the jobs of a disconnected worker wait "
+            "for it to reconnect, before they are run on other workers; "
+            "0 to run them elsewhere right away",
+            float,
+        ],
+    ]
+    optFlags = [
+        [
+            'scheduler-backfill',
+            None,
+            "let any-cpu workers blocked for cpu-exec jobs run other jobs "
+            "whose time limits guarantee that they end before the jobs "
+            "the workers are running (PrioritizingScheduler only)",
+        ],
     ]
 
 
@@ -106,23 +248,40 @@ class ServerServiceMaker(object):
 
     def makeService(self, options):
         # root service, leaf in the tree of dependency
-        workerm = WorkerManager()
-
-        sched_module, sched_class = options['scheduler'].rsplit('.', 1)
-        try:
-            SchedulerClass = getattr(importlib.import_module(sched_module), sched_class)
-        except ImportError:
-            print("[ERROR] Invalid scheduler module: " + sched_module + "\n")
-            raise
-        except AttributeError:
-            print("[ERROR] Invalid scheduler class: " + sched_class + "\n")
-            raise
+        workerm = WorkerManager(
+            heartbeat_interval=options['heartbeat-interval'] or None,
+            reattach_timeout=options['reattach-timeout'] or None,
+        )
+
+        SchedulerClass = _load_class(options['scheduler'], 'scheduler')
+        DatabaseClass = _load_class(
+            options['database-backend']
+            or getDefaultDatabaseClassName(options['database']),
+            'database',
+        )
+        # Only the options which were set are passed, so that schedulers
+        # which don't support them still work.
+        scheduler_options = {}
+        if options['scheduler-backfill']:
+            scheduler_options['backfill'] = True
+        if options['fast-lane']:
+            scheduler_options['fast_lane'] = options['fast-lane'].split(',')
+        if options['fast-lane-share']:
+            scheduler_options['fast_lane_share'] = options['fast-lane-share']
+        if options['prefetch-depth']:
+            scheduler_options['prefetch_depth'] = options['prefetch-depth']
+        if options['slow-worker-rtt']:
+            scheduler_options['slow_rtt'] = options['slow-worker-rtt']
 
         taskm = TaskManager(
             options['database'],
             workerm,
-            SchedulerClass(workerm),
+            SchedulerClass(workerm, **scheduler_options),
             int(options['max-task-ram']),
+            db_class=DatabaseClass,
+            return_concurrency=options['return-concurrency'],
+            return_keepalive=options['return-keepalive'],
+            schedule_interval=options['schedule-interval'],
         )
         taskm.setServiceParent(workerm)
 